@@ -0,0 +1,73 @@
+"""
+Compares the voronoi and contour elevation modes on synthetic terrain.
+
+Reports runtime, vertex count and area agreement (intersection over union) of the contour
+band polygon against the Voronoi output, for several grid sizes.
+
+    python -m benchmarks.elevation_modes
+"""
+import argparse
+import time
+
+import numpy as np
+import shapely
+
+from src import data_handler
+from src import grid
+from src import projection
+
+def get_synthetic_coords(config: dict, seed: int = 0) -> dict:
+    """
+    Samples smooth hilly terrain on the region grid.
+    """
+    rng = np.random.default_rng(seed)
+    lon, lat = grid.get_hex_grid(config)
+
+    elevations = np.zeros_like(lon)
+    for _ in range(8):
+        lon_c, lat_c = rng.uniform(lon.min(), lon.max()), rng.uniform(lat.min(), lat.max())
+        width = rng.uniform(0.02, 0.08)
+        elevations += rng.uniform(100, 400) * np.exp(-((lon - lon_c) ** 2 + (lat - lat_c) ** 2) / width ** 2)
+
+    return {'lon': lon, 'lat': lat, 'elevation': elevations}
+
+def run(n_points: list[tuple[int, int]], repeat: int):
+    print(f"{'grid':>10} {'mode':>8} {'time [s]':>9} {'vertices':>9} {'IoU':>6}")
+
+    for n_points_lat, n_points_lon in n_points:
+        config = {
+            'top_left': {'lat': 45.9, 'lon': 15.8},
+            'bottom_right': {'lat': 45.7, 'lon': 16.1},
+            'n_points_lat': n_points_lat,
+            'n_points_lon': n_points_lon,
+            'elevation_range': {'min': 150, 'max': 1000},
+        }
+        coords = get_synthetic_coords(config)
+        local_projection = projection.get_projection([{'region': config}])
+
+        results = {}
+        for mode, method in [
+            ('voronoi', data_handler.convert_elevations_to_shapely_polygon_voronoi),
+            ('contour', data_handler.convert_elevations_to_shapely_polygon_contour),
+        ]:
+            times = []
+            for _ in range(repeat):
+                time_start = time.perf_counter()
+                results[mode] = method(coords, config, local_projection)
+                times.append(time.perf_counter() - time_start)
+            results[mode + '_time'] = min(times)
+
+        reference = results['voronoi']
+        for mode in ['voronoi', 'contour']:
+            polygon = results[mode]
+            iou = polygon.intersection(reference).area / polygon.union(reference).area
+            print(f"{f'{n_points_lat}x{n_points_lon}':>10} {mode:>8} {results[mode + '_time']:>9.3f} "
+                  f"{shapely.get_num_coordinates(polygon):>9} {iou:>6.3f}")
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark of elevation extraction modes')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs, the fastest is reported')
+    args = parser.parse_args()
+
+    run([(80, 160), (200, 400), (400, 800)], args.repeat)
@@ -0,0 +1,81 @@
+"""
+Measures how long a fresh interpreter needs to start the command line without rendering.
+
+Every measurement runs in a new process, so nothing is imported before it starts. Fails with
+exit code 1 if the build/query imports take longer than the budget or load a rendering module.
+
+    python -m benchmarks.import_time
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# Modules only rendering needs, or which the data pipeline imports when it actually uses them
+MODULES_HEAVY = ['plotly', 'kaleido', 'PIL', 'scipy', 'contourpy', 'requests']
+
+STAGES = {
+    'main --help': None,
+    'build/query': 'import main; from src import batch, data_handler, export',
+    'render': 'import main; from src import batch, data_handler, export, visualization',
+}
+
+SCRIPT = """
+import json, sys, time
+time_start = time.perf_counter()
+{imports}
+print(json.dumps({{
+    'time': time.perf_counter() - time_start,
+    'heavy': sorted(m for m in {modules} if m in sys.modules),
+}}))
+"""
+
+def measure(imports: str) -> dict:
+    """
+    Returns the import time in seconds and the heavy modules loaded, measured in a new interpreter.
+    """
+    script = SCRIPT.format(imports=imports, modules=MODULES_HEAVY)
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+def measure_help() -> float:
+    """
+    Returns the wall time of printing the usage of main.py, including the start of the interpreter.
+    """
+    script = (
+        "import subprocess, sys, time; time_start = time.perf_counter(); "
+        "subprocess.run([sys.executable, 'main.py', '--help'], capture_output=True, check=True); "
+        "print(time.perf_counter() - time_start)"
+    )
+    return float(subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout)
+
+def run(repeat: int, budget: float) -> bool:
+    print(f"{'stage':>12} {'time [s]':>9}  heavy modules loaded")
+
+    results = {}
+    for stage, imports in STAGES.items():
+        if imports is None:
+            results[stage] = {'time': min(measure_help() for _ in range(repeat)), 'heavy': []}
+        else:
+            runs = [measure(imports) for _ in range(repeat)]
+            results[stage] = {'time': min(r['time'] for r in runs), 'heavy': runs[0]['heavy']}
+        print(f"{stage:>12} {results[stage]['time']:>9.3f}  {', '.join(results[stage]['heavy']) or '-'}")
+
+    passed = True
+    if results['build/query']['heavy']:
+        print(f"FAIL: build/query imports {', '.join(results['build/query']['heavy'])}, import them where they are used")
+        passed = False
+    if results['build/query']['time'] > budget:
+        print(f"FAIL: build/query imports take {results['build/query']['time']:.3f} s, budget is {budget:.3f} s")
+        passed = False
+
+    return passed
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark of the start up time of main.py')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of runs, the fastest is reported')
+    parser.add_argument('-b', '--budget', type=float, default=0.5, help='Maximum import time of a run without rendering in seconds')
+    args = parser.parse_args()
+
+    sys.exit(0 if run(args.repeat, args.budget) else 1)
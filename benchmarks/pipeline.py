@@ -0,0 +1,403 @@
+"""
+End-to-end benchmark of building and drawing the map of a synthetic city.
+
+Mapbox isochrones and OpenTopoData elevations are answered by a local stand-in server, and every run
+is a new process in an empty working directory, so nothing comes from data/cache. Cities are scaled by
+the number of locations per category, the number of points per line and the size of the elevation grid.
+
+Times of the stages (fetch, polygon build, Voronoi, category union, logic combine and render) are saved
+as JSON named after the current commit, so a run of an older version can be compared with --compare.
+
+    python -m benchmarks.pipeline
+    python -m benchmarks.pipeline --scales small medium --latency 0.05 --compare results/benchmarks/pipeline_<commit>.json
+"""
+import argparse
+import functools
+import http.server
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+import numpy as np
+
+PATH_ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+CENTER = {'lat': 45.55, 'lon': 18.69}
+
+SCALES = {
+    'small': {'locations': 10, 'line_points': 20, 'n_points_lat': 40, 'n_points_lon': 80},
+    'medium': {'locations': 50, 'line_points': 100, 'n_points_lat': 100, 'n_points_lon': 200},
+    'large': {'locations': 200, 'line_points': 400, 'n_points_lat': 200, 'n_points_lon': 400},
+}
+
+STAGES = ['fetch', 'polygon build', 'voronoi', 'category union', 'logic combine', 'render']
+
+# Isochrone categories of the city as (category, profile, minutes, color)
+ISOCHRONE_CATEGORIES = [
+    ('kindergarten', 'walking', 10, 'purple'),
+    ('school', 'walking', 20, 'red'),
+    ('transportation', 'walking', 5, 'orange'),
+]
+
+# Travel speed of the stand-in isochrones in metres per second
+PROFILE_SPEEDS = {'walking': 1.4, 'cycling': 4.2, 'driving': 8.3}
+
+def get_isochrone_response(profile: str, lon: float, lat: float, contours_minutes: list) -> dict:
+    """
+    Returns a Mapbox-like isochrone: a noisy ring per contour, the same for the same request.
+    """
+    features = []
+    for minutes in sorted(contours_minutes, reverse=True):
+        # String hashes change between processes, crc32 keeps the city equal across runs and versions
+        rng = np.random.default_rng(zlib.crc32(f'{profile},{lon:.6f},{lat:.6f},{minutes}'.encode()))
+        angles = np.linspace(0, 2 * np.pi, 64, endpoint=False)
+        radius = minutes * 60 * PROFILE_SPEEDS[profile] * rng.uniform(0.5, 0.9, len(angles))
+
+        ring_lon = lon + radius * np.cos(angles) / (111320 * np.cos(np.radians(lat)))
+        ring_lat = lat + radius * np.sin(angles) / 111320
+        ring = np.round(np.column_stack([ring_lon, ring_lat]), 6).tolist()
+
+        features.append({
+            'type': 'Feature',
+            'properties': {'contour': minutes},
+            'geometry': {'type': 'Polygon', 'coordinates': [ring + ring[:1]]},
+        })
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+def get_elevation(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """
+    Returns smooth synthetic terrain around the city center, hills up to about 400 m.
+    """
+    return (
+        100
+        + 250 * np.exp(-((lon - CENTER['lon'] - 0.03) ** 2 + (lat - CENTER['lat'] - 0.02) ** 2) / 0.02 ** 2)
+        + 150 * np.exp(-((lon - CENTER['lon'] + 0.04) ** 2 + (lat - CENTER['lat'] + 0.01) ** 2) / 0.03 ** 2)
+    )
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers Mapbox isochrone and OpenTopoData requests with synthetic data after an optional delay.
+    """
+
+    # Keep-alive, as the pooled session of src.network expects from the real APIs.
+    # Headers and body are sent separately, without TCP_NODELAY every response would wait for a delayed ACK
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.
+    requests_served = 0
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path.startswith('/isochrone/'):
+            profile, lon_lat = url.path.split('/')[-2:]
+            lon, lat = map(float, lon_lat.split(','))
+            contours_minutes = [int(c) for c in query['contours_minutes'][0].split(',')]
+            body = get_isochrone_response(profile, lon, lat, contours_minutes)
+        elif url.path == '/elevation':
+            points = np.array([p.split(',') for p in query['locations'][0].split('|')], dtype=float)
+            elevations = get_elevation(points[:, 1], points[:, 0])
+            body = {'results': [
+                {'location': {'lat': lat, 'lng': lon}, 'elevation': elevation}
+                for (lat, lon), elevation in zip(points.tolist(), elevations.tolist())
+            ]}
+        else:
+            self.send_error(404)
+            return
+
+        time.sleep(self.latency)
+        StandInHandler.requests_served += 1
+
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(latency: float) -> http.server.ThreadingHTTPServer:
+    StandInHandler.latency = latency
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def get_city_config(scale: dict, seed: int = 0) -> dict:
+    """
+    Returns the config of a synthetic city of about 11 x 11 km with all location types,
+    every location has its coordinates inline so no database is needed.
+    """
+    rng = np.random.default_rng(seed)
+
+    def random_points(n):
+        return [
+            {'lat': float(lat), 'lon': float(lon)}
+            for lat, lon in zip(CENTER['lat'] + rng.uniform(-0.05, 0.05, n), CENTER['lon'] + rng.uniform(-0.07, 0.07, n))
+        ]
+
+    locations = []
+    for category, profile, minutes, color in ISOCHRONE_CATEGORIES:
+        for i, point in enumerate(random_points(scale['locations'])):
+            locations.append({
+                'name': f'{category} {i}', 'category': category, 'type': 'isochrone', 'profile': profile,
+                'contours_minutes': minutes, 'color': color, 'coordinates': [point],
+                # The stand-in server has no rate limit
+                'max_workers': 16, 'requests_per_minute': 60000,
+            })
+
+    # Roads as random walks with 50 m steps
+    for i, start in enumerate(random_points(max(1, scale['locations'] // 5))):
+        angle = np.cumsum(rng.normal(0, 0.3, scale['line_points'])) + rng.uniform(0, 2 * np.pi)
+        lat = start['lat'] + np.cumsum(50 * np.sin(angle)) / 111320
+        lon = start['lon'] + np.cumsum(50 * np.cos(angle)) / (111320 * np.cos(np.radians(start['lat'])))
+        locations.append({
+            'name': f'road {i}', 'category': 'traffic', 'type': 'line', 'buffer_meters': 30, 'color': 'black',
+            'coordinates': [{'lat': float(a), 'lon': float(o)} for a, o in zip(lat, lon)],
+        })
+
+    for i, point in enumerate(random_points(max(1, scale['locations'] // 10))):
+        locations.append({
+            'name': f'powerhouse {i}', 'category': 'powerhouse', 'type': 'circle', 'radius_meters': 400,
+            'color': 'gray', 'coordinates': [point],
+        })
+
+    for i, point in enumerate(random_points(max(1, scale['locations'] // 10))):
+        corners = [(-1, -1), (1, -1), (1, 1), (-1, 1)]
+        locations.append({
+            'name': f'custom {i}', 'category': 'custom', 'type': 'standard', 'color': 'blue',
+            'coordinates': [{'lat': point['lat'] + a * 0.004, 'lon': point['lon'] + o * 0.006} for a, o in corners],
+        })
+
+    locations.append({
+        'name': 'terrain', 'category': 'elevation', 'type': 'elevation', 'color': 'brown',
+        'region': {
+            'top_left': {'lat': CENTER['lat'] + 0.06, 'lon': CENTER['lon'] - 0.08},
+            'bottom_right': {'lat': CENTER['lat'] - 0.06, 'lon': CENTER['lon'] + 0.08},
+            'n_points_lat': scale['n_points_lat'],
+            'n_points_lon': scale['n_points_lon'],
+            'elevation_range': {'min': 0, 'max': 200},
+        },
+    })
+
+    return {
+        'locations': locations,
+        'logic': {
+            'intersection': ['kindergarten', 'school', 'transportation', 'elevation'],
+            'union': ['custom'],
+            'difference': ['traffic', 'powerhouse'],
+        },
+        'center': CENTER,
+    }
+
+class StageTimer:
+    """
+    Measures the time of pipeline stages by wrapping the functions that implement them.
+    Time of a stage nested in another one, e.g. fetching while a location is built, only counts for the nested stage.
+    Only calls on the main thread are timed, work of threads counts for the stage that waits for them.
+
+    Attributes
+    ----------
+    times : dict
+        total time in seconds by stage
+    """
+
+    def __init__(self):
+        self.times = {stage: 0. for stage in STAGES}
+        self._nested = []
+        self._patches = []
+
+    def wrap(self, owner, name: str, stage: str):
+        function = getattr(owner, name)
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            if threading.current_thread() is not threading.main_thread():
+                return function(*args, **kwargs)
+
+            self._nested.append(0.)
+            time_start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - time_start
+                self.times[stage] += elapsed - self._nested.pop()
+                if self._nested:
+                    self._nested[-1] += elapsed
+
+        setattr(owner, name, timed)
+        self._patches.append((owner, name, function))
+
+    def restore(self):
+        for owner, name, function in reversed(self._patches):
+            setattr(owner, name, function)
+        self._patches = []
+
+def run_once(path_config: str, url: str) -> dict:
+    """
+    Builds and draws the map of the config in the current working directory, against the stand-in server.
+    """
+    import shapely
+
+    from src import data_handler
+    from src import logic
+    from src import mapbox
+    from src import opentopdata
+    from src import visualization
+
+    mapbox.ISOCHRONE_LINK = url + '/isochrone/v1/mapbox/{}/{},{}?contours_minutes={}&polygons=true&access_token={}'
+    opentopdata.ELEVATION_LINK = url + '/elevation?locations={}'
+    opentopdata.API_TIME_SLEEP = 1e-4
+
+    timer = StageTimer()
+    timer.wrap(data_handler, 'fetch_isochrones', 'fetch')
+    timer.wrap(opentopdata, 'get_elevations', 'fetch')
+    timer.wrap(data_handler, 'convert_elevations_to_shapely_polygon_voronoi', 'voronoi')
+    timer.wrap(data_handler.Location, 'get_polygons', 'polygon build')
+    timer.wrap(data_handler.Map, '_stack_categories', 'category union')
+    timer.wrap(data_handler.Map, '_union_categories', 'category union')
+    # Categories that the logic clips or reaches late are unioned while it is evaluated
+    timer.wrap(data_handler.Map, '_union_category', 'category union')
+    timer.wrap(logic, 'clip_union', 'category union')
+    timer.wrap(data_handler.Map, '_combine_categories', 'logic combine')
+    timer.wrap(visualization, 'draw_map', 'render')
+
+    time_start = time.perf_counter()
+    map = data_handler.Map(path_config)
+    # Images need map tiles from the internet, only the figures are built
+    visualization.draw_map(map, save=False)
+    time_total = time.perf_counter() - time_start
+    timer.restore()
+
+    final = map.locations_stacked['final_shapely_polygon']
+    return {
+        'stages': timer.times,
+        'total': time_total,
+        'locations': len(map.locations),
+        'final_vertices': 0 if final is None else int(shapely.get_num_coordinates(final)),
+    }
+
+def run_scale(scale: dict, url: str, repeat: int, seed: int) -> dict:
+    """
+    Runs the city of the scale repeat times, each in a new process and empty directory,
+    and keeps the fastest time of every stage.
+    """
+    config = get_city_config(scale, seed)
+
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as path_work:
+            path_config = pathlib.Path(path_work, 'config.json')
+            path_config.write_text(json.dumps(config))
+            path_token = pathlib.Path(path_work, 'data', 'tokens', 'mapbox.txt')
+            path_token.parent.mkdir(parents=True)
+            path_token.write_text('benchmark')
+
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.pipeline', '--run', str(path_config), '--url', url],
+                cwd=path_work,
+                env={**os.environ, 'PYTHONPATH': str(PATH_ROOT)},
+                capture_output=True,
+                text=True,
+            )
+            if output.returncode:
+                raise RuntimeError(f"Benchmark run failed:\n{output.stderr}")
+            runs.append(json.loads(output.stdout.splitlines()[-1]))
+
+    return {
+        'params': scale,
+        'stages': {stage: min(run['stages'][stage] for run in runs) for stage in STAGES},
+        'total': min(run['total'] for run in runs),
+        'locations': runs[0]['locations'],
+        'final_vertices': runs[0]['final_vertices'],
+    }
+
+def get_version() -> str:
+    """
+    Returns the short hash of the checked out commit, with '-dirty' if there are uncommitted changes.
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=PATH_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'diff', '--quiet', 'HEAD', '--', 'src', 'main.py'], cwd=PATH_ROOT
+        ).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+def print_results(results: dict, results_previous: dict = None):
+    print(f"{'scale':>8} {'stage':>15} {'time [s]':>9}" + (f" {'before [s]':>10} {'ratio':>6}" if results_previous else ''))
+
+    for name, result in results['scales'].items():
+        previous = (results_previous or {}).get('scales', {}).get(name)
+        for stage, seconds in [*result['stages'].items(), ('total', result['total'])]:
+            line = f"{name:>8} {stage:>15} {seconds:>9.3f}"
+            if previous is not None:
+                seconds_previous = previous['total'] if stage == 'total' else previous['stages'].get(stage)
+                if seconds_previous:
+                    line += f" {seconds_previous:>10.3f} {seconds / seconds_previous:>6.2f}"
+            print(line)
+
+def run(scales: list, repeat: int, latency: float, seed: int, path_output: str, path_compare: str = None):
+    server = start_server(latency)
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    import shapely
+    results = {
+        'version': get_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'shapely': shapely.__version__,
+        'numpy': np.__version__,
+        'repeat': repeat,
+        'latency': latency,
+        'seed': seed,
+        'scales': {},
+    }
+    try:
+        for name in scales:
+            print(f'Running {name} city...')
+            results['scales'][name] = run_scale(SCALES[name], url, repeat, seed)
+    finally:
+        server.shutdown()
+    results['requests_served'] = StandInHandler.requests_served
+
+    path_output = pathlib.Path(path_output.format(version=results['version']))
+    path_output.parent.mkdir(parents=True, exist_ok=True)
+    path_output.write_text(json.dumps(results, indent=4))
+
+    results_previous = None if path_compare is None else json.loads(pathlib.Path(path_compare).read_text())
+    print_results(results, results_previous)
+    print(f'Results saved: {path_output}')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='End-to-end benchmark on synthetic cities with offline API stand-ins')
+    parser.add_argument('-s', '--scales', nargs='+', choices=list(SCALES), default=['small', 'medium'], help='Cities to run')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs, the fastest time of every stage is reported')
+    parser.add_argument('-l', '--latency', type=float, default=0., help='Delay of every stand-in API response in seconds')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic city')
+    parser.add_argument('-o', '--output', type=str, default='results/benchmarks/pipeline_{version}.json', help='Path of the JSON results, {version} is replaced by the commit')
+    parser.add_argument('-c', '--compare', type=str, default=None, help='JSON results of an earlier run to compare with')
+    parser.add_argument('--run', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--url', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        # Single run in a worker process, started by run_scale
+        print(json.dumps(run_once(args.run, args.url)))
+    else:
+        run(args.scales, args.repeat, args.latency, args.seed, args.output, args.compare)
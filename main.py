@@ -1,16 +1,145 @@
 import argparse
+import pathlib
+import sys
 
-from src import data_handler
-from src import visualization
+# Modules of src are imported by the commands that use them, so parsing arguments and runs
+# without rendering do not pay for loading plotly, kaleido or scipy
+COMMANDS = ['build', 'query', 'render']
 
-if __name__ == '__main__':
+def get_path_results(path_config: str, batch: bool) -> pathlib.Path:
+    """
+    Returns the folder for figures and exports of a config, e.g. results/osijek/school in a batch run.
+    """
+    if not batch:
+        return pathlib.Path('results')
+    path_config = pathlib.Path(path_config)
+    return pathlib.Path('results', path_config.parent.name, path_config.stem)
+
+def build_maps(args: argparse.Namespace) -> dict:
+    """
+    Builds the maps of all configs, several of them in one batch.
 
-    parser = argparse.ArgumentParser(description='Analysis of living locations based on custom criteria')
-    parser.add_argument('-p', '--path_config', type=str, help='Path to config json with the list of criteria')
-    args = parser.parse_args()
+    Returns:
+    dict: Maps by config path.
+    """
+    from src import batch
+    from src import data_handler
 
-    map = data_handler.Map(args.path_config)
+    paths_config = batch.expand_config_paths(args.path_config)
+
+    if len(paths_config) == 1:
+        maps = {paths_config[0]: data_handler.Map(paths_config[0])}
+    else:
+        maps, _ = batch.evaluate_configs(paths_config, max_workers=args.workers)
     print('Maps prepared !')
 
-    visualization.draw_map(map)
-    print('Visualization done !')
\ No newline at end of file
+    return maps
+
+def export_maps(maps: dict, args: argparse.Namespace):
+    from src import export
+    from src import metrics
+
+    for path_config, map in maps.items():
+        with metrics.span(path_config, 'export'):
+            export.export_map(map, get_path_results(path_config, len(maps) > 1) / 'export', max_workers=args.workers)
+    print('Export done !')
+
+def run_build(args: argparse.Namespace):
+    maps = build_maps(args)
+    if args.export:
+        export_maps(maps, args)
+
+def run_query(args: argparse.Namespace):
+    if len(args.lat) != len(args.lon):
+        raise ValueError(f"Got {len(args.lat)} latitudes and {len(args.lon)} longitudes, expected one of each per point")
+
+    for path_config, map in build_maps(args).items():
+        results = map.query_points(args.lat, args.lon)
+        print(f'Query of {path_config}:')
+        print('\t'.join(['lat', 'lon', *results]))
+        for i, (lat, lon) in enumerate(zip(args.lat, args.lon)):
+            print('\t'.join([str(lat), str(lon), *(str(bool(values[i])) for values in results.values())]))
+
+def run_render(args: argparse.Namespace):
+    from src import metrics
+    from src import visualization
+
+    maps = build_maps(args)
+    for path_config, map in maps.items():
+        with metrics.span(path_config, 'render'):
+            if len(maps) == 1:
+                visualization.draw_map(map)
+            else:
+                visualization.draw_map(map, get_path_results(path_config, True))
+    print('Visualization done !')
+
+    if args.export:
+        export_maps(maps, args)
+
+def run_recorded(args: argparse.Namespace):
+    """
+    Runs the command, recording stages with src.metrics if a report, trace or profile is requested.
+    Batch runs with several workers only record the main process.
+    """
+    if args.metrics is None and args.trace is None and args.profile is None:
+        args.run(args)
+        return
+
+    from src import metrics
+
+    metrics.enable(memory=args.memory, profile=args.profile is not None)
+    try:
+        args.run(args)
+    finally:
+        recorder = metrics.disable()
+        if args.metrics is not None:
+            recorder.write_json(args.metrics)
+            print(f'Metrics saved to {args.metrics}')
+        if args.trace is not None:
+            recorder.write_chrome_trace(args.trace)
+            print(f'Trace saved to {args.trace}')
+        if args.profile is not None:
+            recorder.write_profile(args.profile)
+            print(f'Profile saved to {args.profile}')
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description='Analysis of living locations based on custom criteria',
+        epilog='Without a command, render is run, e.g. python main.py -p data/config/osijek/all.json'
+    )
+
+    parser_config = argparse.ArgumentParser(add_help=False)
+    parser_config.add_argument('-p', '--path_config', type=str, nargs='+', required=True, help='Path to config json with the list of criteria. Several paths or glob patterns evaluate all configs in one batch')
+    parser_config.add_argument('-w', '--workers', type=int, default=None, help='Number of worker processes for batch evaluation and export')
+    parser_config.add_argument('--metrics', type=str, default=None, help='Save wall time, CPU time, cache hits and memory per location, network call and union as a JSON report')
+    parser_config.add_argument('--trace', type=str, default=None, help='Save the same stages as a Chrome trace, to open in chrome://tracing or ui.perfetto.dev')
+    parser_config.add_argument('--profile', type=str, default=None, help='Profile the run with cProfile and save the statistics, the report lists the slowest functions')
+    parser_config.add_argument('--memory', action='store_true', help='Trace peak memory per stage with tracemalloc, which slows the run down')
+
+    parser_export = argparse.ArgumentParser(add_help=False)
+    parser_export.add_argument('-e', '--export', action='store_true', help='Also export polygons as GeoJSON and vector tiles to results/.../export')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_build = subparsers.add_parser('build', parents=[parser_config, parser_export], help='Build and cache the polygons without drawing them')
+    parser_build.set_defaults(run=run_build)
+
+    parser_query = subparsers.add_parser('query', parents=[parser_config], help='Check which criteria the given points satisfy')
+    parser_query.add_argument('--lat', type=float, nargs='+', required=True, help='Latitudes of the points')
+    parser_query.add_argument('--lon', type=float, nargs='+', required=True, help='Longitudes of the points')
+    parser_query.set_defaults(run=run_query)
+
+    parser_render = subparsers.add_parser('render', parents=[parser_config, parser_export], help='Build the polygons and save figures (default)')
+    parser_render.set_defaults(run=run_render)
+
+    return parser
+
+if __name__ == '__main__':
+
+    argv = sys.argv[1:]
+    # Older invocations without a command render, as main.py always did
+    if argv and argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['render'] + argv
+
+    args = get_parser().parse_args(argv)
+    run_recorded(args)
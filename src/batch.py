@@ -0,0 +1,131 @@
+import glob
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from src import cache
+from src import data_handler
+from src import database
+from src import projection
+
+def expand_config_paths(patterns: list[str]) -> list[str]:
+    """
+    Expands glob patterns, e.g. 'data/config/*/*.json', into a sorted list of unique config paths.
+    Patterns that match nothing are kept as they are, so a missing file is reported when loaded.
+    """
+    paths_config = []
+    for pattern in patterns:
+        paths_config.extend(sorted(glob.glob(pattern)) or [pattern])
+    return list(dict.fromkeys(paths_config))
+
+def _build_location(config: dict, local_projection: projection.LocalProjection) -> tuple:
+    time_start = time.perf_counter()
+    location = data_handler.Location(config, local_projection)
+    return location, time.perf_counter() - time_start
+
+def _build_map(path_config: str, locations_built: dict) -> tuple:
+    time_start = time.perf_counter()
+    # Maps are already built in parallel processes, threads per map would only compete for the same cores
+    map = data_handler.Map(path_config, locations_built=locations_built, max_workers=1)
+    return map, time.perf_counter() - time_start
+
+def evaluate_configs(
+        paths_config: list[str],
+        max_workers: int = None,
+        path_database: str = database.PATH_DATABASE
+    ) -> tuple[dict, list]:
+    """
+    Evaluates many configs in one process pool. Locations that are identical across configs
+    are built only once and shared by all maps that use them. Missing Mapbox isochrones are fetched
+    by this process before the pool starts, so the rate limit holds for the whole run and not per worker.
+
+    Parameters:
+    paths_config (list): Paths to config json files.
+    max_workers (int): Number of worker processes, defaults to the number of CPUs.
+    path_database (str): Path to the database (default is 'data/database').
+
+    Returns:
+    tuple: Maps by config path, and a timing summary with one dict per config.
+    """
+    time_start = time.perf_counter()
+
+    # Resolve every location against the database first, so identical locations get identical keys.
+    # Locations are built in the projection of their map, so they are shared only between maps with the same center
+    configs_location = {}
+    keys_per_config = {}
+    for path_config in paths_config:
+        configuration = data_handler.load_json(path_config)
+        if not configuration:
+            raise ValueError(f"Config {path_config} does not exist or is empty")
+
+        keys_per_config[path_config] = []
+        for config in configuration['locations']:
+            data_handler.Map.update_config_with_database_coordinates(config, path_database)
+        local_projection = projection.get_projection(configuration['locations'], configuration.get('center'))
+
+        for config in configuration['locations']:
+            # Isochrones computed per category have no polygons of their own, the map builds them
+            if data_handler.is_category_isochrone(configuration, config):
+                continue
+            key = data_handler.get_location_key(config, local_projection)
+            configs_location.setdefault(key, (config, local_projection))
+            keys_per_config[path_config].append(key)
+
+    data_handler.fetch_isochrones(
+        [
+            config for config, _ in configs_location.values()
+            if config['type'] == 'isochrone' and config.get('source', 'mapbox') == 'mapbox'
+        ],
+        cache.get_cache()
+    )
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        keys = list(configs_location)
+        results = executor.map(
+            _build_location,
+            [configs_location[k][0] for k in keys],
+            [configs_location[k][1] for k in keys]
+        )
+        locations_built = dict(zip(keys, results))
+
+        futures = {
+            path_config: executor.submit(
+                _build_map,
+                path_config,
+                {k: locations_built[k][0] for k in keys_per_config[path_config]}
+            )
+            for path_config in paths_config
+        }
+        maps_built = {path_config: future.result() for path_config, future in futures.items()}
+
+    n_uses = {}
+    for keys_config in keys_per_config.values():
+        for key in set(keys_config):
+            n_uses[key] = n_uses.get(key, 0) + 1
+
+    timings = []
+    for path_config in paths_config:
+        keys_config = set(keys_per_config[path_config])
+        timings.append({
+            'config': path_config,
+            'locations': len(keys_config),
+            'locations_shared': sum(n_uses[k] > 1 for k in keys_config),
+            'time_locations': sum(locations_built[k][1] for k in keys_config),
+            'time_stacking': maps_built[path_config][1],
+        })
+
+    maps = {path_config: map for path_config, (map, _) in maps_built.items()}
+
+    print_timings(timings, time.perf_counter() - time_start, len(configs_location))
+
+    return maps, timings
+
+def print_timings(timings: list, time_total: float, n_locations_unique: int):
+    """
+    Prints the per config timing summary of evaluate_configs.
+    """
+    width = max(len(t['config']) for t in timings)
+    print(f"{'config':<{width}} {'locations':>9} {'shared':>6} {'build [s]':>9} {'stack [s]':>9}")
+    for t in timings:
+        print(f"{t['config']:<{width}} {t['locations']:>9} {t['locations_shared']:>6} "
+              f"{t['time_locations']:>9.2f} {t['time_stacking']:>9.2f}")
+    print(f'{len(timings)} configs, {n_locations_unique} unique locations, {time_total:.2f} s in total')
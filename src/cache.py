@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+import zipfile
+
+import numpy as np
+import shapely
+
+PATH_CACHE = 'data/cache'
+
+# Bump when the layout of stored arrays changes, old entries then simply stop matching
+CACHE_VERSION = 2
+
+class Cache:
+    """
+    A content-addressed cache of NumPy arrays stored as .npz files.
+
+    Entries are keyed by a hash of exactly the parameters that affect the cached result,
+    written atomically so several workers can share the directory, and evicted by age
+    and total size, least recently used first.
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        directory with cached entries
+    max_size_mb : float
+        total size of the directory above which least recently used entries are removed
+    max_age_days : float
+        entries not used for longer than this are removed
+    hits : int
+        number of loads served from the cache
+    misses : int
+        number of entries that had to be fetched, counted by load and by contains with count
+    """
+
+    def __init__(self, path: str = PATH_CACHE, max_size_mb: float = 1024, max_age_days: float = 90):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size_mb = max_size_mb
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Total size and number of the entries, scanned by the first eviction or stats and then tracked as entries are saved
+        self._size_bytes = None
+        self._n_entries = None
+        self._evicted = False
+
+    @staticmethod
+    def key(params: dict) -> str:
+        """
+        Returns a stable hash of the parameters, independent of key order.
+        """
+        params = {**params, 'cache_version': CACHE_VERSION}
+        params_json = json.dumps(params, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(params_json.encode()).hexdigest()
+
+    def get_path(self, key: str, suffix: str = '.npz') -> pathlib.Path:
+        return self.path / f'{key}{suffix}'
+
+    def contains(self, key: str, count: bool = False) -> bool:
+        """
+        Tells whether an entry exists under the key.
+
+        Parameters:
+        key (str): Cache key of the entry.
+        count (bool): Counts a miss if the entry does not exist, for callers that fetch missing entries
+            and use them without a load.
+        """
+        exists = self.get_path(key).exists()
+        if count and not exists:
+            with self._lock:
+                self.misses += 1
+        return exists
+
+    def load(self, key: str) -> dict:
+        """
+        Loads arrays stored under the key.
+
+        Returns:
+        dict: Arrays by name, or None if the entry does not exist or cannot be read.
+        """
+        path_entry = self.get_path(key)
+        try:
+            with np.load(path_entry, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            # Loading counts as use for the least recently used eviction
+            os.utime(path_entry)
+        except (FileNotFoundError, ValueError, OSError, zipfile.BadZipFile):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return arrays
+
+    def save(self, key: str, arrays: dict):
+        """
+        Stores arrays under the key. The entry is written to a temporary file first
+        and moved into place, so readers never see a partially written file.
+        """
+        file_temp, path_temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(file_temp, 'wb') as file:
+                np.savez(file, **arrays)
+            size = os.path.getsize(path_temp)
+            try:
+                size_replaced = os.path.getsize(self.get_path(key))
+            except FileNotFoundError:
+                size_replaced = None
+            os.replace(path_temp, self.get_path(key))
+        except BaseException:
+            pathlib.Path(path_temp).unlink(missing_ok=True)
+            raise
+
+        # The directory is only scanned by the first save of the process and when the cache outgrows its limit,
+        # not on every save
+        with self._lock:
+            if self._size_bytes is not None:
+                self._size_bytes += size - (size_replaced or 0)
+                self._n_entries += size_replaced is None
+            scan = not self._evicted or self._size_bytes > self.max_size_mb * 1024 * 1024
+        if scan:
+            self.evict()
+
+    def load_or_fetch(self, params: dict, fetch_func, *args, encode=None, decode=None):
+        """
+        Loads the result for the parameters from the cache, or fetches it using
+        the provided function and then stores it.
+
+        Parameters:
+        params (dict): Parameters that determine the result, hashed into the cache key.
+        fetch_func (callable): Function called with args on a cache miss.
+        encode (callable): Converts the fetched result to a dict of arrays. Defaults to no conversion.
+        decode (callable): Converts stored arrays back to the result. Defaults to no conversion.
+        """
+        key = self.key(params)
+        arrays = self.load(key)
+        if arrays is not None:
+            return arrays if decode is None else decode(arrays)
+
+        data = fetch_func(*args)
+        self.save(key, data if encode is None else encode(data))
+        return data
+
+    def evict(self, size_ratio: float = 0.9):
+        """
+        Removes entries older than max_age_days, then least recently used entries
+        until the cache is smaller than size_ratio of max_size_mb. Leaving room below the limit
+        means the next saves do not scan the directory again right away.
+        """
+        entries = self._scan()
+
+        time_limit = time.time() - self.max_age_days * 24 * 3600
+        size_total = sum(size for _, size, _ in entries)
+        n_entries = len(entries)
+        size_limit = self.max_size_mb * 1024 * 1024
+        if size_total > size_limit:
+            size_limit *= size_ratio
+
+        for mtime, size, path_entry in sorted(entries):
+            if mtime >= time_limit and size_total <= size_limit:
+                break
+            path_entry.unlink(missing_ok=True)
+            size_total -= size
+            n_entries -= 1
+
+        with self._lock:
+            self._size_bytes = size_total
+            self._n_entries = n_entries
+            self._evicted = True
+
+    def _scan(self) -> list:
+        """
+        Returns modification time, size and path of every entry. Entries removed by another worker
+        while scanning are skipped.
+        """
+        entries = []
+        for path_entry in self.path.glob('*.npz'):
+            try:
+                stat = path_entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path_entry))
+        return entries
+
+    def stats(self) -> dict:
+        """
+        Returns hit and miss counts together with the size of the cache, tracked since the directory
+        was last scanned. The directory is only scanned if no entry was saved or evicted yet.
+        """
+        if self._size_bytes is None:
+            entries = self._scan()
+            with self._lock:
+                if self._size_bytes is None:
+                    self._size_bytes = sum(size for _, size, _ in entries)
+                    self._n_entries = len(entries)
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': self._n_entries,
+            'size_mb': self._size_bytes / 1024 / 1024,
+        }
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(path: str = PATH_CACHE) -> Cache:
+    """
+    Returns the cache shared within the process for the given directory.
+    """
+    path = str(pathlib.Path(path).resolve())
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = Cache(path)
+    return _caches[path]
+
+def get_counts() -> tuple[int, int]:
+    """
+    Returns hits and misses summed over all caches of the process.
+    """
+    caches = list(_caches.values())
+    return sum(c.hits for c in caches), sum(c.misses for c in caches)
+
+def encode_grid(coords: dict) -> dict:
+    """
+    Converts sampled grid values, e.g. {'lon': [], 'lat': [], 'elevation': []}, to float arrays.
+    """
+    return {name: np.asarray(values, dtype=float) for name, values in coords.items()}
+
+def encode_geometry(geometry: shapely.Geometry) -> dict:
+    """
+    Stores a Shapely geometry as WKB bytes.
+    """
+    return {'wkb': np.frombuffer(shapely.to_wkb(geometry), dtype=np.uint8)}
+
+def decode_geometry(arrays: dict) -> shapely.Geometry:
+    """
+    Restores a Shapely geometry stored by encode_geometry.
+    """
+    return shapely.from_wkb(arrays['wkb'].tobytes())
+
+def hash_geometries(geometries: list) -> str:
+    """
+    Returns a hash of the geometries that does not depend on their order.
+    """
+    wkbs = shapely.to_wkb(np.asarray(geometries, dtype=object)) if len(geometries) else []
+    digest = hashlib.sha256()
+    for wkb_digest in sorted(hashlib.sha256(wkb).digest() for wkb in wkbs):
+        digest.update(wkb_digest)
+    return digest.hexdigest()
@@ -0,0 +1,115 @@
+import numpy as np
+import shapely
+
+class Coordinates:
+    """
+    A class to store points or rings in one contiguous float64 array.
+
+    Rings of different lengths are stacked into a single (n, 2) array of (lon, lat) pairs and split
+    by offsets, so conversion to Shapely and Plotly works on array views instead of Python lists.
+
+    Attributes
+    ----------
+    xy : np.ndarray
+        C-contiguous (n, 2) array of longitudes and latitudes
+    offsets : np.ndarray
+        start of every ring in xy followed by the total number of points, ring i is xy[offsets[i]:offsets[i + 1]]
+    """
+
+    __slots__ = ('xy', 'offsets')
+
+    def __init__(self, xy: np.ndarray = None, offsets: np.ndarray = None):
+        """
+        Constructs coordinates from the stacked array, a single ring if offsets are not given.
+        """
+        self.xy = np.ascontiguousarray(np.empty((0, 2)) if xy is None else xy, dtype=np.float64).reshape(-1, 2)
+        self.offsets = np.array([0, len(self.xy)]) if offsets is None else np.asarray(offsets, dtype=np.int64)
+
+    @property
+    def lon(self) -> np.ndarray:
+        return self.xy[:, 0]
+
+    @property
+    def lat(self) -> np.ndarray:
+        return self.xy[:, 1]
+
+    def __len__(self) -> int:
+        """
+        Returns the number of rings.
+        """
+        return len(self.offsets) - 1
+
+    def ring(self, i: int) -> np.ndarray:
+        """
+        Returns a view of the (lon, lat) pairs of ring i.
+        """
+        return self.xy[self.offsets[i]:self.offsets[i + 1]]
+
+    @classmethod
+    def from_points(cls, points: list[dict]) -> 'Coordinates':
+        """
+        Creates a single ring from points as listed in the database, e.g. [{'lat': 45.5, 'lon': 18.6}].
+        """
+        xy = np.fromiter(
+            (value for point in points for value in (point['lon'], point['lat'])),
+            dtype=np.float64, count=2 * len(points)
+        )
+        return cls(xy)
+
+    @classmethod
+    def from_rings(cls, rings: list) -> 'Coordinates':
+        """
+        Creates coordinates from a list of rings, each an array-like of (lon, lat) pairs.
+        """
+        rings = [np.asarray(ring, dtype=np.float64).reshape(-1, 2) for ring in rings]
+        xy = np.concatenate(rings) if rings else None
+        offsets = np.cumsum([0] + [len(ring) for ring in rings])
+        return cls(xy, offsets)
+
+    @classmethod
+    def from_shapely(cls, geometries) -> 'Coordinates':
+        """
+        Creates coordinates with one ring per linear ring or line of the given geometries.
+        """
+        parts = shapely.get_parts(geometries)
+        is_polygon = shapely.get_type_id(parts) == 3
+        rings = np.concatenate([shapely.get_rings(parts[is_polygon]), parts[~is_polygon]])
+
+        xy, index = shapely.get_coordinates(rings, return_index=True)
+        offsets = np.searchsorted(index, np.arange(len(rings) + 1))
+        return cls(xy, offsets)
+
+    @classmethod
+    def from_arrays(cls, arrays: dict) -> 'Coordinates':
+        """
+        Restores coordinates stored by to_arrays.
+        """
+        return cls(arrays['xy'], arrays['offsets'])
+
+    def to_arrays(self) -> dict:
+        """
+        Returns the arrays backing the coordinates, e.g. to store them in the cache.
+        """
+        return {'xy': self.xy, 'offsets': self.offsets}
+
+    def _get_ring_indices(self, min_points: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns mask of rings with at least min_points points, the index among those rings for each
+        of their points, and mask of points that belong to them.
+        """
+        counts = np.diff(self.offsets)
+        valid = counts >= min_points
+        ring_ids = np.repeat(np.arange(len(counts)), counts)
+        selected = valid[ring_ids]
+        return valid, np.unique(ring_ids[selected], return_inverse=True)[1], selected
+
+    def to_shapely_polygons(self) -> np.ndarray:
+        """
+        Converts every ring to a Shapely Polygon in one call. Rings with less than three points become empty polygons.
+        """
+        valid, ring_ids, selected = self._get_ring_indices(3)
+        shapely_polygons = np.full(len(self), shapely.Polygon(), dtype=object)
+        if valid.any():
+            rings = shapely.linearrings(self.xy[selected], indices=ring_ids)
+            shapely_polygons[valid] = shapely.polygons(rings)
+        return shapely_polygons
@@ -1,15 +1,24 @@
+import functools
+import itertools
 import json
 import pathlib
-import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import shapely
-import pandas as pd
+import numpy as np
 from shapely.ops import unary_union
-from matplotlib.patches import Ellipse
-from scipy.spatial import Voronoi
-from collections import defaultdict
 
+from src import cache
+from src import database
+from src import dem
+from src import lod
+from src import logic
 from src import mapbox
+from src import metrics
 from src import opentopdata
+from src import projection
+from src.coordinates import Coordinates
 
 def load_json(path: str) -> dict:
     """
@@ -34,69 +43,49 @@ def load_json(path: str) -> dict:
 
     return config
 
-def convert_coords_to_shapely_polygon(coords: dict[str, list]) -> shapely.Polygon:
+def convert_coords_to_shapely_polygon(coords: Coordinates) -> shapely.Polygon:
     """
     Converts coordinates to a Shapely Polygon.
 
     Parameters:
-    coords (dict): A dictionary with 'lon' and 'lat' keys containing lists of longitudes and latitudes respectively.
+    coords (Coordinates): A single ring of projected coordinates.
 
     Returns:
     Polygon: A Shapely Polygon object.
     """
-    if 'lon' not in coords or 'lat' not in coords:
-        raise ValueError("Input dictionary must have 'lon' and 'lat' keys")
-
-    coords_temp = [(lon, lat) for lon, lat in zip(coords['lon'], coords['lat'])]
-    shapely_polygon = shapely.Polygon(coords_temp)
-
-    return shapely_polygon
+    return shapely.Polygon(coords.xy)
 
-def convert_coords_to_shapely_line(coords: dict[str, list], buffer_distance: float) -> shapely.LineString:
+def convert_coords_to_shapely_line(coords: Coordinates, buffer_distance: float) -> shapely.LineString:
     """
     Converts coordinates to a Shapely LineString and applies a buffer.
 
     Parameters:
-    coords (dict): A dictionary with 'lon' and 'lat' keys containing lists of longitudes and latitudes respectively.
-    buffer_distance (float): The buffer distance to apply to the LineString.
+    coords (Coordinates): A single ring of projected coordinates.
+    buffer_distance (float): The buffer distance in metres to apply to the LineString.
 
     Returns:
     LineString: A buffered Shapely LineString object.
     """
-    if 'lon' not in coords or 'lat' not in coords:
-        raise ValueError("Input dictionary must have 'lon' and 'lat' keys")
-
-    coords_temp = [(lon, lat) for lon, lat in zip(coords['lon'], coords['lat'])]
-    shapely_line = shapely.LineString(coords_temp)
+    shapely_line = shapely.LineString(coords.xy)
     shapely_line = shapely_line.buffer(buffer_distance)
 
     return shapely_line
 
-def convert_coords_to_shapely_ellipse(coords: dict, radius_distance: float) -> shapely.Polygon:
+def convert_coords_to_shapely_circle(coords: Coordinates, radius_distance: float) -> shapely.Polygon:
     """
-    Converts coordinates to a Shapely ellipse.
+    Converts coordinates to a Shapely circle.
 
     Parameters:
-    coords (dict): A dictionary containing longitude and latitude.
-    radius_distance (float): The radius distance for the ellipse.
+    coords (Coordinates): Projected coordinates whose first point is the center.
+    radius_distance (float): The radius of the circle in metres.
 
     Returns:
-    Polygon: A Shapely Polygon object representing the ellipse.
+    Polygon: A Shapely Polygon object representing the circle.
     """
+    shapely_circle = shapely.Point(coords.xy[0])
+    shapely_circle = shapely_circle.buffer(radius_distance)
 
-    center_lon = coords['lon'][0]
-    center_lat = coords['lat'][0]
-    ellipse_width = radius_distance
-    ellipse_height = radius_distance * 0.75
-
-    # Draw the ellipse using matplotlib
-    matplotlib_ellipse = Ellipse((center_lon, center_lat), ellipse_width, ellipse_height, angle=0) 
-    shapely_polygon = shapely.Polygon(matplotlib_ellipse.get_verts())
-
-    # shapely_circle = shapely.geometry.point.Point(coords['lon'], coords['lat'])
-    # shapely_circle = shapely_circle.buffer(radius_distance)
-
-    return shapely_polygon
+    return shapely_circle
 
 def convert_shapely_line_to_shapely_polygon(shapely_line: shapely.LineString) -> shapely.Polygon:
     """
@@ -115,6 +104,284 @@ def convert_shapely_line_to_shapely_polygon(shapely_line: shapely.LineString) ->
 
     return shapely_polygon
 
+def convert_voronoi_regions_to_shapely_polygons(voronoi: 'Voronoi', point_indices: np.ndarray) -> np.ndarray:
+    """
+    Converts Voronoi regions of the selected points to Shapely Polygons in bulk.
+    Vertices at infinity are dropped and regions left with less than three vertices are skipped.
+
+    Parameters:
+    voronoi (Voronoi): Voronoi diagram computed on projected (x, y) points.
+    point_indices (np.ndarray): Indices of the points whose regions are converted.
+
+    Returns:
+    np.ndarray: Array of Shapely Polygon objects.
+    """
+    regions = [voronoi.regions[r] for r in voronoi.point_region[point_indices]]
+    lengths = np.fromiter(map(len, regions), dtype=np.intp, count=len(regions))
+
+    # Flatten ragged regions into vertex indices with the id of the region they belong to
+    vertex_indices = np.fromiter(itertools.chain.from_iterable(regions), dtype=np.intp, count=lengths.sum())
+    region_ids = np.repeat(np.arange(len(regions)), lengths)
+
+    finite = vertex_indices != -1
+    vertex_indices, region_ids = vertex_indices[finite], region_ids[finite]
+
+    valid = (np.bincount(region_ids, minlength=len(regions)) > 2)[region_ids]
+    vertex_indices, region_ids = vertex_indices[valid], region_ids[valid]
+    if not len(vertex_indices):
+        return np.empty(0, dtype=object)
+
+    _, region_ids = np.unique(region_ids, return_inverse=True)
+
+    rings = shapely.linearrings(voronoi.vertices[vertex_indices], indices=region_ids)
+
+    return shapely.polygons(rings)
+
+def convert_elevations_to_shapely_polygon_voronoi(
+        coords: dict,
+        config: dict,
+        local_projection: projection.LocalProjection
+    ) -> shapely.Polygon:
+    """
+    Converts sampled elevations to the region within the elevation range by merging Voronoi cells
+    of the points in range.
+
+    Parameters:
+    coords (dict): A dictionary with 'lon', 'lat' and 'elevation' keys containing lists of sampled points.
+    config (dict): Region configuration with the 'elevation_range' key.
+    local_projection (LocalProjection): Projection of the map, cells are built in metres.
+
+    Returns:
+    Polygon: A Shapely Polygon or MultiPolygon object.
+    """
+    # scipy.spatial takes a third of a second to import, only load it when elevations are processed
+    from scipy.spatial import Voronoi
+
+    elevations = np.asarray(coords['elevation'], dtype=float)
+    mask = (elevations >= config['elevation_range']['min']) & (elevations <= config['elevation_range']['max'])
+
+    points = np.column_stack(local_projection.forward(coords['lon'], coords['lat']))
+    voronoi = Voronoi(points)
+    cells = convert_voronoi_regions_to_shapely_polygons(voronoi, np.flatnonzero(mask))
+
+    # Voronoi cells share their edges exactly, so they form a coverage that can be
+    # dissolved much faster than with a general union
+    shapely_polygon = shapely.coverage_union_all(cells) if len(cells) else None
+    if shapely_polygon is None or not shapely_polygon.is_valid:
+        shapely_polygon = unary_union(cells)
+
+    # Cells on the edge of the grid reach far outside of it, keep only the sampled region
+    return shapely_polygon.intersection(shapely.box(*points.min(axis=0), *points.max(axis=0)))
+
+def convert_elevations_to_shapely_polygon_contour(
+        coords: dict,
+        config: dict,
+        local_projection: projection.LocalProjection
+    ) -> shapely.Polygon:
+    """
+    Converts elevations sampled on the regular region grid to the region within the elevation range
+    with filled marching squares contours. The band polygon has far fewer vertices than merged Voronoi
+    cells but only covers the area between the outer grid points.
+
+    Parameters:
+    coords (dict): A dictionary with 'lon', 'lat' and 'elevation' keys containing lists of points, ordered as the region grid.
+    config (dict): Region configuration with 'n_points_lat', 'n_points_lon' and 'elevation_range' keys.
+    local_projection (LocalProjection): Projection of the map, the grid is contoured in metres.
+
+    Returns:
+    Polygon: A Shapely Polygon or MultiPolygon object.
+    """
+    import contourpy
+
+    shape = (config['n_points_lat'], config['n_points_lon'])
+    if len(coords['elevation']) != shape[0] * shape[1]:
+        raise ValueError("Contour mode needs an elevation for every point of the region grid")
+
+    x, y = local_projection.forward(coords['lon'], coords['lat'])
+    x, y = x.reshape(shape), y.reshape(shape)
+    elevations = np.ma.masked_invalid(np.asarray(coords['elevation'], dtype=float).reshape(shape))
+
+    # Lower level is exclusive in contourpy, nudge it so the range stays inclusive as in voronoi mode
+    elevation_min = np.nextafter(config['elevation_range']['min'], -np.inf)
+    generator = contourpy.contour_generator(x, y, elevations, fill_type=contourpy.FillType.OuterOffset)
+    points, offsets = generator.filled(elevation_min, config['elevation_range']['max'])
+
+    shapely_polygons = [
+        shapely.Polygon(p[o[0]:o[1]], [p[start:end] for start, end in zip(o[1:-1], o[2:])])
+        for p, o in zip(points, offsets)
+    ]
+
+    return unary_union(shapely_polygons)
+
+def get_isochrone_cache_params(
+        profile: str,
+        lat: float,
+        lon: float,
+        contours_minutes: int,
+        source: str = 'mapbox',
+        source_params: dict = None
+    ) -> dict:
+    """
+    Returns the parameters that determine an isochrone, used as its cache key.
+    Isochrones computed on a local road graph also depend on the graph and how polygons are built, see graph.get_cache_params.
+    """
+    return {
+        'type': 'isochrone',
+        'source': source,
+        'profile': profile,
+        'lat': lat,
+        'lon': lon,
+        'contours_minutes': contours_minutes,
+        **(source_params or {}),
+    }
+
+def get_isochrone_source_params(config: dict) -> dict:
+    """
+    Returns the parameters of the isochrone source of a location config that go into the cache key,
+    None for Mapbox.
+    """
+    source = config.get('source', 'mapbox')
+    if source == 'mapbox':
+        return None
+    elif source == 'graph':
+        # Road graphs need scipy.sparse, imported only for locations that use them
+        from src import graph
+        return graph.get_cache_params(config)
+    raise ValueError(f"Unknown isochrone source {source}, expected 'mapbox' or 'graph'")
+
+def get_isochrone_key(config: dict, coord: dict, contours_minutes: int, location_cache: cache.Cache, source_params: dict = None) -> str:
+    """
+    Returns the cache key of one contour of an isochrone location config at one of its coordinates.
+    """
+    if source_params is None:
+        source_params = get_isochrone_source_params(config)
+    return location_cache.key(
+        get_isochrone_cache_params(
+            config['profile'], coord['lat'], coord['lon'], contours_minutes, config.get('source', 'mapbox'), source_params
+        )
+    )
+
+def fetch_isochrones(configs: list, location_cache: cache.Cache) -> dict:
+    """
+    Fetches or computes the contours of isochrone location configs that are missing from the cache,
+    together with their contours_minutes_prefetch, and saves every one as soon as it arrives.
+    Mapbox isochrones of all configs are requested in one batch, so they share one rate limit:
+    the smallest max_workers and requests_per_minute of the configs.
+
+    Parameters:
+    configs (list): Isochrone location configs.
+    location_cache (Cache): Cache the contours are stored in.
+
+    Returns:
+    dict: Coordinates of the fetched contours by cache key.
+    """
+    queries = {'mapbox': [], 'graph': []}
+    for config in configs:
+        source = config.get('source', 'mapbox')
+        source_params = get_isochrone_source_params(config)
+        # Mapbox returns up to four contours per request, a road graph search has no limit
+        max_contours = mapbox.MAX_CONTOURS if source == 'mapbox' else None
+        contours_minutes = sorted({config['contours_minutes']} | set(config.get('contours_minutes_prefetch', [])))
+
+        # Every missing contour of a coordinate is requested in the same call
+        for coord in config['coordinates']:
+            keys = {m: get_isochrone_key(config, coord, m, location_cache, source_params) for m in contours_minutes}
+            missing = [m for m in contours_minutes if not location_cache.contains(keys[m], count=True)]
+            step = max_contours or max(len(missing), 1)
+            for i in range(0, len(missing), step):
+                query = {
+                    'profile': config['profile'],
+                    'lon': coord['lon'],
+                    'lat': coord['lat'],
+                    'contours_minutes': missing[i:i + step],
+                }
+                queries[source].append((config, query, {m: keys[m] for m in query['contours_minutes']}))
+
+    fetched = {}
+
+    def save(keys_contour, polygons_contours):
+        for minutes, key in keys_contour.items():
+            location_cache.save(key, polygons_contours[minutes].to_arrays())
+            fetched[key] = polygons_contours[minutes]
+
+    if queries['mapbox']:
+        # Fetch all missing isochrones at once so requests overlap instead of running one by one
+        results = mapbox.iter_isochrone_coordinates_batch(
+            [query for _, query, _ in queries['mapbox']],
+            max_workers=min(config.get('max_workers', 8) for config, _, _ in queries['mapbox']),
+            requests_per_minute=min(config.get('requests_per_minute', 300) for config, _, _ in queries['mapbox']),
+        )
+        # Every isochrone is saved as soon as it arrives, so a failed request does not discard the others
+        for i_query, polygons_contours in results:
+            save(queries['mapbox'][i_query][2], polygons_contours)
+
+    if queries['graph']:
+        from src import graph
+
+        # Searches run per config, whose settings decide the graph and how polygons are built
+        queries_config = {}
+        for config, query, keys_contour in queries['graph']:
+            queries_config.setdefault(id(config), (config, []))[1].append((query, keys_contour))
+        for config, queries_graph in queries_config.values():
+            results = graph.get_isochrone_coordinates_batch([query for query, _ in queries_graph], config)
+            for (_, keys_contour), polygons_contours in zip(queries_graph, results):
+                save(keys_contour, polygons_contours)
+
+    return fetched
+
+def get_elevation_cache_params(config: dict) -> dict:
+    """
+    Returns the parameters that determine fetched elevations of a region, used as their cache key.
+    Elevation range and mode only affect how elevations are used, so they are left out.
+    """
+    return {
+        'type': 'elevation',
+        'source': config.get('source', 'opentopdata'),
+        'top_left': config['top_left'],
+        'bottom_right': config['bottom_right'],
+        'n_points_lat': config['n_points_lat'],
+        'n_points_lon': config['n_points_lon'],
+    }
+
+def unary_union_cached(shapely_polygons: list, path_cache: str = cache.PATH_CACHE) -> shapely.Geometry:
+    """
+    Unions polygons, reusing the result of a previous run if the input polygons did not change.
+
+    Parameters:
+    shapely_polygons (list): Shapely geometries to union.
+    path_cache (str): The path to the cache directory. Defaults to 'data/cache'.
+
+    Returns:
+    Geometry: The union of all polygons.
+    """
+    return cache.get_cache(path_cache).load_or_fetch(
+        {'type': 'union', 'polygons': cache.hash_geometries(shapely_polygons)},
+        unary_union,
+        shapely_polygons,
+        encode=cache.encode_geometry,
+        decode=cache.decode_geometry,
+    )
+
+def get_location_key(config: dict, local_projection: projection.LocalProjection = None) -> str:
+    """
+    Returns a hash of the full location configuration and the projection its polygons are built in,
+    equal for locations that are identical across configs.
+    """
+    origin = None if local_projection is None else local_projection.origin
+    return cache.Cache.key({'type': 'location', 'config': config, 'projection': origin})
+
+def is_category_isochrone(configuration: dict, config: dict) -> bool:
+    """
+    Tells whether the isochrone of a location is computed together with its whole category.
+    That needs "isochrone_union": "category" in the map configuration and a location on a local road graph,
+    Mapbox isochrones are always fetched per coordinate.
+    """
+    return (
+        configuration.get('isochrone_union', 'location') == 'category'
+        and config['type'] == 'isochrone'
+        and config.get('source', 'mapbox') == 'graph'
+    )
+
 class Location:
     """
     A class to represent a location.
@@ -123,13 +390,22 @@ class Location:
     ----------
     config : dict
         a dictionary containing configuration parameters for the location
+    coordinates : Coordinates
+        coordinates of the location from the config, None if it has none
+    projection : LocalProjection
+        local metric projection the shapely polygons are built in
     polygons : list
         a list to store polygons
     name : str
         a string to store the name of the location
     """
 
-    def __init__(self, config: dict):
+    def __init__(
+            self,
+            config: dict,
+            local_projection: projection.LocalProjection = None,
+            build_polygons: bool = True
+        ):
         """
         Constructs all the necessary attributes for the location object.
 
@@ -137,27 +413,42 @@ class Location:
         ----------
             config : dict
                 a dictionary containing configuration parameters for the location
+            local_projection : LocalProjection
+                projection shared by all locations of the map, centred at the location by default
+            build_polygons : bool
+                False leaves polygons empty, for locations whose category area is computed at once by the map
         """
 
         self.config = config
+        self.coordinates = Coordinates.from_points(config['coordinates']) if 'coordinates' in config else None
+        self.projection = projection.get_projection([config]) if local_projection is None else local_projection
         self.polygons = []
 
-        # Create location name based on config values but ignore the ones in filter list
-        name_attributes_filter = ['region', 'color', 'coordinates']
-        self.name = '_'.join(str(config[a]) for a in config if a not in name_attributes_filter)
-        self.get_polygons()
+        self.name = self._get_name()
+        if build_polygons:
+            self.get_polygons()
+
+    def _get_name(self) -> str:
+        """
+        Creates location name based on config values but ignores the ones in filter list.
+        """
+        name_attributes_filter = [
+            'region', 'color', 'coordinates', 'max_workers', 'requests_per_minute', 'contours_minutes_prefetch',
+            'path_graph'
+        ]
+        return '_'.join(str(self.config[a]) for a in self.config if a not in name_attributes_filter)
 
-    def get_polygons(self, path_cache: str = 'data/cache'):
+    def get_polygons(self, path_cache: str = cache.PATH_CACHE):
         """
         This function generates polygons based on the type specified in the config.
-        It first ensures the cache directory exists, then calls the appropriate method
+        It first opens the cache, then calls the appropriate method
         to generate the polygons. If the type is not recognized, it defaults to generating
         standard polygons.
 
         Parameters:
         path_cache (str): The path to the cache directory. Defaults to 'data/cache'.
         """
-        pathlib.Path(path_cache).mkdir(parents=True, exist_ok=True)
+        location_cache = cache.get_cache(path_cache)
 
         polygon_methods = {
             'isochrone': self._get_isochrone_polygons,
@@ -167,184 +458,183 @@ class Location:
         }
 
         method = polygon_methods.get(self.config['type'], self._get_standard_polygons)
-        if self.config['type'] in ['isochrone', 'elevation']:
-            method(path_cache)
-        else:
-            method()
-
-    def _get_isochrone_polygons(self, path_cache: str):
+        with metrics.span(self.name, 'location', type=self.config['type'], category=self.config['category']):
+            if self.config['type'] in ['isochrone', 'elevation']:
+                method(location_cache)
+            else:
+                method()
+
+    def _get_isochrone_polygons(self, location_cache: cache.Cache):
+        contours_minutes_used = self.config['contours_minutes']
+        # Maps prefetch the isochrones of all their locations, then nothing is missing here
+        # and the contours are only read from the cache
+        fetched = fetch_isochrones([self.config], location_cache)
+
+        coords_used = []
         for coord in self.config['coordinates']:
-            file_name = f"{self.name}_{coord['lat']}_{coord['lon']}.pkl"
-            path_coord = pathlib.Path(path_cache, file_name)
-
-            polygon = Polygon(center=[coord])
-            polygon.get_isochrone_coordinates(
-                path_coord,
-                self.config['profile'],
-                coord['lat'], coord['lon'],
-                self.config['contours_minutes'],
-            )
-            polygon.get_shapely_polygons_from_coords()
-
-            self.polygons.append(polygon)
+            key = get_isochrone_key(self.config, coord, contours_minutes_used, location_cache)
+            coords = fetched.get(key)
+            if coords is None:
+                coords = Coordinates.from_arrays(location_cache.load(key))
+            coords_used.append(coords)
+
+        with metrics.span('isochrone', 'polygon', coordinates=len(coords_used)):
+            for i_coord, coords in enumerate(coords_used):
+                polygon = Polygon(
+                    center=Coordinates(self.coordinates.xy[i_coord]),
+                    coords=coords,
+                    aux_config={'contours_minutes': contours_minutes_used}
+                )
+                polygon.get_shapely_polygons_from_coords(self.projection)
+
+                self.polygons.append(polygon)
 
     def _get_line_polygons(self):
-        polygon = Polygon(center=self.config['coordinates'])
-        polygon.get_shapely_polygons_from_line(self.config['buffer_distance'])
+        # Older configs give the buffer in degrees
+        buffer_meters = self.config.get('buffer_meters')
+        if buffer_meters is None:
+            buffer_meters = self.config['buffer_distance'] * projection.METERS_PER_DEGREE
+
+        polygon = Polygon(center=self.coordinates)
+        polygon.get_shapely_polygons_from_line(buffer_meters, self.projection)
         self.polygons.append(polygon)
 
     def _get_circle_polygons(self):
-        polygon = Polygon(center=self.config['coordinates'])
-        polygon.get_shapely_polygons_from_circle(self.config['radius'])
-        self.polygons.append(polygon)
+        # Older configs give the width of an ellipse in degrees of longitude, squeezed to 0.75 in latitude
+        radius_meters = self.config.get('radius_meters')
+        if radius_meters is None:
+            radius_meters = self.config['radius'] * 0.375 * projection.METERS_PER_DEGREE
 
-    def _get_elevation_polygons(self, path_cache: str):
-        path_elevation = '_'.join([self.name, self.config['category'] + '.pkl'])
-        path_elevation = pathlib.Path(path_cache, path_elevation)
+        polygon = Polygon(center=self.coordinates)
+        polygon.get_shapely_polygons_from_circle(radius_meters, self.projection)
+        self.polygons.append(polygon)
 
+    def _get_elevation_polygons(self, location_cache: cache.Cache):
         polygon = Polygon()
         polygon.get_shapely_polygons_from_elevations(
-            path_elevation,
-            self.config['region']
+            location_cache,
+            self.config['region'],
+            self.projection
         )
         self.polygons.append(polygon)
 
     def _get_standard_polygons(self):
-        polygon = Polygon(center=self.config['coordinates'])
-        polygon.get_shapely_polygons_standard()
+        polygon = Polygon(center=self.coordinates)
+        polygon.get_shapely_polygons_standard(self.projection)
         self.polygons.append(polygon)
 
 class Polygon():
+    __slots__ = ('center', 'coords', 'shapely_polygons', 'aux_config')
+
     def __init__(
             self,
-            center: list = [{'lat': [], 'lon': []}],
-            coords: list = [{'lat': [], 'lon': []}],
-            shapely_polygons: list = [],
-            aux_config : dict = {}
+            center: Coordinates = None,
+            coords: Coordinates = None,
+            shapely_polygons: list = None,
+            aux_config : dict = None
         ):
         """
         Initializes the Polygon class with center coordinates, polygon coordinates,
         shapely polygons, and auxiliary configuration.
-        """        
-        self.center = center
-        self.coords = coords
-        self.shapely_polygons = shapely_polygons
-        self.aux_config = aux_config
-
-    def _load_or_fetch(self, path, fetch_func, *args):
+        Coordinates are in lon/lat, shapely polygons in metres of the projection they were built with.
+        Elevation polygons keep their sampled grid in coords as a dict of 'lon', 'lat' and 'elevation' arrays.
         """
-        Helper function to load data from a file if it exists, or fetch it using
-        a provided function and then save it to the file.
-        """
-        if path.exists():
-            with open(path, 'rb') as file:
-                return pickle.load(file)
-        else:
-            data = fetch_func(*args)
-            with open(path, 'wb') as file:
-                pickle.dump(data, file)
-            return data
-
-    def get_isochrone_coordinates(self, 
-            path_c: pathlib.Path,
-            profile: str,
-            lat: float,
-            lon: float,
-            contours_minutes: int
-        ):
-        """
-        Gets isochrone coordinates either by loading from a file or fetching from Mapbox.
-        """
-        self.coords = self._load_or_fetch(
-            path_c,
-            mapbox.get_isochrone_coordinates,
-            profile,
-            lat,
-            lon,
-            contours_minutes,
-        )
+        self.center = Coordinates() if center is None else center
+        self.coords = Coordinates() if coords is None else coords
+        self.shapely_polygons = [] if shapely_polygons is None else shapely_polygons
+        self.aux_config = {} if aux_config is None else aux_config
 
-    def _get_shapely_polygons(self, convert_func, buffer_distance_or_radius=None):
+    def _get_shapely_polygons(self, convert_func, local_projection, buffer_distance_or_radius=None):
         """
-        Helper function to get shapely polygons from center coordinates.
+        Helper function to get shapely polygons from center coordinates projected to metres.
         """
-        coords = {
-            'lat' : [coord['lat'] for coord in self.center],
-            'lon' : [coord['lon'] for coord in self.center],
-        }
+        center = local_projection.project(self.center)
         if buffer_distance_or_radius is None:
-            self.shapely_polygons = [convert_func(coords)]
+            self.shapely_polygons = [convert_func(center)]
         else:
-            self.shapely_polygons = [convert_func(coords, buffer_distance_or_radius)] 
+            self.shapely_polygons = [convert_func(center, buffer_distance_or_radius)]
 
-    def get_shapely_polygons_from_line(self, buffer_distance):
+    def get_shapely_polygons_from_line(self, buffer_meters, local_projection):
         """
         Gets shapely polygons from line.
         """  
-        self._get_shapely_polygons(convert_coords_to_shapely_line, buffer_distance)
+        self._get_shapely_polygons(convert_coords_to_shapely_line, local_projection, buffer_meters)
 
-    def get_shapely_polygons_from_circle(self, buffer_radius):
+    def get_shapely_polygons_from_circle(self, radius_meters, local_projection):
         """
         Gets shapely polygons from circle.
         """  
-        self._get_shapely_polygons(convert_coords_to_shapely_ellipse, buffer_radius)
+        self._get_shapely_polygons(convert_coords_to_shapely_circle, local_projection, radius_meters)
 
-    def get_shapely_polygons_standard(self):
+    def get_shapely_polygons_standard(self, local_projection):
         """
         Gets standard shapely polygons.
         """  
-        self._get_shapely_polygons(convert_coords_to_shapely_polygon)
+        self._get_shapely_polygons(convert_coords_to_shapely_polygon, local_projection)
 
-    def get_shapely_polygons_from_coords(self):
+    def get_shapely_polygons_from_coords(self, local_projection):
         """
         Gets shapely polygons from coordinates.
         """        
-        self.shapely_polygons = [
-            convert_coords_to_shapely_polygon(coord) for coord in self.coords
-        ]
+        self.shapely_polygons = list(local_projection.project(self.coords).to_shapely_polygons())
 
     def get_shapely_polygons_from_elevations(self,
-            path_a: pathlib.Path,
-            config: dict
+            location_cache: cache.Cache,
+            config: dict,
+            local_projection: projection.LocalProjection
         ):
         """
-        Gets elevations either by loading from a file or fetching from OpenTopData.
+        Gets elevations either by sampling local DEM tiles, or by loading from the cache or fetching from OpenTopData.
+        The source is selected by the 'source' key of the region config, 'opentopdata' by default.
         """
-        self.coords = self._load_or_fetch(
-            path_a,
-            opentopdata.get_elevations,
-            config,
-        )
-
-        df = pd.DataFrame(self.coords)
-        mask = (df['elevation'] >= config['elevation_range']['min']) & (df['elevation'] <= config['elevation_range']['max'])
+        source = config.get('source', 'opentopdata')
+        if source == 'dem':
+            # Sampling local tiles is faster than reading the cache, nothing to store
+            self.coords = dem.get_elevations(config)
+        elif source == 'opentopdata':
+            params = get_elevation_cache_params(config)
+            path_checkpoint = location_cache.get_path(location_cache.key(params), suffix='.parts')
+            self.coords = location_cache.load_or_fetch(
+                params,
+                functools.partial(opentopdata.get_elevations, path_checkpoint=path_checkpoint),
+                config,
+                encode=cache.encode_grid,
+            )
+        else:
+            raise ValueError(f"Unknown elevation source {source}, expected 'opentopdata' or 'dem'")
 
-        voronoi = Voronoi(df[['lat', 'lon']].to_numpy())
-        regions = voronoi.point_region[df[mask].index.values]
-        regions = [voronoi.regions[r] for r in regions]
-        regions = [list(filter(lambda x: x != -1, r)) for r in regions]
-        regions = [r for r in regions if len(r)>2]
+        elevation_methods = {
+            'voronoi': convert_elevations_to_shapely_polygon_voronoi,
+            'contour': convert_elevations_to_shapely_polygon_contour,
+        }
+        mode = config.get('mode', 'voronoi')
+        if mode not in elevation_methods:
+            raise ValueError(f"Unknown elevation mode {mode}, expected 'voronoi' or 'contour'")
 
-        self.shapely_polygons = [unary_union([convert_coords_to_shapely_polygon(
-            {
-                'lat': voronoi.vertices[r][:,0],
-                'lon': voronoi.vertices[r][:,1]})
-                for r in regions]
-        )]      
+        with metrics.span(mode, 'polygon', points=len(self.coords['elevation'])):
+            self.shapely_polygons = [elevation_methods[mode](self.coords, config, local_projection)]
 
 class Map:
-    def __init__(self, path_config: str):
+    def __init__(self, path_config: str, locations_built: dict = None, max_workers: int = None):
         """
         Initializes a Map object.
+        Buffers, unions and logic are evaluated in metres of a local projection centred at the map center,
+        geometries are converted back to lon/lat only for rendering.
 
         Args:
             path_config (str): Path to the configuration file.
+            locations_built (dict): Already built locations by get_location_key, reused instead of building them again.
+            max_workers (int): Number of threads that union categories, defaults to the number of CPUs. 1 unions them one by one.
         """
         self.configuration = load_json(path_config)
-        self.locations = self.prepare_locations()
+        self.max_workers = max_workers
+        self.projection = None
+        self.locations = self.prepare_locations(locations_built=locations_built)
         self.locations_stacked = self.stack_locations()
+        self._spatial_index = None
+        self._lod = {}
 
-    def prepare_locations(self, path_database: str = 'data/database') -> dict:
+    def prepare_locations(self, path_database: str = database.PATH_DATABASE, locations_built: dict = None) -> dict:
         """
         Prepares locations by updating their coordinates from the database.
         It iterates over each location in the configuration, updates its coordinates
@@ -352,27 +642,60 @@ class Map:
 
         Args:
             path_database (str): Path to the database (default is 'data/database').
+            locations_built (dict): Already built locations by get_location_key, reused instead of building them again.
 
         Returns:
             dict: A dictionary of prepared locations.
         """
-        locations = {}
+        locations_built = {} if locations_built is None else locations_built
+
         for config in self.configuration['locations']:
             self.update_config_with_database_coordinates(config, path_database)
-            location = Location(config)
-            locations[location.name] = location
-            print(f'Location prepared: {location.name}')
+        self.projection = projection.get_projection(self.configuration['locations'], self.configuration.get('center'))
+
+        configs_build = [
+            config for config in self.configuration['locations']
+            if get_location_key(config, self.projection) not in locations_built
+        ]
+
+        locations = {}
+        with metrics.span('prepare_locations', 'map', locations=len(self.configuration['locations'])):
+            # Mapbox isochrones of all locations are fetched in one batch, so their requests overlap
+            # and locations only read them from the cache
+            fetch_isochrones(
+                [
+                    config for config in configs_build
+                    if config['type'] == 'isochrone' and config.get('source', 'mapbox') == 'mapbox'
+                ],
+                cache.get_cache()
+            )
+
+            for config in self.configuration['locations']:
+                location = locations_built.get(get_location_key(config, self.projection))
+                if location is None:
+                    location = self._build_location(config)
+                locations[location.name] = location
+                print(f'Location prepared: {location.name}')
+
+        cache_stats = cache.get_cache().stats()
+        print(f"Cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['size_mb']:.1f} MB")
+
         return locations
 
+    def _build_location(self, config: dict) -> 'Location':
+        return Location(
+            config, self.projection, build_polygons=not is_category_isochrone(self.configuration, config)
+        )
+
+    @staticmethod
     def update_config_with_database_coordinates(
-        self,
         config: dict,
         path_database: str
     ) -> None:
         """
         Updates the configuration dictionary with coordinates from a database.
-        It loads the database from a JSON file and updates the configuration
-        with the coordinates of the location if it exists in the database.
+        It looks the location up in the category of the database, which is loaded once per process,
+        and updates the configuration with the coordinates of the location if it exists in the database.
 
         Args:
             config (dict): Configuration dictionary.
@@ -381,11 +704,9 @@ class Map:
         Returns:
             None
         """
-        path_l = pathlib.PurePath(path_database, config['category'] + '.json')        
-        c_json = load_json(path_l)
-        
-        if config['name'] in c_json:
-            c_coordinates = c_json[config['name']]
+        c_coordinates = database.get_database(path_database).get(config['category'], config['name'])
+
+        if c_coordinates is not None:
             config.update(c_coordinates)
 
     def stack_locations(self) -> dict:
@@ -393,43 +714,403 @@ class Map:
         Stacks locations based on the logic defined in the configuration.
         It first gets all polygons for each location and stacks them per category.
         Then it combines all polygons according to the logic defined in the configuration.
+        The union of a category is only built when the logic or a caller of get_geometries needs it.
 
         Returns:
             dict: A dictionary of stacked locations.
         """
-        locations_stacked = defaultdict(lambda: {'shapely_polygons': []})
+        with metrics.span('stack_locations', 'map'):
+            locations_stacked = self._stack_categories(list(self.get_dependency_graph()['categories']))
+            locations_stacked['final_shapely_polygon'] = self._combine_categories(locations_stacked)
+
+        print('Stacking finished. The map is ready.')
+
+        return locations_stacked
 
-        # Get all polygons
-        for location in self.locations.values():
+    def _stack_categories(self, categories: list) -> dict:
+        """
+        Stacks the categories and returns them in the given order.
+        """
+        return {category: self._stack_category(category) for category in categories}
+
+    def _stack_category(self, category: str) -> dict:
+        """
+        Gets all polygons of the locations in the category. Their union is added under 'final_shapely_polygon'
+        on first use, see _union_category.
+        """
+        locations = [location for location in self.locations.values() if location.config['category'] == category]
+        shapely_polygons = [
+            shapely_polygon for location in locations
+            for polygon in location.polygons
+            for shapely_polygon in polygon.shapely_polygons
+        ]
+        shapely_polygons.extend(self._get_category_isochrone_polygons(
+            [location for location in locations if is_category_isochrone(self.configuration, location.config)]
+        ))
+
+        return {'shapely_polygons': shapely_polygons}
+
+    def _union_category(self, category: str, stacked: dict) -> shapely.Geometry:
+        """
+        Returns the union of the polygons of a stacked category, built on first use and kept in the stacked category.
+        """
+        if 'final_shapely_polygon' not in stacked:
+            with metrics.span(category, 'union', polygons=len(stacked['shapely_polygons'])):
+                stacked['final_shapely_polygon'] = unary_union_cached(stacked['shapely_polygons'])
+        return stacked['final_shapely_polygon']
+
+    def _union_categories(self, categories: list, locations_stacked: dict = None):
+        """
+        Builds the unions of the categories that do not have one yet, concurrently.
+        Shapely releases the GIL while GEOS computes, so threads use several cores at once.
+
+        Args:
+            categories (list): Categories to union.
+            locations_stacked (dict): Stacked categories the unions are kept in, defaults to self.locations_stacked.
+        """
+        locations_stacked = self.locations_stacked if locations_stacked is None else locations_stacked
+        categories = [
+            category for category in categories if 'final_shapely_polygon' not in locations_stacked[category]
+        ]
+        if self.max_workers == 1 or len(categories) < 2:
+            for category in categories:
+                self._union_category(category, locations_stacked[category])
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda category: self._union_category(category, locations_stacked[category]), categories))
+
+    def get_category_polygon(self, category: str) -> shapely.Geometry:
+        """
+        Returns the union of all polygons of the category in metres of self.projection, built on first use.
+        """
+        return self._union_category(category, self.locations_stacked[category])
+
+    def _get_category_isochrone_polygons(self, locations: list, path_cache: str = cache.PATH_CACHE) -> list:
+        """
+        Computes the area reachable from any of the locations with one multi-source search per road graph,
+        profile and contour, instead of an isochrone per coordinate that would have to be unioned afterwards.
+        Each contour is cached under the set of all centres, like isochrones of a single coordinate.
+
+        Args:
+            locations (list): Isochrone locations of one category, see is_category_isochrone.
+            path_cache (str): The path to the cache directory. Defaults to 'data/cache'.
+
+        Returns:
+            list: Shapely polygons in metres of the map projection.
+        """
+        from src import graph
+
+        location_cache = cache.get_cache(path_cache)
+
+        # Locations share a search if they travel the same graph with the same settings
+        groups = {}
+        for location in locations:
+            config = location.config
+            source_params = graph.get_cache_params(config)
+            key = (config['profile'], config['contours_minutes'], json.dumps(source_params, sort_keys=True))
+            groups.setdefault(key, (config, source_params, []))[2].append(location)
+
+        shapely_polygons = []
+        for (profile, contours_minutes_used, _), (config, source_params, group) in groups.items():
+            contours_minutes = sorted({contours_minutes_used} | {
+                minutes for location in group for minutes in location.config.get('contours_minutes_prefetch', [])
+            })
+            # Sorted and deduplicated, so the key does not depend on the order of locations
+            points = sorted({(c['lon'], c['lat']) for location in group for c in location.config['coordinates']})
+
+            def get_key(minutes):
+                return location_cache.key({
+                    'type': 'isochrone_union',
+                    'source': 'graph',
+                    'profile': profile,
+                    'coordinates': points,
+                    'contours_minutes': minutes,
+                    **source_params,
+                })
+
+            arrays = location_cache.load(get_key(contours_minutes_used))
+            coords = None if arrays is None else Coordinates.from_arrays(arrays)
+            missing = [
+                m for m in contours_minutes
+                if (m == contours_minutes_used and arrays is None)
+                or (m != contours_minutes_used and not location_cache.contains(get_key(m), count=True))
+            ]
+            if missing:
+                lon, lat = zip(*points)
+                isochrones = graph.get_isochrone_union_coordinates(profile, lon, lat, missing, config)
+                for minutes, coords_contour in isochrones.items():
+                    location_cache.save(get_key(minutes), coords_contour.to_arrays())
+                coords = isochrones.get(contours_minutes_used, coords)
+
+            polygon = Polygon(coords=coords)
+            polygon.get_shapely_polygons_from_coords(self.projection)
+            shapely_polygons.extend(polygon.shapely_polygons)
+
+        return shapely_polygons
+
+    def _combine_categories(self, locations_stacked: dict) -> shapely.Geometry:
+        """
+        Combines category polygons according to the logic defined in the configuration, see logic.evaluate.
+        The logic is an expression of nested and/or/not over categories, or the older block of
+        intersection, union and difference steps, which is converted to an expression.
+
+        Categories the evaluation takes whole are unioned up front, concurrently, see logic.get_categories_whole.
+        Any other category is unioned only when the evaluation reaches it. A category evaluated within
+        the bounding box of the result so far is unioned from its polygons clipped to that box,
+        unless its full union has already been built or the box covers most of the category,
+        in which case the full union is built once and kept for rendering.
+        """
+        categories = [category for category in locations_stacked if category != 'final_shapely_polygon']
+        expression = logic.parse(self.configuration['logic'], categories)
+        # The summed area of the polygons bounds the area of their union, without building it
+        areas = {
+            category: float(shapely.area(locations_stacked[category]['shapely_polygons']).sum())
+            for category in categories
+        }
+
+        def get_geometry(category, bounds):
+            stacked = locations_stacked.get(category)
+            if stacked is None:
+                return None
+            if bounds is not None and 'final_shapely_polygon' not in stacked and stacked['shapely_polygons']:
+                box_category = shapely.box(*shapely.total_bounds(stacked['shapely_polygons']))
+                if shapely.intersection(box_category, shapely.box(*bounds)).area < 0.5 * box_category.area:
+                    return logic.clip_union(stacked['shapely_polygons'], bounds)
+            geometry = self._union_category(category, stacked)
+            return geometry if bounds is None else logic.prune(geometry, bounds)
+
+        categories_whole = [
+            category for category in logic.get_categories_whole(expression, areas) if category in locations_stacked
+        ]
+        self._union_categories(categories_whole, locations_stacked)
+
+        with metrics.span('combine', 'logic', categories=len(categories)):
+            return logic.evaluate(expression, get_geometry, areas)
+
+    def get_dependency_graph(self) -> dict:
+        """
+        Returns which stages depend on each other: every location feeds the union of its category,
+        and every category feeds the logic steps it is listed in.
+
+        Returns:
+            dict: A dictionary with keys
+                'locations': location name to its category,
+                'categories': category to the names of its locations, in configuration order,
+                'logic': category to the logic steps that use it, 'expression' if the logic is an expression.
+        """
+        graph = {'locations': {}, 'categories': {}, 'logic': {}}
+        for name, location in self.locations.items():
             category = location.config['category']
-            locations_stacked[category]['shapely_polygons'].extend(
-                shapely_polygon for polygon in location.polygons
-                for shapely_polygon in polygon.shapely_polygons
-            )
+            graph['locations'][name] = category
+            graph['categories'].setdefault(category, []).append(name)
 
-        # Stack per category
-        for category, polygons in locations_stacked.items():
-            polygons['final_shapely_polygon'] = unary_union(polygons['shapely_polygons'])
-
-        # Combine all 
-        final_shapely_polygon = None
-        for logic, logic_categories in self.configuration['logic'].items():
-            for category, category_shapely_polygons in locations_stacked.items():
-                if category not in logic_categories or category_shapely_polygons['final_shapely_polygon'] is None:
-                    continue
-
-                shapely_polygon = category_shapely_polygons['final_shapely_polygon']
-                if final_shapely_polygon is None:
-                    final_shapely_polygon = shapely_polygon
-                elif logic == 'union':
-                    final_shapely_polygon = unary_union([final_shapely_polygon, shapely_polygon])
-                elif logic == 'intersection':
-                    final_shapely_polygon = final_shapely_polygon.intersection(shapely_polygon)
-                elif logic == 'difference':
-                    final_shapely_polygon = final_shapely_polygon.difference(shapely_polygon)
-                
-        locations_stacked['final_shapely_polygon'] = final_shapely_polygon
+        steps = logic.get_steps(self.configuration['logic'])
+        for category in graph['categories']:
+            graph['logic'][category] = [step for step, step_categories in steps.items() if category in step_categories]
 
-        print('Stacking finished. The map is ready.')
+        return graph
 
-        return locations_stacked
+    def add_location(self, config: dict, path_database: str = database.PATH_DATABASE) -> dict:
+        """
+        Adds a location and re-derives only its category and the final polygon.
+
+        Args:
+            config (dict): Location configuration, same as an entry of 'locations' in the configuration file.
+            path_database (str): Path to the database (default is 'data/database').
+
+        Returns:
+            dict: Stages that were recomputed, see update_stages.
+        """
+        time_start = time.perf_counter()
+
+        self.update_config_with_database_coordinates(config, path_database)
+        location = self._build_location(config)
+        self.locations[location.name] = location
+        self.configuration['locations'].append(config)
+
+        return self.update_stages([location.name], [config['category']], time_start)
+
+    def remove_location(self, name: str) -> dict:
+        """
+        Removes a location and re-derives only its category and the final polygon.
+
+        Args:
+            name (str): Name of the location, as the key in self.locations.
+
+        Returns:
+            dict: Stages that were recomputed, see update_stages.
+        """
+        time_start = time.perf_counter()
+
+        location = self.locations.pop(name)
+        # Reused locations carry the config of the map that built them, so entries are matched by content
+        key = get_location_key(location.config, self.projection)
+        self.configuration['locations'] = [
+            c for c in self.configuration['locations'] if get_location_key(c, self.projection) != key
+        ]
+
+        return self.update_stages([], [location.config['category']], time_start)
+
+    def update_location(self, name: str, path_database: str = database.PATH_DATABASE, **changes) -> dict:
+        """
+        Updates configuration values of a location, e.g. buffer_meters or contours_minutes,
+        and re-derives only that location, the affected categories and the final polygon.
+
+        Args:
+            name (str): Name of the location, as the key in self.locations.
+            path_database (str): Path to the database (default is 'data/database').
+            **changes: Configuration values to replace.
+
+        Returns:
+            dict: Stages that were recomputed, see update_stages.
+        """
+        time_start = time.perf_counter()
+
+        location = self.locations.pop(name)
+        config = {**location.config, **changes}
+        if 'name' in changes or 'category' in changes:
+            self.update_config_with_database_coordinates(config, path_database)
+
+        location_updated = self._build_location(config)
+        self.locations[location_updated.name] = location_updated
+        key = get_location_key(location.config, self.projection)
+        self.configuration['locations'] = [
+            config if get_location_key(c, self.projection) == key else c for c in self.configuration['locations']
+        ]
+
+        categories = list(dict.fromkeys([location.config['category'], config['category']]))
+        return self.update_stages([location_updated.name], categories, time_start)
+
+    def update_stages(self, locations: list, categories: list, time_start: float = None) -> dict:
+        """
+        Re-derives the given categories and, if any of them is used by the logic, the final polygon.
+
+        Args:
+            locations (list): Names of locations that were rebuilt, only reported.
+            categories (list): Categories whose locations changed.
+            time_start (float): perf_counter value at the start of the edit, used to report its duration.
+
+        Returns:
+            dict: A dictionary with keys 'locations', 'categories' and 'logic' listing recomputed stages,
+                'final' telling whether the final polygon was recomputed and 'time' in seconds.
+        """
+        time_start = time.perf_counter() if time_start is None else time_start
+        graph = self.get_dependency_graph()
+
+        # Keep categories in configuration order, as a full rebuild would
+        stacked = self._stack_categories([
+            category for category in graph['categories']
+            if category in categories or category not in self.locations_stacked
+        ])
+        locations_stacked = {
+            category: stacked[category] if category in stacked else self.locations_stacked[category]
+            for category in graph['categories']
+        }
+
+        # A category whose last location was removed still changes the logic it was used in
+        steps = [
+            step for step, step_categories in logic.get_steps(self.configuration['logic']).items()
+            if any(category in step_categories for category in categories)
+        ]
+        if steps:
+            locations_stacked['final_shapely_polygon'] = self._combine_categories(locations_stacked)
+        else:
+            locations_stacked['final_shapely_polygon'] = self.locations_stacked['final_shapely_polygon']
+
+        self.locations_stacked = locations_stacked
+        self._spatial_index = None
+        self._lod = {}
+
+        return {
+            'locations': locations,
+            'categories': categories,
+            'logic': steps,
+            'final': bool(steps),
+            'time': time.perf_counter() - time_start,
+        }
+
+    def get_spatial_index(self) -> dict:
+        """
+        Returns prepared geometries of the final polygon and of every category, built on first use.
+        Preparing builds an internal spatial index, so point queries do not scan all edges.
+
+        Returns:
+            dict: Prepared Shapely geometries by category, 'final' for the final polygon.
+        """
+        if self._spatial_index is None:
+            geometries = self.get_geometries()
+
+            for geometry in geometries.values():
+                if geometry is not None:
+                    shapely.prepare(geometry)
+
+            self._spatial_index = geometries
+
+        return self._spatial_index
+
+    def get_geometries(self) -> dict:
+        """
+        Returns the final polygon of every category and 'final' for the final polygon, in metres of self.projection.
+        Category unions that the logic did not need are built here.
+        """
+        categories = [category for category in self.locations_stacked if category != 'final_shapely_polygon']
+        self._union_categories(categories)
+        geometries = {category: self.locations_stacked[category]['final_shapely_polygon'] for category in categories}
+        geometries['final'] = self.locations_stacked['final_shapely_polygon']
+
+        return geometries
+
+    def prepare_lod(self, tiers: tuple = lod.ZOOM_TIERS):
+        """
+        Precomputes simplified geometries for every zoom tier, e.g. before serving interactive views.
+
+        Args:
+            tiers (tuple): Zoom levels to simplify for.
+        """
+        for tier in tiers:
+            self.get_lod(tier, tiers)
+
+    def get_lod(self, zoom: float, tiers: tuple = lod.ZOOM_TIERS) -> dict:
+        """
+        Returns geometries simplified for rendering at the zoom, computed once per tier.
+        The zoom is rounded up to the next tier so details visible at the zoom are kept,
+        above the highest tier the full-precision geometries are returned.
+        Queries always use the full-precision geometries.
+
+        Args:
+            zoom (float): Zoom level of the rendered map.
+            tiers (tuple): Zoom levels to simplify for.
+
+        Returns:
+            dict: Shapely geometries in metres by category, 'final' for the final polygon.
+        """
+        tier = lod.get_tier(zoom, tiers)
+        if tier is None:
+            return self.get_geometries()
+
+        if tier not in self._lod:
+            tolerance = lod.get_tolerance(tier, self.projection.lat_origin)
+            self._lod[tier] = lod.simplify(self.get_geometries(), tolerance)
+
+        return self._lod[tier]
+
+    def query_points(self, lat, lon) -> dict:
+        """
+        Checks which criteria each of the points satisfies, evaluated for all points at once.
+        Points on a polygon boundary count as inside.
+
+        Args:
+            lat (array-like): Latitudes of the points.
+            lon (array-like): Longitudes of the points.
+
+        Returns:
+            dict: Boolean arrays by category, 'final' tells whether a point lies in the final polygon.
+                Can be passed directly to pandas.DataFrame.
+        """
+        x, y = self.projection.forward(lon, lat)
+
+        return {
+            name: np.zeros(x.shape, dtype=bool) if geometry is None else shapely.intersects_xy(geometry, x, y)
+            for name, geometry in self.get_spatial_index().items()
+        }
@@ -0,0 +1,106 @@
+import json
+import pathlib
+import threading
+
+PATH_DATABASE = 'data/database'
+
+class Database:
+    """
+    A class to look up locations from category files of the database.
+
+    Each category file is parsed at most once per process and indexed by location name.
+    Files are checked by modification time, so edits are picked up without restarting.
+    Categories can be stored as <category>.json, a single object of name to location,
+    or as <category>.jsonl with one {"name": ..., "coordinates": [...]} object per line.
+    JSON Lines files are streamed to index byte offsets only, and locations are parsed when requested,
+    which keeps large imports (e.g. tens of thousands of POIs from OpenStreetMap) out of memory.
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        directory with category files
+    """
+
+    def __init__(self, path: str = PATH_DATABASE):
+        self.path = pathlib.Path(path)
+        self._categories = {}
+        self._lock = threading.Lock()
+
+    def get(self, category: str, name: str) -> dict:
+        """
+        Returns the location stored under the name in the category, None if there is none.
+        """
+        index = self._get_index(category)
+        if index is None or name not in index['names']:
+            return None
+
+        if index['format'] == 'json':
+            return dict(index['names'][name])
+
+        with open(index['path'], 'rb') as file:
+            file.seek(index['names'][name])
+            location = json.loads(file.readline())
+        location.pop('name', None)
+
+        return location
+
+    def names(self, category: str) -> list:
+        """
+        Returns names of all locations in the category.
+        """
+        index = self._get_index(category)
+        return [] if index is None else list(index['names'])
+
+    def _get_index(self, category: str) -> dict:
+        """
+        Returns the index of the category, (re)building it if the file is new or was modified.
+        """
+        for suffix in ['.json', '.jsonl']:
+            path_category = self.path / (category + suffix)
+            try:
+                mtime = path_category.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            with self._lock:
+                index = self._categories.get(category)
+                if index is None or index['path'] != path_category or index['mtime'] != mtime:
+                    index = self._build_index(path_category, mtime)
+                    self._categories[category] = index
+            return index
+
+        return None
+
+    @staticmethod
+    def _build_index(path_category: pathlib.Path, mtime: int) -> dict:
+        if path_category.suffix == '.json':
+            try:
+                with open(path_category, 'r') as file:
+                    names = json.load(file)
+            except json.JSONDecodeError:
+                raise ValueError(f"File {path_category} is not a valid JSON file")
+            return {'path': path_category, 'mtime': mtime, 'format': 'json', 'names': names}
+
+        names = {}
+        with open(path_category, 'rb') as file:
+            offset = file.tell()
+            for line in iter(file.readline, b''):
+                if line.strip():
+                    try:
+                        names[json.loads(line)['name']] = offset
+                    except (json.JSONDecodeError, KeyError):
+                        raise ValueError(f"Line at byte {offset} of {path_category} is not a location with a name")
+                offset = file.tell()
+
+        return {'path': path_category, 'mtime': mtime, 'format': 'jsonl', 'names': names}
+
+_databases = {}
+
+def get_database(path: str = PATH_DATABASE) -> Database:
+    """
+    Returns the database shared within the process for the given directory.
+    """
+    path = str(pathlib.Path(path).resolve())
+    if path not in _databases:
+        _databases[path] = Database(path)
+    return _databases[path]
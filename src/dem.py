@@ -0,0 +1,225 @@
+import pathlib
+import re
+import struct
+
+import numpy as np
+
+from src import grid
+
+# Sizes in bytes of the TIFF field types that can hold the tags used below
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+TIFF_TYPE_FORMATS = {1: 'B', 2: 's', 3: 'H', 4: 'I', 6: 'b', 7: 'B', 8: 'h', 9: 'i', 11: 'f', 12: 'd'}
+TIFF_SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+
+class Raster:
+    """
+    A class to represent a single band elevation raster in geographic coordinates.
+
+    Attributes
+    ----------
+    data : np.ndarray
+        2D array of elevations, usually memory-mapped so only sampled pages are read
+    lon_origin : float
+        longitude of the centre of the top left pixel
+    lat_origin : float
+        latitude of the centre of the top left pixel
+    lon_step : float
+        pixel width in degrees
+    lat_step : float
+        pixel height in degrees, positive while rows go from north to south
+    nodata : float
+        value marking missing elevation, None if the raster has none
+    """
+
+    def __init__(self, data: np.ndarray, lon_origin: float, lat_origin: float,
+                 lon_step: float, lat_step: float, nodata: float = None):
+        self.data = data
+        self.lon_origin = lon_origin
+        self.lat_origin = lat_origin
+        self.lon_step = lon_step
+        self.lat_step = lat_step
+        self.nodata = nodata
+
+    def contains(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """
+        Returns mask of points that lie between the centres of the outer pixels.
+        """
+        n_rows, n_cols = self.data.shape
+        lon_max = self.lon_origin + (n_cols - 1) * self.lon_step
+        lat_min = self.lat_origin - (n_rows - 1) * self.lat_step
+        return (lon >= self.lon_origin) & (lon <= lon_max) & (lat <= self.lat_origin) & (lat >= lat_min)
+
+    def sample(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """
+        Bilinearly interpolates elevations at all given points at once.
+        Points next to a nodata pixel get NaN.
+        """
+        n_rows, n_cols = self.data.shape
+        col = (np.asarray(lon, dtype=float) - self.lon_origin) / self.lon_step
+        row = (self.lat_origin - np.asarray(lat, dtype=float)) / self.lat_step
+
+        col_0 = np.clip(np.floor(col).astype(np.intp), 0, n_cols - 2)
+        row_0 = np.clip(np.floor(row).astype(np.intp), 0, n_rows - 2)
+        col_frac = col - col_0
+        row_frac = row - row_0
+
+        corners = [
+            self.data[row_0, col_0], self.data[row_0, col_0 + 1],
+            self.data[row_0 + 1, col_0], self.data[row_0 + 1, col_0 + 1]
+        ]
+        corners = [np.asarray(c, dtype=float) for c in corners]
+        if self.nodata is not None:
+            for c in corners:
+                c[c == self.nodata] = np.nan
+
+        top = corners[0] * (1 - col_frac) + corners[1] * col_frac
+        bottom = corners[2] * (1 - col_frac) + corners[3] * col_frac
+
+        return top * (1 - row_frac) + bottom * row_frac
+
+def load_hgt(path: pathlib.Path) -> Raster:
+    """
+    Memory-maps a raw SRTM/ASTER .hgt tile, e.g. N45E018.hgt.
+    The tile is a square of big-endian int16 values whose name gives its south west corner.
+    """
+    match = re.match(r'([NS])(\d{2})([EW])(\d{3})', path.name.upper())
+    if match is None:
+        raise ValueError(f"File {path} is not named like a .hgt tile, e.g. N45E018.hgt")
+
+    lat = int(match[2]) * (1 if match[1] == 'N' else -1)
+    lon = int(match[4]) * (1 if match[3] == 'E' else -1)
+
+    n_pixels = int(round((path.stat().st_size // 2) ** 0.5))
+    data = np.memmap(path, dtype='>i2', mode='r', shape=(n_pixels, n_pixels))
+    step = 1. / (n_pixels - 1)
+
+    return Raster(data, lon, lat + 1, step, step, nodata=-32768)
+
+def _read_tiff_tags(file, byte_order: str) -> dict:
+    """
+    Reads tags of the first image file directory of a classic TIFF file.
+    """
+    file.seek(4)
+    offset_ifd, = struct.unpack(byte_order + 'I', file.read(4))
+    file.seek(offset_ifd)
+    n_entries, = struct.unpack(byte_order + 'H', file.read(2))
+    entries = [struct.unpack(byte_order + 'HHII', file.read(12)) for _ in range(n_entries)]
+
+    tags = {}
+    for tag, field_type, count, value in entries:
+        if field_type not in TIFF_TYPE_FORMATS:
+            continue
+
+        size = TIFF_TYPE_SIZES[field_type] * count
+        if size <= 4:
+            raw = struct.pack(byte_order + 'I', value)[:size]
+        else:
+            file.seek(value)
+            raw = file.read(size)
+
+        if field_type == 2:
+            tags[tag] = raw.rstrip(b'\x00').decode('ascii')
+        else:
+            tags[tag] = struct.unpack(byte_order + TIFF_TYPE_FORMATS[field_type] * count, raw)
+
+    return tags
+
+def load_geotiff(path: pathlib.Path) -> Raster:
+    """
+    Memory-maps an uncompressed, striped, single band GeoTIFF such as an ASTER GDEM tile.
+    Other layouts are read with rasterio if it is installed.
+    """
+    with open(path, 'rb') as file:
+        header = file.read(4)
+        byte_order = {b'II': '<', b'MM': '>'}.get(header[:2])
+        magic = None if byte_order is None else struct.unpack(byte_order + 'H', header[2:])[0]
+        tags = _read_tiff_tags(file, byte_order) if magic == 42 else {}
+
+    offsets = tags.get(273, ())
+    byte_counts = tags.get(279, ())
+    memory_mappable = (
+        tags.get(259, (1,))[0] == 1
+        and tags.get(277, (1,))[0] == 1
+        and 322 not in tags
+        and all(o + c == o_next for o, c, o_next in zip(offsets, byte_counts, offsets[1:]))
+        and 33550 in tags and 33922 in tags
+    )
+    if not memory_mappable:
+        return _load_geotiff_rasterio(path)
+
+    n_cols, n_rows = tags[256][0], tags[257][0]
+    dtype = np.dtype(byte_order + TIFF_SAMPLE_FORMATS[tags.get(339, (1,))[0]] + str(tags[258][0] // 8))
+    data = np.memmap(path, dtype=dtype, mode='r', offset=offsets[0], shape=(n_rows, n_cols))
+
+    lon_step, lat_step = tags[33550][:2]
+    _, _, _, lon_tie, lat_tie, _ = tags[33922][:6]
+
+    # GTRasterTypeGeoKey tells whether the tie point is a pixel corner (1) or a pixel centre (2)
+    geo_keys = tags.get(34735, ())
+    geo_keys = {geo_keys[i]: geo_keys[i + 3] for i in range(4, len(geo_keys), 4)}
+    if geo_keys.get(1025, 1) == 1:
+        lon_tie += lon_step / 2
+        lat_tie -= lat_step / 2
+
+    nodata = float(tags[42113]) if 42113 in tags else None
+
+    return Raster(data, lon_tie, lat_tie, lon_step, lat_step, nodata)
+
+def _load_geotiff_rasterio(path: pathlib.Path) -> Raster:
+    try:
+        import rasterio
+    except ImportError:
+        raise ImportError(
+            f"File {path} is compressed or tiled and cannot be memory-mapped, install rasterio to read it"
+        )
+
+    with rasterio.open(path) as dataset:
+        data = dataset.read(1)
+        transform = dataset.transform
+        nodata = dataset.nodata
+
+    return Raster(data, transform.c + transform.a / 2, transform.f + transform.e / 2,
+                  transform.a, -transform.e, nodata)
+
+def load_raster(path: str) -> Raster:
+    """
+    Loads a .hgt or GeoTIFF elevation raster, chosen by the file suffix.
+    """
+    path = pathlib.Path(path)
+    if path.suffix.lower() == '.hgt':
+        return load_hgt(path)
+    if path.suffix.lower() in ['.tif', '.tiff']:
+        return load_geotiff(path)
+    raise ValueError(f"File {path} is not a supported elevation raster (.hgt, .tif)")
+
+def get_elevations(config: dict) -> dict:
+    """
+    Samples elevations of the region grid from local DEM rasters.
+
+    Parameters:
+    config (dict): Region configuration, same as for opentopdata.get_elevations, with the additional key:
+        'path_dem' (str or list): Path to a .hgt or GeoTIFF tile, or a list of tiles covering the region.
+
+    Returns:
+    dict: A dictionary containing the following keys, ordered as the sampled grid:
+        'lon' (np.ndarray): The longitudes of the sampled points.
+        'lat' (np.ndarray): The latitudes of the sampled points.
+        'elevation' (np.ndarray): The elevations of the sampled points, NaN outside of the tiles.
+    """
+    paths_dem = config['path_dem']
+    if isinstance(paths_dem, str):
+        paths_dem = [paths_dem]
+
+    lon_coords, lat_coords = grid.get_hex_grid(config)
+    elevations = np.full(lon_coords.shape, np.nan)
+
+    for path_dem in paths_dem:
+        raster = load_raster(path_dem)
+        mask = raster.contains(lon_coords, lat_coords) & np.isnan(elevations)
+        elevations[mask] = raster.sample(lon_coords[mask], lat_coords[mask])
+
+    return {
+        'lon': lon_coords,
+        'lat': lat_coords,
+        'elevation': elevations
+    }
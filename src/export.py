@@ -0,0 +1,412 @@
+import gzip
+import json
+import pathlib
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+
+# Web Mercator (EPSG:3857) used by web map tiles
+MERCATOR_RADIUS = 6378137.
+MERCATOR_HALF_SIZE = np.pi * MERCATOR_RADIUS
+MERCATOR_MAX_LAT = 85.0511287798
+
+# Tile coordinate range and the margin drawn outside of a tile, so outlines do not show at tile edges
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+TILES_STATE_FILE = 'tiles_state.npz'
+
+def to_mercator(geometry: shapely.Geometry) -> shapely.Geometry:
+    """
+    Converts a Shapely geometry from lon/lat to Web Mercator metres.
+    """
+    def transform(xy):
+        lat = np.radians(np.clip(xy[:, 1], -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT))
+        return np.column_stack([
+            MERCATOR_RADIUS * np.radians(xy[:, 0]),
+            MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + lat / 2)),
+        ])
+    return shapely.transform(geometry, transform)
+
+def get_tile_bounds(z: int, x: int, y: int) -> tuple:
+    """
+    Returns (x_min, y_min, x_max, y_max) of the tile in Web Mercator metres.
+    """
+    size = 2 * MERCATOR_HALF_SIZE / 2 ** z
+    x_min = -MERCATOR_HALF_SIZE + x * size
+    y_max = MERCATOR_HALF_SIZE - y * size
+    return x_min, y_max - size, x_min + size, y_max
+
+def get_tiles(geometry: shapely.Geometry, z: int, buffer: int = TILE_BUFFER) -> set:
+    """
+    Returns (x, y) of all tiles at zoom z whose buffered area intersects the geometry.
+    """
+    if geometry is None or geometry.is_empty:
+        return set()
+
+    n_tiles = 2 ** z
+    size = 2 * MERCATOR_HALF_SIZE / n_tiles
+    pad = size * buffer / TILE_EXTENT
+
+    x_min, y_min, x_max, y_max = geometry.bounds
+    x_first, x_last = np.clip(np.floor((np.array([x_min - pad, x_max + pad]) + MERCATOR_HALF_SIZE) / size), 0, n_tiles - 1)
+    y_first, y_last = np.clip(np.floor((MERCATOR_HALF_SIZE - np.array([y_max + pad, y_min - pad])) / size), 0, n_tiles - 1)
+
+    xs, ys = np.meshgrid(np.arange(x_first, x_last + 1), np.arange(y_first, y_last + 1))
+    xs, ys = xs.ravel(), ys.ravel()
+    boxes = shapely.box(
+        -MERCATOR_HALF_SIZE + xs * size - pad,
+        MERCATOR_HALF_SIZE - (ys + 1) * size - pad,
+        -MERCATOR_HALF_SIZE + (xs + 1) * size + pad,
+        MERCATOR_HALF_SIZE - ys * size + pad,
+    )
+
+    shapely.prepare(geometry)
+    hit = shapely.intersects(geometry, boxes)
+
+    return set(zip(xs[hit].astype(int).tolist(), ys[hit].astype(int).tolist()))
+
+def _encode_varints(values) -> bytes:
+    """
+    Encodes non-negative integers as protobuf varints, 7 bits per byte with the high bit marking continuation.
+    """
+    values = np.asarray(values, dtype=np.uint64).ravel()
+    shifts = np.arange(10, dtype=np.uint64) * np.uint64(7)
+    n_bytes = 1 + (values[:, None] >= (np.uint64(1) << shifts[1:])).sum(axis=1)
+
+    groups = ((values[:, None] >> shifts) & np.uint64(0x7f)).astype(np.uint8)
+    groups[np.arange(10) < (n_bytes[:, None] - 1)] |= 0x80
+
+    return groups[np.arange(10) < n_bytes[:, None]].tobytes()
+
+def _encode_field(field: int, value) -> bytes:
+    """
+    Encodes a protobuf field, bytes as length-delimited and integers as varint.
+    """
+    if isinstance(value, bytes):
+        return _encode_varints([field << 3 | 2, len(value)]) + value
+    return _encode_varints([field << 3, value])
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+def encode_polygon_commands(geometry: shapely.Geometry) -> np.ndarray:
+    """
+    Encodes polygons given in tile coordinates as MVT geometry commands.
+    Exterior rings are written clockwise and holes counterclockwise as seen on screen, as the specification requires.
+    Rings that collapse after rounding to integer coordinates are dropped, together with holes of dropped exteriors.
+
+    Parameters:
+    geometry (Geometry): Shapely geometry, only its polygon parts are encoded.
+
+    Returns:
+    np.ndarray: Command integers, empty if nothing is left to draw.
+    """
+    parts = shapely.get_parts(geometry)
+    parts = parts[shapely.get_type_id(parts) == 3]
+    rings, polygon_index = shapely.get_rings(parts, return_index=True)
+    is_exterior = np.r_[True, polygon_index[1:] != polygon_index[:-1]] if len(rings) else np.empty(0, dtype=bool)
+
+    commands = []
+    cursor = np.zeros(2, dtype=np.int64)
+    keep_holes = False
+    for ring, exterior in zip(rings, is_exterior):
+        points = np.round(shapely.get_coordinates(ring)[:-1]).astype(np.int64)
+        if len(points):
+            points = points[np.r_[True, np.any(points[1:] != points[:-1], axis=1)]]
+        if len(points) > 1 and (points[-1] == points[0]).all():
+            points = points[:-1]
+
+        area = 0 if len(points) < 3 else (
+            np.dot(points[:, 0], np.roll(points[:, 1], -1)) - np.dot(np.roll(points[:, 0], -1), points[:, 1])
+        )
+        if exterior:
+            keep_holes = area != 0
+        if area == 0 or not keep_holes:
+            continue
+
+        # Surveyor's formula in tile coordinates is positive for exterior rings, negative for holes
+        if (area > 0) != exterior:
+            points = points[::-1]
+
+        deltas = np.diff(points, axis=0, prepend=cursor[None])
+        cursor = points[-1]
+        # MoveTo the first point, LineTo the others and ClosePath, as command id | count << 3
+        commands.append(np.concatenate([
+            np.array([1 | 1 << 3], dtype=np.uint64),
+            _zigzag(deltas[0]),
+            np.array([2 | (len(points) - 1) << 3], dtype=np.uint64),
+            _zigzag(deltas[1:]).ravel(),
+            np.array([7 | 1 << 3], dtype=np.uint64),
+        ]))
+
+    return np.concatenate(commands) if commands else np.empty(0, dtype=np.uint64)
+
+def encode_tile(
+        geometries: dict,
+        properties: dict,
+        z: int,
+        x: int,
+        y: int,
+        extent: int = TILE_EXTENT,
+        buffer: int = TILE_BUFFER
+    ) -> bytes:
+    """
+    Encodes one Mapbox Vector Tile with a layer per geometry.
+
+    Parameters:
+    geometries (dict): Shapely geometries in Web Mercator metres by layer name.
+    properties (dict): String properties of the feature of every layer.
+    z, x, y (int): Tile address.
+    extent (int): Tile coordinate range.
+    buffer (int): Margin outside of the tile that is kept, in tile coordinates.
+
+    Returns:
+    bytes: Encoded tile, empty if no geometry reaches the tile.
+    """
+    x_min, y_min, x_max, y_max = get_tile_bounds(z, x, y)
+    size = x_max - x_min
+    pad = size * buffer / extent
+
+    layers = []
+    for name, geometry in geometries.items():
+        if geometry is None:
+            continue
+        clipped = shapely.clip_by_rect(geometry, x_min - pad, y_min - pad, x_max + pad, y_max + pad)
+        if clipped.is_empty:
+            continue
+
+        # Clipping first keeps every tile independent of geometry outside of it, simplify to one tile unit
+        clipped = shapely.transform(
+            clipped, lambda xy: np.column_stack([(xy[:, 0] - x_min) * extent / size, (y_max - xy[:, 1]) * extent / size])
+        )
+        commands = encode_polygon_commands(shapely.simplify(clipped, 1.))
+        if not len(commands):
+            continue
+
+        keys = list(properties[name])
+        values = b''.join(_encode_field(4, _encode_field(1, str(v).encode())) for v in properties[name].values())
+        feature = (
+            _encode_field(1, 1)
+            + _encode_field(2, _encode_varints(np.repeat(np.arange(len(keys)), 2)))
+            + _encode_field(3, 3)
+            + _encode_field(4, _encode_varints(commands))
+        )
+        layers.append(_encode_field(3, (
+            _encode_field(15, 2)
+            + _encode_field(1, name.encode())
+            + _encode_field(2, feature)
+            + b''.join(_encode_field(3, key.encode()) for key in keys)
+            + values
+            + _encode_field(5, extent)
+        )))
+
+    return b''.join(layers)
+
+_tile_worker = {}
+
+def _init_tile_worker(wkbs: dict, properties: dict, path_tiles: str):
+    _tile_worker['geometries'] = {name: shapely.from_wkb(wkb) for name, wkb in wkbs.items()}
+    _tile_worker['properties'] = properties
+    _tile_worker['path_tiles'] = pathlib.Path(path_tiles)
+
+def _write_tiles(tiles: list) -> tuple[int, int]:
+    """
+    Writes the tiles, removing files of tiles that became empty. Returns numbers of written and removed tiles.
+    """
+    n_written, n_removed = 0, 0
+    for z, x, y in tiles:
+        path_tile = _tile_worker['path_tiles'] / str(z) / str(x) / f'{y}.mvt'
+        tile = encode_tile(_tile_worker['geometries'], _tile_worker['properties'], z, x, y)
+        if tile:
+            path_tile.parent.mkdir(parents=True, exist_ok=True)
+            path_tile.write_bytes(tile)
+            n_written += 1
+        elif path_tile.exists():
+            path_tile.unlink()
+            n_removed += 1
+    return n_written, n_removed
+
+def _load_tiles_state(path_state: pathlib.Path) -> dict:
+    try:
+        with np.load(path_state, allow_pickle=False) as state:
+            names = state['names'].tolist()
+            return {
+                'zoom': state['zoom'].tolist(),
+                'geometries': {name: shapely.from_wkb(state[f'wkb_{i}'].tobytes()) for i, name in enumerate(names)},
+            }
+    except (FileNotFoundError, KeyError, ValueError, OSError):
+        return None
+
+def _save_tiles_state(path_state: pathlib.Path, zoom: list, wkbs: dict):
+    np.savez(
+        path_state,
+        names=np.array(list(wkbs), dtype=str),
+        zoom=np.array(zoom),
+        **{f'wkb_{i}': np.frombuffer(wkb, dtype=np.uint8) for i, wkb in enumerate(wkbs.values())}
+    )
+
+def write_tiles(
+        geometries: dict,
+        properties: dict,
+        path_export: str,
+        zoom_min: int = 10,
+        zoom_max: int = 16,
+        max_workers: int = None,
+        chunk_size: int = 64
+    ) -> dict:
+    """
+    Writes vector tiles to path_export/tiles/{z}/{x}/{y}.mvt with a process pool.
+    Geometries of the previous run are kept in path_export, and only tiles that overlap the symmetric
+    difference between the previous and the current geometry of some layer are written again.
+
+    Parameters:
+    geometries (dict): Shapely geometries in Web Mercator metres by layer name.
+    properties (dict): String properties of the feature of every layer.
+    path_export (str): Output folder.
+    zoom_min, zoom_max (int): Zoom range, both included.
+    max_workers (int): Number of worker processes, defaults to the number of CPUs.
+    chunk_size (int): Number of tiles sent to a worker at once.
+
+    Returns:
+    dict: Number of 'written', 'removed' and 'unchanged' tiles, and 'time' in seconds.
+    """
+    time_start = time.perf_counter()
+
+    path_tiles = pathlib.Path(path_export, 'tiles')
+    path_state = pathlib.Path(path_export, TILES_STATE_FILE)
+    zoom = [zoom_min, zoom_max, TILE_EXTENT, TILE_BUFFER]
+    geometries = {name: geometry for name, geometry in geometries.items() if geometry is not None}
+    wkbs = {name: shapely.to_wkb(geometry) for name, geometry in geometries.items()}
+
+    state = _load_tiles_state(path_state)
+    if state is None or state['zoom'] != zoom:
+        shutil.rmtree(path_tiles, ignore_errors=True)
+        changed = list(geometries.values())
+    else:
+        # Only the area where a layer gained or lost coverage needs new tiles
+        changed = [
+            geometry if name not in state['geometries']
+            else shapely.symmetric_difference(geometry, state['geometries'][name])
+            for name, geometry in geometries.items()
+            if name not in state['geometries'] or wkbs[name] != shapely.to_wkb(state['geometries'][name])
+        ] + [geometry for name, geometry in state['geometries'].items() if name not in geometries]
+
+    tiles = sorted(
+        (z, x, y)
+        for z in range(zoom_min, zoom_max + 1)
+        for x, y in set().union(*[get_tiles(geometry, z) for geometry in changed])
+    )
+    n_total = sum(len(set().union(*[get_tiles(geometry, z) for geometry in geometries.values()]))
+                  for z in range(zoom_min, zoom_max + 1))
+
+    chunks = [tiles[i:i + chunk_size] for i in range(0, len(tiles), chunk_size)]
+    if len(chunks) > 1 and max_workers != 1:
+        with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_tile_worker,
+                initargs=(wkbs, properties, str(path_tiles))
+            ) as executor:
+            counts = list(executor.map(_write_tiles, chunks))
+    else:
+        _init_tile_worker(wkbs, properties, str(path_tiles))
+        counts = [_write_tiles(chunk) for chunk in chunks]
+
+    path_state.parent.mkdir(parents=True, exist_ok=True)
+    _save_tiles_state(path_state, zoom, wkbs)
+
+    n_written = sum(c[0] for c in counts)
+    return {
+        'written': n_written,
+        'removed': sum(c[1] for c in counts),
+        'unchanged': n_total - n_written,
+        'time': time.perf_counter() - time_start,
+    }
+
+def write_geojson(geometries: dict, properties: dict, path: str):
+    """
+    Writes lon/lat geometries as a gzip compressed GeoJSON FeatureCollection with a feature per geometry.
+    Coordinates are rounded to 7 decimals, about a centimetre.
+    """
+    features = [
+        '{"type":"Feature","properties":' + json.dumps(properties[name]) + ',"geometry":'
+        + shapely.to_geojson(shapely.transform(geometry, lambda xy: np.round(xy, 7))) + '}'
+        for name, geometry in geometries.items() if geometry is not None
+    ]
+    with gzip.open(path, 'wt', compresslevel=6) as file:
+        file.write('{"type":"FeatureCollection","features":[' + ','.join(features) + ']}')
+
+def write_flatgeobuf(geometries: dict, properties: dict, path: str):
+    """
+    Writes lon/lat geometries as FlatGeobuf, which has a spatial index for streaming parts of it over HTTP.
+    """
+    try:
+        from pyogrio.raw import write
+    except ImportError:
+        raise ImportError(f"Cannot write {path}, install pyogrio to export FlatGeobuf")
+
+    names = [name for name, geometry in geometries.items() if geometry is not None]
+    fields = list(properties[names[0]]) if names else []
+    write(
+        str(path),
+        shapely.to_wkb(np.array([geometries[name] for name in names], dtype=object)),
+        [np.array([str(properties[name][field]) for name in names], dtype=object) for field in fields],
+        fields,
+        driver='FlatGeobuf',
+        geometry_type='Unknown',
+        crs='EPSG:4326',
+    )
+
+def export_map(
+        map,
+        path_export: str = 'results/export',
+        zoom_min: int = 10,
+        zoom_max: int = 16,
+        flatgeobuf: bool = False,
+        max_workers: int = None
+    ) -> dict:
+    """
+    Exports the final and category polygons of the map for serving to a web map:
+    gzip compressed GeoJSON, optionally FlatGeobuf, and vector tiles over the zoom range.
+    Every polygon becomes a feature with its 'name' and 'color', tiles have a layer per polygon.
+
+    Parameters:
+    map (data_handler.Map): Map with stacked locations.
+    path_export (str): Output folder.
+    zoom_min, zoom_max (int): Zoom range of the tiles, both included.
+    flatgeobuf (bool): Also writes polygons.fgb, needs pyogrio.
+    max_workers (int): Number of tiling processes, defaults to the number of CPUs.
+
+    Returns:
+    dict: Tiling summary from write_tiles.
+    """
+    path_export = pathlib.Path(path_export)
+    path_export.mkdir(parents=True, exist_ok=True)
+
+    geometries = {name: map.projection.to_lonlat(geometry) for name, geometry in map.get_geometries().items()}
+
+    colors = {'final': 'green'}
+    for location in map.locations.values():
+        colors.setdefault(location.config['category'], location.config['color'])
+    properties = {name: {'name': name, 'color': colors.get(name, '')} for name in geometries}
+
+    write_geojson(geometries, properties, path_export / 'polygons.geojson.gz')
+    if flatgeobuf:
+        write_flatgeobuf(geometries, properties, path_export / 'polygons.fgb')
+
+    summary = write_tiles(
+        {name: to_mercator(geometry) for name, geometry in geometries.items() if geometry is not None},
+        properties,
+        path_export,
+        zoom_min,
+        zoom_max,
+        max_workers
+    )
+    print(f"Tiles: {summary['written']} written, {summary['removed']} removed, "
+          f"{summary['unchanged']} unchanged in {summary['time']:.2f} s")
+
+    return summary
@@ -0,0 +1,496 @@
+import gzip
+import json
+import pathlib
+import threading
+import time
+
+import numpy as np
+import shapely
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+from src import metrics
+from src import projection
+from src.coordinates import Coordinates
+
+# Travel speed in km/h by OSM highway class, 'default' for classes not listed
+PROFILE_SPEEDS = {
+    'walking': {'default': 5.},
+    'cycling': {'default': 15., 'footway': 8., 'pedestrian': 8., 'path': 10., 'track': 10.},
+    'driving': {
+        'motorway': 110., 'trunk': 90., 'primary': 60., 'secondary': 50., 'tertiary': 40.,
+        'unclassified': 40., 'residential': 30., 'living_street': 10., 'service': 15., 'default': 30.,
+    },
+}
+
+# Highway classes a profile cannot use
+PROFILE_EXCLUDED = {
+    'walking': {'motorway', 'trunk'},
+    'cycling': {'motorway', 'trunk', 'steps'},
+    'driving': {'footway', 'pedestrian', 'path', 'steps', 'cycleway', 'bridleway', 'track', 'corridor', 'platform'},
+}
+
+# Profiles that have to follow one-way streets
+PROFILE_ONEWAY = {'cycling', 'driving'}
+
+class RoadGraph:
+    """
+    A class to compute isochrones offline on a local road network.
+
+    Nodes are road junctions and vertices, edges are road segments between them. Travel times of every
+    profile are derived from segment lengths and the speeds of their highway class, and reachable
+    areas are found with a bounded Dijkstra search from all centres at once.
+
+    Attributes
+    ----------
+    lon, lat : np.ndarray
+        coordinates of the nodes
+    u, v : np.ndarray
+        node indices of the edge ends
+    highway : np.ndarray
+        OSM highway class of every edge, e.g. 'residential'
+    oneway : np.ndarray
+        True for edges that can only be travelled from u to v
+    length : np.ndarray
+        length of every edge in metres
+    projection : LocalProjection
+        metric projection centred at the graph, used for lengths, snapping and polygons
+    xy : np.ndarray
+        projected coordinates of the nodes in metres
+    """
+
+    def __init__(self, lon, lat, u, v, highway=None, oneway=None, length=None):
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.u = np.asarray(u, dtype=np.int64)
+        self.v = np.asarray(v, dtype=np.int64)
+        self.highway = np.full(len(self.u), 'residential') if highway is None else np.asarray(highway, dtype=str)
+        self.oneway = np.zeros(len(self.u), dtype=bool) if oneway is None else np.asarray(oneway, dtype=bool)
+
+        self.projection = projection.LocalProjection(
+            (self.lon.min() + self.lon.max()) / 2, (self.lat.min() + self.lat.max()) / 2
+        )
+        self.xy = np.column_stack(self.projection.forward(self.lon, self.lat))
+        if length is None:
+            length = np.hypot(*(self.xy[self.v] - self.xy[self.u]).T)
+        self.length = np.asarray(length, dtype=np.float64)
+
+        self._tree = cKDTree(self.xy)
+        self._edges = {}
+        self._travel_times = {}
+        self._lock = threading.Lock()
+
+    def save(self, path: str):
+        """
+        Stores the graph as .npz, which loads much faster than GeoJSON or OSM files.
+        """
+        np.savez(
+            path, lon=self.lon, lat=self.lat, u=self.u, v=self.v,
+            highway=self.highway, oneway=self.oneway, length=self.length
+        )
+
+    def get_edges(self, profile: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns directed edges usable by the profile as (source nodes, target nodes, travel times in seconds),
+        computed once per profile.
+        """
+        with self._lock:
+            if profile not in self._edges:
+                self._edges[profile] = self._get_edges(profile)
+        return self._edges[profile]
+
+    def _get_edges(self, profile: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if profile not in PROFILE_SPEEDS:
+            raise ValueError(f"Unknown profile {profile}, expected one of {list(PROFILE_SPEEDS)}")
+
+        highway = np.char.replace(self.highway, '_link', '')
+        speeds = PROFILE_SPEEDS[profile]
+        speed = np.array([speeds.get(h, speeds['default']) for h in highway.tolist()], dtype=np.float64)
+        allowed = ~np.isin(highway, list(PROFILE_EXCLUDED[profile]))
+
+        # Zero weights would be dropped by the sparse matrix, keep at least a millisecond per edge
+        seconds = np.maximum(self.length / (speed / 3.6), 1e-3)
+
+        backward = allowed & ~(self.oneway & (profile in PROFILE_ONEWAY))
+        return (
+            np.concatenate([self.u[allowed], self.v[backward]]),
+            np.concatenate([self.v[allowed], self.u[backward]]),
+            np.concatenate([seconds[allowed], seconds[backward]]),
+        )
+
+    def get_travel_times(self, profile: str) -> sparse.csr_matrix:
+        """
+        Returns the sparse matrix of travel times between neighbouring nodes for the profile, built on first use.
+        """
+        source, target, seconds = self.get_edges(profile)
+        with self._lock:
+            if profile not in self._travel_times:
+                # Parallel edges would be summed, keep the fastest one
+                order = np.lexsort((seconds, target, source))
+                source, target, seconds = source[order], target[order], seconds[order]
+                first = np.r_[True, (source[1:] != source[:-1]) | (target[1:] != target[:-1])]
+
+                n_nodes = len(self.lon)
+                self._travel_times[profile] = sparse.csr_matrix(
+                    (seconds[first], (source[first], target[first])), shape=(n_nodes, n_nodes)
+                )
+
+        return self._travel_times[profile]
+
+    def snap(self, lon, lat, max_distance: float = 500.) -> np.ndarray:
+        """
+        Returns the nearest node of every point.
+
+        Raises:
+        ValueError: If a point is farther than max_distance metres from the graph.
+        """
+        x, y = self.projection.forward(lon, lat)
+        distance, nodes = self._tree.query(np.column_stack([np.atleast_1d(x), np.atleast_1d(y)]))
+        if (distance > max_distance).any():
+            i = int(np.argmax(distance > max_distance))
+            raise ValueError(
+                f"Point {np.atleast_1d(lat)[i]}, {np.atleast_1d(lon)[i]} is {distance[i]:.0f} m from the nearest road of the graph"
+            )
+        return nodes
+
+    def get_reachable_polygon(
+            self,
+            times: np.ndarray,
+            seconds: float,
+            profile: str,
+            buffer_meters: float = 25.,
+            polygon: str = 'edges',
+            origins: np.ndarray = None
+        ) -> shapely.Geometry:
+        """
+        Builds the area reachable within the time limit, in metres of self.projection.
+
+        Parameters:
+        times (np.ndarray): Travel time from the centre to every node in seconds, inf if not reached.
+        seconds (float): Time limit.
+        profile (str): Profile the times were computed for.
+        buffer_meters (float): Distance around reached roads that counts as reachable.
+        polygon (str): 'edges' buffers the reached road segments, 'concave_hull' wraps the reached points.
+        origins (np.ndarray): Centre nearest to every node, if times come from several centres.
+            Points of each centre are wrapped separately, so the hull does not bridge gaps between centres.
+
+        Returns:
+        Geometry: Shapely Polygon or MultiPolygon.
+        """
+        source, target, edge_seconds = self.get_edges(profile)
+        reached = times <= seconds
+
+        # Segments reached completely, and the reached part of segments that lead out of the reachable area
+        full = reached[source] & reached[target]
+        partial = reached[source] & ~reached[target]
+        fraction = (seconds - times[source[partial]]) / edge_seconds[partial]
+        ends_partial = self.xy[source[partial]] + fraction[:, None] * (self.xy[target[partial]] - self.xy[source[partial]])
+
+        starts = np.concatenate([self.xy[source[full]], self.xy[source[partial]]])
+        ends = np.concatenate([self.xy[target[full]], ends_partial])
+        points = np.concatenate([self.xy[reached], ends_partial])
+
+        if polygon == 'concave_hull':
+            if origins is None:
+                return shapely.buffer(shapely.concave_hull(shapely.multipoints(points), ratio=0.3), buffer_meters)
+            # Nodes across a segment to another centre are wrapped by both, so neighbouring hulls touch
+            cross = full & (origins[source] != origins[target])
+            points = np.concatenate([points, self.xy[target[cross]]])
+            points_origin = np.concatenate([origins[reached], origins[source[partial]], origins[source[cross]]])
+            order = np.argsort(points_origin, kind='stable')
+            _, index = np.unique(points_origin[order], return_inverse=True)
+            hulls = shapely.concave_hull(shapely.multipoints(points[order], indices=index), ratio=0.3)
+            return shapely.union_all(shapely.buffer(hulls, buffer_meters))
+        if polygon != 'edges':
+            raise ValueError(f"Unknown isochrone polygon {polygon}, expected 'edges' or 'concave_hull'")
+
+        # Two-way roads are reached in both directions, one segment per pair of nodes is enough.
+        # One-way roads exist in a single direction, so pairs are compared without their direction
+        pairs = np.stack([np.minimum(source[full], target[full]), np.maximum(source[full], target[full])], axis=1)
+        _, index_full = np.unique(pairs, axis=0, return_index=True)
+        unique = np.r_[index_full, np.arange(full.sum(), len(starts))]
+        segments = shapely.linestrings(np.stack([starts[unique], ends[unique]], axis=1))
+
+        # Reached nodes without reached segments, e.g. a centre on a road the profile cannot use
+        isolated = reached.copy()
+        isolated[source[full | partial]] = False
+        isolated[target[full]] = False
+        geometries = np.concatenate([segments, shapely.points(self.xy[isolated])])
+
+        # Cascaded union of small buffers is several times faster than buffering all segments as one geometry
+        return shapely.union_all(shapely.buffer(geometries, buffer_meters, quad_segs=2))
+
+    def get_isochrones(
+            self,
+            profile: str,
+            lon,
+            lat,
+            contours_minutes: list,
+            buffer_meters: float = 25.,
+            polygon: str = 'edges',
+            max_snap_meters: float = 500.,
+            chunk_size: int = 64
+        ) -> list[dict]:
+        """
+        Computes isochrones of many centres with one bounded Dijkstra search per chunk of centres.
+
+        Parameters:
+        profile (str): Profile to travel with: walking, cycling or driving.
+        lon, lat (array-like): Coordinates of the centres.
+        contours_minutes (list): Times in minutes, any number and length.
+        buffer_meters (float): Distance around reached roads that counts as reachable.
+        polygon (str): 'edges' or 'concave_hull', see get_reachable_polygon.
+        max_snap_meters (float): Maximum distance of a centre from the nearest road.
+        chunk_size (int): Number of centres searched together, limits memory of the distance matrix.
+
+        Returns:
+        list: For every centre a dict of contour minutes to Coordinates with the outer rings of the reachable area.
+        """
+        nodes = self.snap(lon, lat, max_snap_meters)
+        travel_times = self.get_travel_times(profile)
+        limit = max(contours_minutes) * 60
+
+        isochrones = []
+        for i in range(0, len(nodes), chunk_size):
+            times = csgraph.dijkstra(travel_times, directed=True, indices=nodes[i:i + chunk_size], limit=limit)
+            for times_centre in np.atleast_2d(times):
+                isochrones.append({
+                    minutes: self._to_coordinates(
+                        self.get_reachable_polygon(times_centre, minutes * 60, profile, buffer_meters, polygon)
+                    )
+                    for minutes in contours_minutes
+                })
+
+        return isochrones
+
+    def get_isochrone_union(
+            self,
+            profile: str,
+            lon,
+            lat,
+            contours_minutes: list,
+            buffer_meters: float = 25.,
+            polygon: str = 'edges',
+            max_snap_meters: float = 500.
+        ) -> dict:
+        """
+        Computes the area reachable from any of the centres with a single multi-source Dijkstra search.
+        Each node only keeps its time from the nearest centre, so the cost grows with the covered area
+        rather than with the number of centres, and no union of overlapping isochrones is needed.
+
+        Parameters:
+        profile (str): Profile to travel with: walking, cycling or driving.
+        lon, lat (array-like): Coordinates of the centres.
+        contours_minutes (list): Times in minutes, any number and length.
+        buffer_meters (float): Distance around reached roads that counts as reachable.
+        polygon (str): 'edges' or 'concave_hull', see get_reachable_polygon.
+        max_snap_meters (float): Maximum distance of a centre from the nearest road.
+
+        Returns:
+        dict: Contour minutes to Coordinates with the outer rings of the reachable area.
+        """
+        nodes = np.unique(self.snap(lon, lat, max_snap_meters))
+        times, _, origins = csgraph.dijkstra(
+            self.get_travel_times(profile), directed=True, indices=nodes, limit=max(contours_minutes) * 60,
+            min_only=True, return_predecessors=True
+        )
+
+        return {
+            minutes: self._to_coordinates(
+                self.get_reachable_polygon(times, minutes * 60, profile, buffer_meters, polygon, origins)
+            )
+            for minutes in contours_minutes
+        }
+
+    def _to_coordinates(self, geometry: shapely.Geometry) -> Coordinates:
+        """
+        Converts outer rings of the polygon to lon/lat Coordinates. Holes are filled as in Mapbox isochrones.
+        """
+        parts = shapely.get_parts(geometry)
+        rings = shapely.get_exterior_ring(parts[shapely.get_type_id(parts) == 3])
+        coordinates = Coordinates.from_shapely(rings)
+        return Coordinates(np.column_stack(self.projection.inverse(coordinates.lon, coordinates.lat)), coordinates.offsets)
+
+def load_npz(path: pathlib.Path) -> RoadGraph:
+    with np.load(path, allow_pickle=False) as graph:
+        return RoadGraph(**{name: graph[name] for name in graph.files})
+
+def _from_ways(ways: list) -> RoadGraph:
+    """
+    Creates a graph from ways given as (points, highway, oneway), connecting ways at equal points.
+    """
+    points = np.concatenate([np.asarray(p, dtype=np.float64).reshape(-1, 2) for p, _, _ in ways])
+    lengths = np.array([len(p) for p, _, _ in ways])
+    nodes, node_index = np.unique(np.round(points, 7), axis=0, return_inverse=True)
+    node_index = node_index.ravel()
+
+    # Consecutive points of the same way form an edge
+    way_index = np.repeat(np.arange(len(ways)), lengths)
+    same_way = way_index[:-1] == way_index[1:]
+    edge_way = way_index[:-1][same_way]
+
+    return RoadGraph(
+        nodes[:, 0],
+        nodes[:, 1],
+        node_index[:-1][same_way],
+        node_index[1:][same_way],
+        np.array([h for _, h, _ in ways], dtype=str)[edge_way],
+        np.array([o for _, _, o in ways], dtype=bool)[edge_way],
+    )
+
+def load_geojson(path: pathlib.Path) -> RoadGraph:
+    """
+    Loads LineString or MultiLineString features with optional 'highway' and 'oneway' properties, e.g. exported from OSM.
+    """
+    with (gzip.open(path, 'rt') if path.suffix == '.gz' else open(path, 'r')) as file:
+        features = json.load(file)['features']
+
+    ways = []
+    for feature in features:
+        geometry = feature['geometry']
+        properties = feature.get('properties') or {}
+        lines = [geometry['coordinates']] if geometry['type'] == 'LineString' else geometry['coordinates']
+        for line in lines:
+            ways.append((line, properties.get('highway', 'residential'), properties.get('oneway') in [True, 'yes', '1']))
+
+    return _from_ways(ways)
+
+def load_osm(path: pathlib.Path) -> RoadGraph:
+    """
+    Loads all ways with a highway tag from an OSM file, e.g. a .osm.pbf extract of a city.
+    """
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError(f"Cannot read {path}, install osmium to load OSM files or convert it to .npz or .geojson")
+
+    class WayHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.ways = []
+
+        def way(self, way):
+            highway = way.tags.get('highway')
+            if highway is not None:
+                points = [(node.lon, node.lat) for node in way.nodes if node.location.valid()]
+                self.ways.append((points, highway, way.tags.get('oneway') in ['yes', '1', 'true']))
+
+    handler = WayHandler()
+    handler.apply_file(str(path), locations=True)
+
+    return _from_ways(handler.ways)
+
+def load_graph(path: str) -> RoadGraph:
+    """
+    Loads a road graph from .npz (see RoadGraph.save), .geojson or OSM (.osm, .pbf) files.
+    """
+    path = pathlib.Path(path)
+    time_start = time.perf_counter()
+
+    if path.suffix == '.npz':
+        graph = load_npz(path)
+    elif path.suffix in ['.geojson', '.json', '.gz']:
+        graph = load_geojson(path)
+    elif path.suffix in ['.pbf', '.osm']:
+        graph = load_osm(path)
+    else:
+        raise ValueError(f"Unknown road graph format of {path}, expected .npz, .geojson or .osm.pbf")
+
+    print(f'Road graph loaded in {time.perf_counter() - time_start:.2f} s: {len(graph.lon)} nodes, {len(graph.u)} edges')
+
+    return graph
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+def get_graph(path: str) -> RoadGraph:
+    """
+    Returns the graph shared within the process for the given file, loaded on first use.
+    """
+    path = str(pathlib.Path(path).resolve())
+    with _graphs_lock:
+        if path not in _graphs:
+            _graphs[path] = load_graph(path)
+    return _graphs[path]
+
+def get_cache_params(config: dict) -> dict:
+    """
+    Returns the parameters of a graph isochrone besides the centre and contour, used in its cache key.
+    """
+    path_graph = pathlib.Path(config['path_graph'])
+    return {
+        'graph': str(path_graph.resolve()),
+        'graph_mtime': path_graph.stat().st_mtime_ns,
+        'buffer_meters': config.get('graph_buffer_meters', 25.),
+        'polygon': config.get('graph_polygon', 'edges'),
+    }
+
+def get_isochrone_coordinates_batch(queries: list[dict], config: dict) -> list:
+    """
+    Computes isochrones of many queries on the road graph of the location config,
+    with one search for all queries of the same profile and contours.
+
+    Parameters:
+    queries (list): Queries with 'profile', 'lon', 'lat' and 'contours_minutes', as for mapbox.get_isochrone_coordinates_batch.
+    config (dict): Location config with 'path_graph' and optional 'graph_buffer_meters', 'graph_polygon' and 'max_snap_meters'.
+
+    Returns:
+    list: For every query a dict of contour minutes to Coordinates, in the same order as queries.
+    """
+    graph = get_graph(config['path_graph'])
+
+    groups = {}
+    for i, query in enumerate(queries):
+        groups.setdefault((query['profile'], tuple(query['contours_minutes'])), []).append(i)
+
+    results = [None] * len(queries)
+    for (profile, contours_minutes), indices in groups.items():
+        time_start = time.perf_counter()
+        with metrics.span('isochrones', 'graph', profile=profile, centres=len(indices)):
+            isochrones = graph.get_isochrones(
+                profile,
+                [queries[i]['lon'] for i in indices],
+                [queries[i]['lat'] for i in indices],
+                list(contours_minutes),
+                buffer_meters=config.get('graph_buffer_meters', 25.),
+                polygon=config.get('graph_polygon', 'edges'),
+                max_snap_meters=config.get('max_snap_meters', 500.),
+            )
+        for i, isochrone in zip(indices, isochrones):
+            results[i] = isochrone
+        print(f'Isochrones computed in {(time.perf_counter() - time_start) * 1000:.0f} ms: '
+              f'{len(indices)} centres, {profile} {list(contours_minutes)} min')
+
+    return results
+
+def get_isochrone_union_coordinates(profile: str, lon, lat, contours_minutes: list, config: dict) -> dict:
+    """
+    Computes the area reachable from any of the centres on the road graph of the location config.
+
+    Parameters:
+    profile (str): Profile to travel with: walking, cycling or driving.
+    lon, lat (array-like): Coordinates of all centres, e.g. of every location in a category.
+    contours_minutes (list): Times in minutes.
+    config (dict): Location config with 'path_graph', as for get_isochrone_coordinates_batch.
+
+    Returns:
+    dict: Contour minutes to Coordinates.
+    """
+    time_start = time.perf_counter()
+
+    with metrics.span('isochrone_union', 'graph', profile=profile, centres=len(lon)):
+        isochrones = get_graph(config['path_graph']).get_isochrone_union(
+            profile,
+            lon,
+            lat,
+            contours_minutes,
+            buffer_meters=config.get('graph_buffer_meters', 25.),
+            polygon=config.get('graph_polygon', 'edges'),
+            max_snap_meters=config.get('max_snap_meters', 500.),
+        )
+
+    print(f'Isochrone union computed in {(time.perf_counter() - time_start) * 1000:.0f} ms: '
+          f'{len(lon)} centres, {profile} {list(contours_minutes)} min')
+
+    return isochrones
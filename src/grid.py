@@ -0,0 +1,24 @@
+import numpy as np
+
+def get_hex_grid(config: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Creates the hex grid of sample points for a region.
+
+    Parameters:
+    config (dict): Configuration dictionary containing the following keys:
+        'top_left' (dict): The latitude and longitude of the top left point of the area of interest.
+        'bottom_right' (dict): The latitude and longitude of the bottom right point of the area of interest.
+        'n_points_lon' (int): The number of points to sample along the longitude.
+        'n_points_lat' (int): The number of points to sample along the latitude.
+
+    Returns:
+    tuple: Flattened longitudes and latitudes of the grid, ordered row by row from the top.
+    """
+    lon_linspace = np.linspace(config['top_left']['lon'], config['bottom_right']['lon'], config['n_points_lon'])
+    lat_linspace = np.linspace(config['top_left']['lat'], config['bottom_right']['lat'], config['n_points_lat'])
+    lon_mesh, lat_mesh = np.meshgrid(lon_linspace, lat_linspace)
+
+    # Add longitude shift to get hex
+    lon_mesh[::2] +=  (lon_linspace[1] - lon_linspace[0])*0.5
+
+    return lon_mesh.flatten(), lat_mesh.flatten()
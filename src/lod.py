@@ -0,0 +1,52 @@
+import numpy as np
+import shapely
+
+# Mapbox GL renders 512 pixel tiles, so zoom 0 shows the equator on 512 pixels
+EARTH_CIRCUMFERENCE = 40075016.686
+TILE_SIZE = 512
+
+# Zoom levels with precomputed geometry, from city overview to street level
+ZOOM_TIERS = (10, 12, 14, 16)
+
+def get_meters_per_pixel(zoom: float, lat: float) -> float:
+    """
+    Returns the ground size of one screen pixel of a Mapbox map.
+
+    Parameters:
+    zoom (float): Map zoom level.
+    lat (float): Latitude of the map center in degrees.
+
+    Returns:
+    float: Metres per pixel.
+    """
+    return EARTH_CIRCUMFERENCE * np.cos(np.radians(lat)) / (TILE_SIZE * 2 ** zoom)
+
+def get_tolerance(zoom: float, lat: float, tolerance_pixels: float = 0.5) -> float:
+    """
+    Returns the simplification tolerance in metres below which vertices are not visible at the zoom.
+    Half a pixel keeps images exported at scale 2 accurate to one output pixel.
+    """
+    return tolerance_pixels * get_meters_per_pixel(zoom, lat)
+
+def get_tier(zoom: float, tiers: tuple = ZOOM_TIERS) -> int:
+    """
+    Returns the coarsest tier that still has enough detail for the zoom, None if the zoom is above all tiers.
+    """
+    return min((tier for tier in tiers if tier >= zoom), default=None)
+
+def simplify(geometries: dict, tolerance: float) -> dict:
+    """
+    Simplifies geometries without changing their topology, so polygons stay valid and holes are kept.
+
+    Parameters:
+    geometries (dict): Shapely geometries in metres by name, None for missing ones.
+    tolerance (float): Maximum distance of a simplified edge from removed vertices, in metres.
+
+    Returns:
+    dict: Simplified geometries by name.
+    """
+    names = [name for name, geometry in geometries.items() if geometry is not None]
+    simplified = shapely.simplify(
+        np.array([geometries[name] for name in names], dtype=object), tolerance, preserve_topology=True
+    )
+    return {**geometries, **dict(zip(names, simplified))}
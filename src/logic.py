@@ -0,0 +1,282 @@
+import numpy as np
+import shapely
+
+# Steps of the older logic block, applied one after another in the order of the block
+LEGACY_STEPS = ['intersection', 'union', 'difference']
+
+OPERATORS = ['and', 'or', 'not']
+
+def is_legacy(logic: dict) -> bool:
+    """
+    Tells whether the logic block lists categories per step, e.g. {"intersection": [...], "difference": [...]},
+    instead of being an expression.
+    """
+    return isinstance(logic, dict) and all(step in LEGACY_STEPS for step in logic)
+
+def from_legacy(logic: dict, categories: list):
+    """
+    Converts the older logic block to an expression with the same result.
+    Steps are applied in the order of the block. The first category with locations starts the result
+    and categories without locations are left out, as they always were.
+
+    Parameters:
+    logic (dict): Categories per step: 'intersection', 'union' and 'difference'.
+    categories (list): Categories with locations, in configuration order.
+
+    Returns:
+    Expression, None if no category of the block has locations.
+    """
+    expression = None
+    for step, step_categories in logic.items():
+        operands = [category for category in categories if category in step_categories]
+        if expression is None and operands:
+            expression, operands = operands[0], operands[1:]
+        if not operands:
+            continue
+
+        if step == 'union':
+            expression = {'or': [expression, *operands]}
+        elif step == 'intersection':
+            expression = {'and': [expression, *operands]}
+        elif step == 'difference':
+            expression = {'and': [expression, *({'not': category} for category in operands)]}
+
+    return expression
+
+def validate(expression, parent: str = None):
+    """
+    Checks that the expression is a category name or a single operator with its operands:
+    {"and": [...]}, {"or": [...]} or {"not": ...}. Not is only allowed as an operand of and,
+    next to at least one operand that is not negated, since the area outside of a category has no bounds.
+    """
+    if isinstance(expression, str):
+        return
+    if not isinstance(expression, dict) or len(expression) != 1:
+        raise ValueError(f"Logic expression {expression} must be a category or a dict with one of the operators {OPERATORS}")
+
+    (operator, operands), = expression.items()
+    if operator not in OPERATORS:
+        raise ValueError(f"Unknown logic operator {operator}, expected one of {OPERATORS}")
+
+    if operator == 'not':
+        if parent != 'and':
+            raise ValueError("Logic operator 'not' is only supported as an operand of 'and'")
+        validate(operands, operator)
+        return
+
+    if not isinstance(operands, list) or not operands:
+        raise ValueError(f"Logic operator '{operator}' needs a non-empty list of operands")
+    if operator == 'and' and all(isinstance(o, dict) and 'not' in o for o in operands):
+        raise ValueError("Logic operator 'and' needs at least one operand that is not negated")
+    for operand in operands:
+        validate(operand, operator)
+
+def parse(logic, categories: list):
+    """
+    Returns the logic block as an expression, converting the older block with from_legacy.
+
+    Parameters:
+    logic (dict or str): The 'logic' block of the configuration.
+    categories (list): Categories with locations, in configuration order.
+
+    Returns:
+    Expression, None if there is nothing to combine.
+    """
+    if is_legacy(logic):
+        return from_legacy(logic, categories)
+
+    validate(logic)
+    return logic
+
+def get_categories(logic) -> list:
+    """
+    Returns the categories the logic block uses, in the order they appear.
+    """
+    if is_legacy(logic):
+        categories = [category for step_categories in logic.values() for category in step_categories]
+    else:
+        categories = []
+        stack = [logic]
+        while stack:
+            expression = stack.pop()
+            if isinstance(expression, str):
+                categories.append(expression)
+            else:
+                operands = next(iter(expression.values()))
+                stack.extend(reversed(operands) if isinstance(operands, list) else [operands])
+
+    return list(dict.fromkeys(categories))
+
+def get_steps(logic) -> dict:
+    """
+    Returns the categories per logic step: the steps of the older block, or a single 'expression' step.
+    """
+    if is_legacy(logic):
+        return logic
+    return {'expression': get_categories(logic)}
+
+def estimate_area(expression, areas: dict) -> float:
+    """
+    Returns an upper bound of the area of the expression from the areas of its categories,
+    None if none of its categories has a geometry.
+    """
+    if isinstance(expression, str):
+        return areas.get(expression)
+
+    (operator, operands), = expression.items()
+    estimates = [
+        estimate_area(operand, areas) for operand in operands
+        if not (isinstance(operand, dict) and 'not' in operand)
+    ]
+    estimates = [estimate for estimate in estimates if estimate is not None]
+    if not estimates:
+        return None
+
+    return sum(estimates) if operator == 'or' else min(estimates)
+
+def prune(geometry: shapely.Geometry, bounds: tuple) -> shapely.Geometry:
+    """
+    Drops the polygons of a geometry whose bounding box lies outside of the bounds.
+    Polygons outside cannot touch anything inside the bounds, so they only slow down later operations.
+    """
+    if geometry.is_empty or shapely.get_type_id(geometry) != shapely.GeometryType.MULTIPOLYGON:
+        return geometry
+
+    parts = shapely.get_parts(geometry)
+    parts_bounds = shapely.bounds(parts)
+    mask = (
+        (parts_bounds[:, 0] <= bounds[2]) & (parts_bounds[:, 2] >= bounds[0])
+        & (parts_bounds[:, 1] <= bounds[3]) & (parts_bounds[:, 3] >= bounds[1])
+    )
+    if mask.all():
+        return geometry
+
+    return shapely.multipolygons(parts[mask])
+
+def clip_union(shapely_polygons: list, bounds: tuple) -> shapely.Geometry:
+    """
+    Unions only what of the polygons lies within the bounds: polygons outside are dropped and the others
+    are clipped to the bounds first, so the union never builds geometry outside of them.
+    """
+    shapely_polygons = np.asarray(shapely_polygons, dtype=object)
+    if not len(shapely_polygons):
+        return shapely.GeometryCollection()
+
+    polygons_bounds = shapely.bounds(shapely_polygons)
+    mask = (
+        (polygons_bounds[:, 0] <= bounds[2]) & (polygons_bounds[:, 2] >= bounds[0])
+        & (polygons_bounds[:, 1] <= bounds[3]) & (polygons_bounds[:, 3] >= bounds[1])
+    )
+    clipped = shapely.clip_by_rect(shapely_polygons[mask], *bounds)
+    clipped = clipped[~shapely.is_empty(clipped)]
+
+    # Clipping by a rectangle is fast but does not guarantee valid output
+    invalid = ~shapely.is_valid(clipped)
+    if invalid.any():
+        clipped[invalid] = shapely.make_valid(clipped[invalid])
+
+    return shapely.union_all(clipped)
+
+def get_categories_whole(expression, areas: dict) -> list:
+    """
+    Returns the categories that evaluate requests whole, without bounds, in the order it reaches them:
+    the operands of or and the first operand of and, as long as no bounds are known yet.
+    Evaluation always needs these, so their unions can be built up front.
+
+    Parameters:
+    expression: Expression from parse.
+    areas (dict): Estimated area of every category, as passed to evaluate.
+
+    Returns:
+    list: Names of the categories.
+    """
+    categories = []
+    if expression is not None:
+        _get_categories_whole(expression, areas, False, categories)
+    return list(dict.fromkeys(categories))
+
+def _get_categories_whole(expression, areas: dict, bounded: bool, categories: list):
+    if isinstance(expression, str):
+        if not bounded:
+            categories.append(expression)
+        return
+
+    (operator, operands), = expression.items()
+    if operator == 'or':
+        for operand in operands:
+            _get_categories_whole(operand, areas, bounded, categories)
+    elif operator == 'and':
+        # Not operands are always requested within the bounds of the result
+        operands = _sort_operands([o for o in operands if not (isinstance(o, dict) and 'not' in o)], areas)
+        for i, operand in enumerate(operands):
+            _get_categories_whole(operand, areas, bounded or i > 0, categories)
+
+def _sort_operands(operands: list, areas: dict) -> list:
+    # The smallest operand first leaves the least to intersect with, operands without geometry last
+    estimates = [estimate_area(operand, areas) for operand in operands]
+    return [operands[i] for i in np.argsort([np.inf if e is None else e for e in estimates], kind='stable')]
+
+def evaluate(expression, get_geometry, areas: dict) -> shapely.Geometry:
+    """
+    Evaluates the expression over the geometries of the categories, requesting every category
+    only when the evaluation reaches it.
+
+    Operands of and are intersected from the smallest estimated area up, the running result is
+    empty-checked after every step and the remaining operands are skipped once it is empty.
+    Every operand of and after the first one, including the categories of a nested or, is requested
+    within the bounding box of the running result, so it can be clipped before it is unioned.
+    Not operands are unioned and subtracted at the end.
+
+    Parameters:
+    expression: Expression from parse.
+    get_geometry (callable): Called with a category and bounds (xmin, ymin, xmax, ymax), or None for
+        the whole category. Returns the geometry of the category, at least its part within the bounds,
+        or None for categories without locations.
+    areas (dict): Estimated area of every category, used to order intersections.
+
+    Returns:
+    Geometry: The combined geometry, None if none of the categories has a geometry.
+    """
+    if expression is None:
+        return None
+
+    return _evaluate(expression, get_geometry, areas, None)
+
+def _evaluate(expression, get_geometry, areas: dict, bounds: tuple) -> shapely.Geometry:
+    if isinstance(expression, str):
+        return get_geometry(expression, bounds)
+
+    (operator, operands), = expression.items()
+    if operator == 'or':
+        geometries_operands = [_evaluate(operand, get_geometry, areas, bounds) for operand in operands]
+        geometries_operands = [geometry for geometry in geometries_operands if geometry is not None]
+        return shapely.union_all(geometries_operands) if geometries_operands else None
+    elif operator == 'and':
+        return _evaluate_and(operands, get_geometry, areas, bounds)
+
+    raise ValueError("Logic operator 'not' is only supported as an operand of 'and'")
+
+def _evaluate_and(operands: list, get_geometry, areas: dict, bounds: tuple) -> shapely.Geometry:
+    negated = [operand['not'] for operand in operands if isinstance(operand, dict) and 'not' in operand]
+    operands = [operand for operand in operands if not (isinstance(operand, dict) and 'not' in operand)]
+
+    operands = _sort_operands(operands, areas)
+
+    result = None
+    for operand in operands:
+        geometry = _evaluate(operand, get_geometry, areas, bounds if result is None else result.bounds)
+        if geometry is None:
+            continue
+        result = geometry if result is None else shapely.intersection(result, geometry)
+        if result.is_empty:
+            return result
+
+    if result is None or not negated:
+        return result
+
+    geometries_negated = [_evaluate(operand, get_geometry, areas, result.bounds) for operand in negated]
+    geometries_negated = [geometry for geometry in geometries_negated if geometry is not None]
+    if not geometries_negated:
+        return result
+
+    return shapely.difference(result, shapely.union_all(geometries_negated))
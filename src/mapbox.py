@@ -1,52 +1,176 @@
-import requests
+import functools
 import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src import metrics
+from src import network
+from src.coordinates import Coordinates
+
+# Mapbox accepts at most four contours per isochrone request
+MAX_CONTOURS = 4
+
+# Isochrone endpoint, values in {} are profile, lon, lat, contours and token.
+# Read on every request, so it can be pointed to a local server, e.g. by benchmarks
+ISOCHRONE_LINK = 'https://api.mapbox.com/isochrone/v1/mapbox/{}/{},{}?contours_minutes={}&polygons=true&access_token={}'
 
 def get_isochrone_coordinates(
-        profile: str, 
+        profile: str,
         lon: float,
         lat: float,
         contours_minutes: int,
-        path_mapbox_token: str = 'data/tokens/mapbox.txt', 
-        mapbox_link: str = 'https://api.mapbox.com/isochrone/v1/mapbox/{}/{},{}?contours_minutes={}&polygons=true&access_token={}'
-    ) -> list:
+        path_mapbox_token: str = 'data/tokens/mapbox.txt',
+        mapbox_link: str = None
+    ) -> Coordinates:
+    """
+    profile: The Mapbox routing profile that the query should use. This can be walking for pedestrian and hiking travel times, cycling for travel times by bicycle, or driving for travel times by car.
+    lon: Longitude value around which to center the isochrone lines.
+    lat: Latitude value around which to center the isochrone lines.
+    contours_minutes: Time that describes the duration in minutes of the trip. The maximum duration is 60 minutes.
+    path_mapbox_token: Personal token needed for retrieval is stored in txt file
+    mapbox_link: Link for polygon retrieval, values in <> need to be replaced. Defaults to ISOCHRONE_LINK
+
+    returns Coordinates with one ring per polygon ring of the isochrone
+    """
+
+    polygons_contours = get_isochrone_contours(
+        profile, lon, lat, [contours_minutes], path_mapbox_token, mapbox_link
+    )
+
+    return polygons_contours[contours_minutes]
+
+def get_isochrone_contours(
+        profile: str,
+        lon: float,
+        lat: float,
+        contours_minutes: list[int],
+        path_mapbox_token: str = 'data/tokens/mapbox.txt',
+        mapbox_link: str = None
+    ) -> dict:
     """
     profile: The Mapbox routing profile that the query should use. This can be walking for pedestrian and hiking travel times, cycling for travel times by bicycle, or driving for travel times by car.
     lon: Longitude value around which to center the isochrone lines.
     lat: Latitude value around which to center the isochrone lines.
-    contours_minutes: Times that describe the duration in minutes of the trip. This can be a comma-separated list of up to four times. The maximum duration is 60 minutes.
+    contours_minutes: Up to four times in minutes, all of them are retrieved with a single request. The maximum duration is 60 minutes.
     path_mapbox_token: Personal token needed for retrieval is stored in txt file
-    mapbox_link: Link for polygon retrieval, values in <> need to be replaced
+    mapbox_link: Link for polygon retrieval, values in <> need to be replaced. Defaults to ISOCHRONE_LINK
 
-    returns list of dict of coordinates, one pair example is 0 : {'lat':[], 'lon':[]}
+    returns dict of contour minutes to Coordinates with one ring per polygon ring of the isochrone.
+    Raises requests.HTTPError for error responses and ValueError for responses without features,
+    so failed requests are never taken for an empty isochrone.
     """
 
     mapbox_token = get_token(path_mapbox_token)
+    mapbox_link = ISOCHRONE_LINK if mapbox_link is None else mapbox_link
+    contours_minutes = sorted(set(contours_minutes))
 
     assert profile in ['driving', 'walking', 'cycling']
-    assert contours_minutes in [5, 10, 20, 30, 40, 50, 60]
+    assert 1 <= len(contours_minutes) <= MAX_CONTOURS
+    assert all(c in [5, 10, 20, 30, 40, 50, 60] for c in contours_minutes)
     assert isinstance(lon, float)
     assert isinstance(lat, float)
     assert isinstance(mapbox_token, str)
     assert not mapbox_token == '<Here comes Mapbox API token>'
 
-    link = mapbox_link.format(profile, lat, lon, contours_minutes, mapbox_token)
-    link_content = requests.get(link)
-    link_content_json = link_content.json()
-    
-    if 'features' in link_content_json:
-        polygons_coordinates = link_content_json['features'][0]['geometry']['coordinates']
-        polygons_coordinates = [{'lon': [pp[0] for pp in p], 'lat': [pp[1] for pp in p]}
-                        for p in polygons_coordinates]
-    else:
-        print('Missing features', link)
-        polygons_coordinates = [{'lon': [], 'lat': []}]
+    contours = ','.join(str(c) for c in contours_minutes)
+    link = mapbox_link.format(profile, lon, lat, contours, mapbox_token)
+    with metrics.span('mapbox', 'network', profile=profile, contours_minutes=contours_minutes):
+        link_content = network.get_session().get(link)
+        link_content.raise_for_status()
+        link_content_json = link_content.json()
+
+    if 'features' not in link_content_json:
+        raise ValueError(f"Isochrone response without features: {link_content_json.get('message', link_content_json)}")
 
-    return polygons_coordinates
+    polygons_contours = {c: Coordinates.from_rings([[]]) for c in contours_minutes}
+    for feature in link_content_json['features']:
+        polygons_coordinates = feature['geometry']['coordinates']
+        polygons_contours[feature['properties']['contour']] = Coordinates.from_rings(polygons_coordinates)
 
+    return polygons_contours
+
+def iter_isochrone_coordinates_batch(
+        queries: list[dict],
+        max_workers: int = 8,
+        requests_per_minute: float = 300,
+        rate_limiter: network.RateLimiter = None,
+        max_retries: int = 5,
+        retry_backoff: float = 2.
+    ):
+    """
+    Fetches many isochrones concurrently over one pooled session and yields them as they arrive,
+    so callers can store every isochrone before the rest are done.
+
+    Rate limited (429) and server error (5xx) responses and connection errors are retried with
+    exponential backoff, other errors fail the query at once. A failed query does not stop the others,
+    the first error is raised after all queries are done.
+
+    Parameters:
+    queries (list): Keyword arguments for get_isochrone_contours, one dict per request.
+    max_workers (int): Maximum number of requests in flight at once.
+    requests_per_minute (float): Rate limit shared by all workers. Mapbox allows 300 isochrone requests per minute by default.
+    rate_limiter (RateLimiter): Limiter to use instead of a new one, e.g. shared by all locations of a run.
+    max_retries (int): The number of times a failed request is retried before giving up.
+    retry_backoff (float): The wait in seconds before the first retry, doubled for every next one.
+
+    Yields:
+    tuple: Index of the query and its result of get_isochrone_contours.
+    """
+    import requests
+
+    if rate_limiter is None:
+        rate_limiter = network.RateLimiter(requests_per_minute, burst=max_workers)
+    network.get_session(pool_size=max_workers)
+
+    def fetch(query):
+        for attempt in range(max_retries + 1):
+            rate_limiter.acquire()
+            time_start = time.perf_counter()
+            try:
+                polygons_contours = get_isochrone_contours(**query)
+                break
+            except (requests.exceptions.RequestException, ValueError) as e:
+                response = getattr(e, 'response', None)
+                retryable = response is None or response.status_code == 429 or response.status_code >= 500
+                if not retryable or attempt == max_retries:
+                    raise RuntimeError(f"Isochrone request {query['profile']} {query['contours_minutes']} min at {query['lon']}, {query['lat']} failed") from e
+                print(f"An error occurred in an isochrone request, retrying: {e}")
+                time.sleep(retry_backoff * 2 ** attempt)
+        latency = time.perf_counter() - time_start
+        print(f"Isochrone fetched in {latency * 1000:.0f} ms: {query['profile']} {query['contours_minutes']} min")
+        return polygons_contours
+
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, query): i for i, query in enumerate(queries)}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except RuntimeError as e:
+                error = error or e
+                continue
+            yield futures[future], result
+
+    if error is not None:
+        raise error
+
+def get_isochrone_coordinates_batch(queries: list[dict], **kwargs) -> list:
+    """
+    Fetches many isochrones concurrently, see iter_isochrone_coordinates_batch for the keyword arguments.
+
+    Returns:
+    list: Results of get_isochrone_contours in the same order as queries.
+    """
+    results = [None] * len(queries)
+    for i, polygons_contours in iter_isochrone_coordinates_batch(queries, **kwargs):
+        results[i] = polygons_contours
+    return results
+
+@functools.lru_cache(maxsize=None)
 def get_token(path: str) -> str:
     """
     path: Path to text file which contains Mapbox token
-    
+
     returns token string
     """
 
@@ -0,0 +1,269 @@
+import contextlib
+import itertools
+import json
+import os
+import pathlib
+import threading
+import time
+import tracemalloc
+
+from src import cache
+
+class Recorder:
+    """
+    A class to record spans of work, e.g. building a location, a network call or a union.
+
+    Every span stores its wall time, CPU time of its thread, cache hits and misses of the process
+    while it was open and, if memory is traced, the peak of traced memory above the start of the span.
+    Spans nest per thread. Optionally the whole recording is profiled with cProfile.
+
+    Attributes
+    ----------
+    spans : list
+        finished spans as dicts, in the order they finished
+    memory : bool
+        whether peak memory is traced with tracemalloc, which slows Python code down noticeably
+    profiler : cProfile.Profile
+        profiler of the thread that started the recording, None if not profiling
+    """
+
+    def __init__(self, memory: bool = False, profile: bool = False):
+        self.spans = []
+        self.memory = memory
+        self.profiler = None
+        if profile:
+            # Every run imports this module, profiling modules are only loaded when they are used
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+        self._time_start = time.perf_counter()
+        self._ids = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._memory_top = None
+
+        self._tracemalloc_started = memory and not tracemalloc.is_tracing()
+        if self._tracemalloc_started:
+            tracemalloc.start()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def stop(self):
+        """
+        Stops profiling and memory tracing, spans can still be exported afterwards.
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.memory and tracemalloc.is_tracing():
+            statistics = tracemalloc.take_snapshot().statistics('lineno')[:20]
+            self._memory_top = [
+                {'location': str(stat.traceback), 'size_mb': stat.size / 1024 / 1024, 'count': stat.count}
+                for stat in statistics
+            ]
+        if self._tracemalloc_started:
+            tracemalloc.stop()
+            self._tracemalloc_started = False
+
+    @contextlib.contextmanager
+    def span(self, name: str, stage: str, **args):
+        """
+        Records the work done inside the with block.
+
+        Parameters:
+        name (str): Name of the span, e.g. the location name.
+        stage (str): Kind of work, e.g. 'location', 'network' or 'union'.
+        **args: Additional values stored with the span, e.g. the location type.
+        """
+        stack = self._local.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack else None
+        # tracemalloc has a single peak for the process, it is only followed on the main thread
+        track_memory = self.memory and tracemalloc.is_tracing() and threading.current_thread() is threading.main_thread()
+
+        record = {
+            'name': name,
+            'stage': stage,
+            'id': next(self._ids),
+            'parent': None if parent is None else parent['id'],
+            'thread': threading.get_ident(),
+            'args': args,
+        }
+        if track_memory:
+            memory_start, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent['_peak'] = max(parent.get('_peak', 0), peak)
+            tracemalloc.reset_peak()
+            record['_memory_start'] = memory_start
+
+        hits_start, misses_start = cache.get_counts()
+        cpu_start = time.thread_time()
+        wall_start = time.perf_counter()
+        stack.append(record)
+        try:
+            yield record
+        finally:
+            stack.pop()
+            record['start'] = wall_start - self._time_start
+            record['wall'] = time.perf_counter() - wall_start
+            record['cpu'] = time.thread_time() - cpu_start
+            hits, misses = cache.get_counts()
+            record['cache_hits'] = hits - hits_start
+            record['cache_misses'] = misses - misses_start
+
+            record['memory_peak_mb'] = None
+            if track_memory:
+                peak = max(tracemalloc.get_traced_memory()[1], record.pop('_peak', 0))
+                record['memory_peak_mb'] = (peak - record.pop('_memory_start')) / 1024 / 1024
+                if parent is not None:
+                    parent['_peak'] = max(parent.get('_peak', 0), peak)
+
+            with self._lock:
+                self.spans.append(record)
+
+    def get_summary(self) -> dict:
+        """
+        Returns totals of spans by stage, of locations by type and category, and the slowest spans.
+        Self time is the wall time of a span without the spans nested in it.
+        """
+        wall_children = {}
+        for span in self.spans:
+            if span['parent'] is not None:
+                wall_children[span['parent']] = wall_children.get(span['parent'], 0.) + span['wall']
+
+        def add(totals, key, span):
+            total = totals.setdefault(key, {'count': 0, 'wall': 0., 'self': 0., 'cpu': 0., 'cache_hits': 0, 'cache_misses': 0})
+            total['count'] += 1
+            total['wall'] += span['wall']
+            total['self'] += span['wall'] - wall_children.get(span['id'], 0.)
+            total['cpu'] += span['cpu']
+            total['cache_hits'] += span['cache_hits']
+            total['cache_misses'] += span['cache_misses']
+
+        summary = {'stages': {}, 'location_types': {}, 'location_categories': {}}
+        for span in self.spans:
+            add(summary['stages'], span['stage'], span)
+            if span['stage'] == 'location':
+                add(summary['location_types'], span['args'].get('type'), span)
+                add(summary['location_categories'], span['args'].get('category'), span)
+
+        summary['slowest'] = [
+            {key: span[key] for key in ['name', 'stage', 'wall', 'cpu', 'memory_peak_mb', 'args']}
+            for span in sorted(self.spans, key=lambda span: span['wall'], reverse=True)[:20]
+        ]
+
+        return summary
+
+    def get_report(self, top: int = 30) -> dict:
+        """
+        Returns all spans with their summary, and the functions with the highest cumulative time
+        and the largest allocations still held if profiling or memory tracing was enabled.
+        """
+        report = {'spans': sorted(self.spans, key=lambda span: span['start']), 'summary': self.get_summary()}
+
+        if self.profiler is not None:
+            import pstats
+            stats = pstats.Stats(self.profiler).stats
+            functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            report['profile'] = [
+                {'function': f'{path}:{line}({function})', 'calls': calls, 'self': time_self, 'cumulative': time_cumulative}
+                for (path, line, function), (_, calls, time_self, time_cumulative, _) in functions
+            ]
+        if self._memory_top is not None:
+            report['memory_top'] = self._memory_top
+
+        return report
+
+    def write_json(self, path: str):
+        """
+        Writes the report of get_report as JSON.
+        """
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.get_report(), file, indent=4, default=str)
+
+    def write_chrome_trace(self, path: str):
+        """
+        Writes spans in the Chrome trace event format, to be opened in chrome://tracing or ui.perfetto.dev.
+        """
+        pid = os.getpid()
+        events = [
+            {
+                'name': span['name'],
+                'cat': span['stage'],
+                'ph': 'X',
+                'ts': span['start'] * 1e6,
+                'dur': span['wall'] * 1e6,
+                'pid': pid,
+                'tid': span['thread'],
+                'args': {
+                    **span['args'],
+                    'cpu': span['cpu'],
+                    'cache_hits': span['cache_hits'],
+                    'cache_misses': span['cache_misses'],
+                    'memory_peak_mb': span['memory_peak_mb'],
+                },
+            }
+            for span in self.spans
+        ]
+
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file, default=str)
+
+    def write_profile(self, path: str):
+        """
+        Writes cProfile statistics, e.g. for snakeviz or pstats.
+        """
+        if self.profiler is None:
+            raise ValueError("Profiling was not enabled for this recording")
+        self.profiler.dump_stats(path)
+
+_recorder = None
+
+def enable(memory: bool = False, profile: bool = False) -> Recorder:
+    """
+    Starts recording spans in the process, replacing a recording in progress.
+
+    Parameters:
+    memory (bool): Traces peak memory of spans on the main thread with tracemalloc.
+    profile (bool): Profiles the calling thread with cProfile until disable.
+
+    Returns:
+    Recorder: The new recording.
+    """
+    global _recorder
+    if _recorder is not None:
+        _recorder.stop()
+    _recorder = Recorder(memory, profile)
+    return _recorder
+
+def disable() -> Recorder:
+    """
+    Stops recording and returns the finished recording, None if none was in progress.
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.stop()
+    return recorder
+
+def get_recorder() -> Recorder:
+    """
+    Returns the recording in progress, None if recording is disabled.
+    """
+    return _recorder
+
+@contextlib.contextmanager
+def span(name: str, stage: str, **args):
+    """
+    Records the with block in the recording in progress, does nothing if recording is disabled.
+    See Recorder.span.
+    """
+    recorder = _recorder
+    if recorder is None:
+        yield None
+        return
+
+    with recorder.span(name, stage, **args) as record:
+        yield record
@@ -0,0 +1,79 @@
+import threading
+import time
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size: int = 16) -> 'requests.Session':
+    """
+    Returns a process-wide requests Session with a keep-alive connection pool.
+
+    Parameters:
+    pool_size (int): Maximum number of pooled connections per host. Only used when the session is created.
+
+    Returns:
+    requests.Session: Shared session, created on first use.
+    """
+    global _session
+
+    # requests takes a noticeable part of the startup, runs from the cache never need it
+    import requests
+
+    with _session_lock:
+        if _session is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+
+    return _session
+
+class RateLimiter:
+    """
+    A thread-safe token bucket used to keep API calls under a rate limit.
+
+    Attributes
+    ----------
+    rate : float
+        number of tokens added per second
+    capacity : float
+        maximum number of tokens that can be stored, i.e. the allowed burst size
+    """
+
+    def __init__(self, requests_per_minute: float, burst: int = 1):
+        """
+        Constructs the token bucket.
+
+        Parameters
+        ----------
+            requests_per_minute : float
+                sustained number of calls allowed per minute
+            burst : int
+                number of calls that may be issued back to back before throttling starts
+        """
+        if requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive")
+
+        self.rate = requests_per_minute / 60.
+        self.capacity = float(burst)
+        self._tokens = float(burst)
+        self._timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and consumes it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._timestamp) * self.rate)
+                self._timestamp = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
@@ -1,12 +1,30 @@
-import requests
+import os
+import pathlib
+import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from src import grid
+from src import metrics
+from src import network
+
+# Elevation endpoint, {} is replaced by the locations of a batch.
+# Both values are read on every call, so they can be pointed to a local server, e.g. by benchmarks
+ELEVATION_LINK = "https://api.opentopodata.org/v1/aster30m?locations={}"
+# The public API allows one request per second
+API_TIME_SLEEP = 1.
+
 def get_elevations(
         config: dict,
         api_batch_size : int = 100,
-        api_time_sleep : int = 1,
-        link_opentodata : str = "https://api.opentopodata.org/v1/aster30m?locations={}"
+        api_time_sleep : float = None,
+        link_opentodata : str = None,
+        path_checkpoint : str = None,
+        max_workers : int = 4,
+        max_retries : int = 5,
+        retry_backoff : float = 2.
     ) -> dict:
     """
     Fetches elevation data for a set of coordinates from the OpenTopoData API.
@@ -18,53 +36,83 @@ def get_elevations(
         'n_points_lon' (int): The number of points to sample along the longitude.
         'n_points_lat' (int): The number of points to sample along the latitude.
 
-    api_batch_size (int, optional): The number of API requests to send at once. Maximum is 100.
-    api_time_sleep (int, optional): The time in seconds to wait between API requests. Minimum is 1 second.
-    link_opentodata (str, optional): The URL of the OpenTopoData API endpoint. 
+    api_batch_size (int, optional): The number of locations sent in one API request. Maximum is 100.
+    api_time_sleep (float, optional): The average time in seconds between API requests. Defaults to API_TIME_SLEEP.
+    link_opentodata (str, optional): The URL of the OpenTopoData API endpoint. Defaults to ELEVATION_LINK.
+    path_checkpoint (str, optional): Directory in which every completed batch is stored. Batches found there are not fetched again, so an interrupted run resumes where it stopped. The directory is removed once all batches are done.
+    max_workers (int, optional): The number of requests that can be in flight at once.
+    max_retries (int, optional): The number of times a failed batch is retried before giving up.
+    retry_backoff (float, optional): The wait in seconds before the first retry, doubled for every next one.
 
     Returns:
-    dict: A dictionary containing the following keys:
+    dict: A dictionary containing the following keys, ordered as the sampled grid:
         'lon' (list): The longitudes of the sampled points.
         'lat' (list): The latitudes of the sampled points.
         'elevation' (list): The elevations of the sampled points.
     """
 
-    lon_linspace = np.linspace(config['top_left']['lon'], config['bottom_right']['lon'], config['n_points_lon'])
-    lat_linspace = np.linspace(config['top_left']['lat'], config['bottom_right']['lat'], config['n_points_lat'])
-    lon_mesh, lat_mesh = np.meshgrid(lon_linspace, lat_linspace)
+    import requests
 
-    # Add longitude shift to get hex
-    lon_mesh[::2] +=  (lon_linspace[1] - lon_linspace[0])*0.5
+    api_time_sleep = API_TIME_SLEEP if api_time_sleep is None else api_time_sleep
+    link_opentodata = ELEVATION_LINK if link_opentodata is None else link_opentodata
 
-    lon_coords = lon_mesh.flatten()
-    lat_coords = lat_mesh.flatten()
+    lon_coords, lat_coords = grid.get_hex_grid(config)
 
-    lon_batches = lon_coords.reshape(-1, api_batch_size)
-    lat_batches = lat_coords.reshape(-1, api_batch_size)
+    batches = [slice(i, i + api_batch_size) for i in range(0, len(lon_coords), api_batch_size)]
 
-    coords = {
-        'lon' : [],
-        'lat' : [],
-        'elevation' : []
-    }
+    if path_checkpoint is not None:
+        path_checkpoint = pathlib.Path(path_checkpoint)
+        path_checkpoint.mkdir(parents=True, exist_ok=True)
+
+    rate_limiter = network.RateLimiter(60. / api_time_sleep)
+    session = network.get_session()
 
-    for lon_batch, lat_batch in zip(lon_batches, lat_batches):
+    def fetch_batch(i):
+        path_batch = None if path_checkpoint is None else path_checkpoint / f'batch_{i:05d}.npz'
+        if path_batch is not None and path_batch.exists():
+            with np.load(path_batch) as batch:
+                return {key: batch[key] for key in ['lon', 'lat', 'elevation']}
 
-        lon_lat = ' | '.join([ '{},{}'.format(llat, llon) for llon, llat in zip(lon_batch, lat_batch)])
+        lon_lat = ' | '.join([ '{},{}'.format(llat, llon) for llon, llat in zip(lon_coords[batches[i]], lat_coords[batches[i]])])
         link = link_opentodata.format(lon_lat)
-        
-        try:
-            link_content = requests.get(link).json()
-        except requests.exceptions.RequestException as e:
-            print(f"An error occurred: {e}")
-            continue
 
-        for p in link_content['results']:
+        for attempt in range(max_retries + 1):
+            rate_limiter.acquire()
+            try:
+                with metrics.span('opentopdata', 'network', batch=i, attempt=attempt):
+                    link_content = session.get(link)
+                    link_content.raise_for_status()
+                    results = link_content.json()['results']
+                break
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                if attempt == max_retries:
+                    raise RuntimeError(f"Elevation batch {i} failed after {max_retries} retries") from e
+                print(f"An error occurred in elevation batch {i}, retrying: {e}")
+                time.sleep(retry_backoff * 2 ** attempt)
 
-            coords['lat'].append(p['location']['lat'])
-            coords['lon'].append(p['location']['lng'])
-            coords['elevation'].append(p['elevation'])       
+        batch = {
+            'lon': np.array([p['location']['lng'] for p in results], dtype=float),
+            'lat': np.array([p['location']['lat'] for p in results], dtype=float),
+            'elevation': np.array([np.nan if p['elevation'] is None else p['elevation'] for p in results], dtype=float),
+        }
+
+        if path_batch is not None:
+            # Write to a temporary file first so a crash never leaves a truncated checkpoint
+            path_temp = path_batch.with_suffix('.tmp.npz')
+            np.savez(path_temp, **batch)
+            os.replace(path_temp, path_batch)
+
+        return batch
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(fetch_batch, range(len(batches))))
+
+    coords = {
+        key: np.concatenate([batch[key] for batch in results]).tolist()
+        for key in ['lon', 'lat', 'elevation']
+    }
 
-        time.sleep(api_time_sleep)
+    if path_checkpoint is not None:
+        shutil.rmtree(path_checkpoint)
 
-    return coords
\ No newline at end of file
+    return coords
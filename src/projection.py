@@ -0,0 +1,153 @@
+import numpy as np
+import shapely
+
+from src.coordinates import Coordinates
+
+# WGS84 ellipsoid
+EARTH_SEMI_MAJOR_AXIS = 6378137.
+EARTH_FLATTENING = 1 / 298.257223563
+
+# Metres per degree of latitude, also per degree of longitude at the equator
+METERS_PER_DEGREE = 111320.
+
+class LocalProjection:
+    """
+    A class to project lon/lat coordinates to a local metric plane and back.
+
+    Uses the azimuthal equidistant projection centred at the origin, scaled north-south and east-west by the
+    radii of curvature of the WGS84 ellipsoid at the origin. Within a city, distances are off by well under
+    a metre per ten kilometres, so buffers and circles can be given in metres at any latitude.
+
+    Attributes
+    ----------
+    lon_origin : float
+        longitude of the centre of the projection in degrees
+    lat_origin : float
+        latitude of the centre of the projection in degrees
+    radius_meridian : float
+        north-south radius of curvature at the origin in metres
+    radius_prime_vertical : float
+        east-west radius of curvature at the origin in metres
+    """
+
+    __slots__ = (
+        'lon_origin', 'lat_origin', 'radius_meridian', 'radius_prime_vertical', '_sin_lat_origin', '_cos_lat_origin'
+    )
+
+    def __init__(self, lon_origin: float, lat_origin: float):
+        self.lon_origin = float(lon_origin)
+        self.lat_origin = float(lat_origin)
+
+        e2 = EARTH_FLATTENING * (2 - EARTH_FLATTENING)
+        sin_lat = np.sin(np.radians(self.lat_origin))
+        self.radius_prime_vertical = float(EARTH_SEMI_MAJOR_AXIS / np.sqrt(1 - e2 * sin_lat ** 2))
+        self.radius_meridian = float(self.radius_prime_vertical * (1 - e2) / (1 - e2 * sin_lat ** 2))
+
+        self._sin_lat_origin = float(sin_lat)
+        self._cos_lat_origin = float(np.cos(np.radians(self.lat_origin)))
+
+    def __repr__(self) -> str:
+        return f'LocalProjection(lon_origin={self.lon_origin}, lat_origin={self.lat_origin})'
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, LocalProjection) and self.origin == other.origin
+
+    def __hash__(self) -> int:
+        return hash(self.origin)
+
+    def __getstate__(self) -> tuple:
+        return self.origin
+
+    def __setstate__(self, state: tuple):
+        self.__init__(*state)
+
+    @property
+    def origin(self) -> tuple:
+        return (self.lon_origin, self.lat_origin)
+
+    def forward(self, lon, lat) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Projects longitudes and latitudes in degrees to x (east) and y (north) in metres.
+        """
+        lat = np.radians(np.asarray(lat, dtype=float))
+        dlon = np.radians(np.asarray(lon, dtype=float) - self.lon_origin)
+        sin_lat, cos_lat = np.sin(lat), np.cos(lat)
+        cos_dlon = np.cos(dlon)
+
+        cos_c = np.clip(self._sin_lat_origin * sin_lat + self._cos_lat_origin * cos_lat * cos_dlon, -1, 1)
+        c = np.arccos(cos_c)
+        # Scale c / sin(c) tends to 1 at the origin
+        sin_c = np.sin(c)
+        k = np.divide(c, sin_c, out=np.ones_like(c), where=sin_c > 1e-12)
+
+        x = k * cos_lat * np.sin(dlon) * self.radius_prime_vertical
+        y = k * (self._cos_lat_origin * sin_lat - self._sin_lat_origin * cos_lat * cos_dlon) * self.radius_meridian
+
+        return x, y
+
+    def inverse(self, x, y) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Converts x (east) and y (north) in metres back to longitudes and latitudes in degrees.
+        """
+        # Angular distance from the origin along the unit sphere
+        x = np.asarray(x, dtype=float) / self.radius_prime_vertical
+        y = np.asarray(y, dtype=float) / self.radius_meridian
+        c = np.hypot(x, y)
+        sin_c, cos_c = np.sin(c), np.cos(c)
+
+        y_c = np.divide(y, c, out=np.zeros_like(c), where=c > 0)
+        lat = np.arcsin(np.clip(cos_c * self._sin_lat_origin + y_c * sin_c * self._cos_lat_origin, -1, 1))
+        dlon = np.arctan2(
+            x * sin_c,
+            c * self._cos_lat_origin * cos_c - y * self._sin_lat_origin * sin_c
+        )
+
+        return np.degrees(dlon) + self.lon_origin, np.degrees(lat)
+
+    def project(self, coordinates: Coordinates) -> Coordinates:
+        """
+        Returns coordinates projected to metres, with the same rings.
+        """
+        x, y = self.forward(coordinates.lon, coordinates.lat)
+        return Coordinates(np.column_stack([x, y]), coordinates.offsets)
+
+    def to_metric(self, geometry):
+        """
+        Projects a Shapely geometry, or an array of them, from lon/lat to metres.
+        """
+        return shapely.transform(geometry, lambda xy: np.column_stack(self.forward(xy[:, 0], xy[:, 1])))
+
+    def to_lonlat(self, geometry):
+        """
+        Converts a Shapely geometry, or an array of them, from metres back to lon/lat.
+        """
+        if geometry is None:
+            return None
+        return shapely.transform(geometry, lambda xy: np.column_stack(self.inverse(xy[:, 0], xy[:, 1])))
+
+def get_projection(configs: list[dict], center: dict = None) -> LocalProjection:
+    """
+    Returns the projection shared by all locations of a map.
+
+    Parameters:
+    configs (list): Location configurations, with coordinates already updated from the database.
+    center (dict): Map center with 'lat' and 'lon' keys. Defaults to the middle of the locations.
+
+    Returns:
+    LocalProjection: Projection centred at the map center.
+    """
+    if center is not None:
+        return LocalProjection(center['lon'], center['lat'])
+
+    points = [
+        point for config in configs
+        for point in config.get('coordinates', [])
+        + [config['region'][corner] for corner in ['top_left', 'bottom_right'] if corner in config.get('region', {})]
+    ]
+    if not points:
+        raise ValueError("Cannot place the projection without a map center or location coordinates")
+
+    lon = [point['lon'] for point in points]
+    lat = [point['lat'] for point in points]
+
+    return LocalProjection((min(lon) + max(lon)) / 2, (min(lat) + max(lat)) / 2)
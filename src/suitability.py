@@ -0,0 +1,146 @@
+import numpy as np
+import shapely
+from scipy import ndimage
+
+from src import projection
+
+def get_raster_grid(config: dict, n_points_lat: int, n_points_lon: int) -> dict:
+    """
+    Creates a regular lat/lon raster with cell centres spanning the region.
+
+    Parameters:
+    config (dict): Region with 'top_left' and 'bottom_right' keys, each with 'lat' and 'lon'.
+    n_points_lat (int): The number of cells along the latitude.
+    n_points_lon (int): The number of cells along the longitude.
+
+    Returns:
+    dict: Raster definition with keys 'lon_min', 'lat_max', 'lon_step', 'lat_step', 'shape'.
+    """
+    lon_min, lon_max = config['top_left']['lon'], config['bottom_right']['lon']
+    lat_min, lat_max = config['bottom_right']['lat'], config['top_left']['lat']
+
+    return {
+        'lon_min': lon_min,
+        'lat_max': lat_max,
+        'lon_step': (lon_max - lon_min) / n_points_lon,
+        'lat_step': (lat_max - lat_min) / n_points_lat,
+        'shape': (n_points_lat, n_points_lon),
+    }
+
+def rasterize(geometry: shapely.Geometry, raster: dict) -> np.ndarray:
+    """
+    Rasterizes polygons with a vectorized even-odd scanline fill.
+    A cell is inside if its centre is inside the geometry, holes are handled by the even-odd rule.
+
+    Parameters:
+    geometry (Geometry): Shapely Polygon or MultiPolygon in lon/lat.
+    raster (dict): Raster definition from get_raster_grid.
+
+    Returns:
+    np.ndarray: Boolean mask with rows from north to south.
+    """
+    n_rows, n_cols = raster['shape']
+    if geometry is None or geometry.is_empty:
+        return np.zeros((n_rows, n_cols), dtype=bool)
+
+    # All ring edges of all polygon parts as (x0, y0) -> (x1, y1)
+    rings = shapely.get_rings(shapely.get_parts(geometry))
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+    same_ring = ring_index[:-1] == ring_index[1:]
+    x0, y0 = coords[:-1][same_ring].T
+    x1, y1 = coords[1:][same_ring].T
+
+    # Rows whose centre lies in [min(y0, y1), max(y0, y1)), half open so vertices are not counted twice
+    row_offset = raster['lat_max'] / raster['lat_step'] - 0.5
+    row_first = np.floor(row_offset - np.maximum(y0, y1) / raster['lat_step']).astype(np.intp) + 1
+    row_last = np.floor(row_offset - np.minimum(y0, y1) / raster['lat_step']).astype(np.intp)
+    row_first = np.clip(row_first, 0, n_rows)
+    row_last = np.clip(row_last, -1, n_rows - 1)
+    n_crossings = np.maximum(row_last - row_first + 1, 0)
+
+    edge = np.repeat(np.arange(len(x0)), n_crossings)
+    row = np.repeat(row_first, n_crossings) + (np.arange(n_crossings.sum()) - np.repeat(np.cumsum(n_crossings) - n_crossings, n_crossings))
+    y_row = raster['lat_max'] - (row + 0.5) * raster['lat_step']
+    x_crossing = x0[edge] + (y_row - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+
+    # Every crossing toggles inside/outside for all cells whose centre lies to the right of it
+    col = np.ceil((x_crossing - raster['lon_min']) / raster['lon_step'] - 0.5).astype(np.intp)
+    col = np.clip(col, 0, n_cols)
+
+    toggles = np.zeros((n_rows, n_cols + 1), dtype=np.int32)
+    np.add.at(toggles, (row, col), 1)
+
+    return (np.cumsum(toggles[:, :-1], axis=1) % 2).astype(bool)
+
+def get_category_score(mask: np.ndarray, raster: dict, decay_distance: float) -> np.ndarray:
+    """
+    Scores cells by proximity to a category: 1 inside, exp(-distance / decay_distance) outside.
+
+    Parameters:
+    mask (np.ndarray): Rasterized category polygons.
+    raster (dict): Raster definition from get_raster_grid.
+    decay_distance (float): Distance in metres at which the score drops to 1/e. Zero keeps a hard edge.
+
+    Returns:
+    np.ndarray: Score of every cell between 0 and 1.
+    """
+    if not decay_distance or not mask.any():
+        return mask.astype(np.float32)
+
+    lat_center = raster['lat_max'] - raster['shape'][0] * raster['lat_step'] / 2
+    sampling = (
+        raster['lat_step'] * projection.METERS_PER_DEGREE,
+        raster['lon_step'] * projection.METERS_PER_DEGREE * np.cos(np.radians(lat_center)),
+    )
+    distance = ndimage.distance_transform_edt(~mask, sampling=sampling)
+
+    return np.exp(-distance / decay_distance).astype(np.float32)
+
+def get_suitability(map) -> dict:
+    """
+    Evaluates a graded suitability score of the map on a raster instead of a boolean area.
+    Configured through the 'heatmap' block of the map configuration:
+        'weights' (dict): Weight of every scored category, negative for categories to avoid.
+        'decay_distance' (dict, optional): Distance decay in metres per category, zero (default) keeps a hard edge.
+        'n_points_lat', 'n_points_lon' (int, optional): Raster size, 1000 x 1000 by default.
+        'top_left', 'bottom_right' (dict, optional): Raster region, bounds of the scored categories by default.
+
+    Parameters:
+    map (data_handler.Map): Map with stacked locations.
+
+    Returns:
+    dict: Raster definition from get_raster_grid with the additional key
+        'score' (np.ndarray): Weighted score of every cell, normalized by the sum of absolute weights.
+    """
+    config = map.configuration['heatmap']
+    weights = config['weights']
+    # The raster is drawn over the map, so it is laid out in lon/lat
+    geometries = {
+        category: map.projection.to_lonlat(map.get_category_polygon(category))
+        for category in weights if category in map.locations_stacked
+    }
+
+    if 'top_left' in config and 'bottom_right' in config:
+        region = config
+    else:
+        # Without a region the raster covers the scored categories, which needs at least one of them with an area
+        if not any(geometry is not None and not geometry.is_empty for geometry in geometries.values()):
+            missing = [category for category in weights if category not in geometries]
+            raise ValueError(
+                f"Heatmap region cannot be derived: scored categories {list(weights)} have no area"
+                + (f", categories without locations: {missing}" if missing else "")
+                + ". Add 'top_left' and 'bottom_right' to the heatmap block"
+            )
+        lon_min, lat_min, lon_max, lat_max = shapely.total_bounds(list(geometries.values()))
+        region = {'top_left': {'lat': lat_max, 'lon': lon_min}, 'bottom_right': {'lat': lat_min, 'lon': lon_max}}
+
+    raster = get_raster_grid(region, config.get('n_points_lat', 1000), config.get('n_points_lon', 1000))
+
+    score = np.zeros(raster['shape'], dtype=np.float32)
+    for category, geometry in geometries.items():
+        mask = rasterize(geometry, raster)
+        score += weights[category] * get_category_score(mask, raster, config.get('decay_distance', {}).get(category, 0))
+
+    raster['score'] = score / max(sum(abs(w) for w in weights.values()), 1e-12)
+
+    return raster
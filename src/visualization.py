@@ -1,12 +1,58 @@
+import base64
+import hashlib
+import io
+import json
 import pathlib
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import kaleido
+import numpy as np
 import plotly
 import plotly.graph_objects as go
+import plotly.io as pio
 import shapely
+from PIL import Image
 
 from src import mapbox
 from src import data_handler
+from src import suitability
+from src.coordinates import Coordinates
+
+# Hashes of the last exported figures, stored next to them in the results folder
+FIGURES_HASH_FILE = 'figures_hash.json'
+
+_export_pool = None
+
+def get_export_pool(max_workers: int = None) -> ProcessPoolExecutor:
+    """
+    Returns the process pool used for figure export, created on first use.
+    Every worker keeps its kaleido process running between figures, so only the first
+    figure of each worker pays for starting it.
+
+    Parameters:
+    max_workers (int): Number of worker processes, defaults to the number of CPUs. Only used when the pool is created.
+
+    Returns:
+    ProcessPoolExecutor: Pool shared within the process.
+    """
+    global _export_pool
+
+    if _export_pool is None:
+        _export_pool = ProcessPoolExecutor(max_workers=max_workers)
+
+    return _export_pool
+
+def _write_image(fig: dict, path_fig: str, scale: float) -> float:
+    time_start = time.perf_counter()
+    pio.write_image(fig, path_fig, format='png', engine='kaleido', scale=scale)
+    return time.perf_counter() - time_start
+
+def get_fig_hash(fig: go.Figure, scale: float) -> str:
+    """
+    Returns a hash of everything that is drawn, i.e. geometry, markers and layout of the figure.
+    """
+    return hashlib.sha256(f'{scale}:{fig.to_json()}'.encode()).hexdigest()
 
 def save_figs(
         figs: dict[str, go.Figure],
@@ -14,10 +60,15 @@ def save_figs(
         path_token: str = 'data/tokens/mapbox.txt',
         path_results: str = 'results',
         figure_width: int = 1000,
-        figure_height: int = 1000
+        figure_height: int = 1000,
+        zoom: float = 12,
+        scale: float = 2,
+        max_workers: int = None,
+        skip_unchanged: bool = True
     ):
     """
     Save figures with updated layout.
+    Figures are exported in parallel by a pool of worker processes, see get_export_pool.
 
     Parameters:
     figs (dict): Dictionary of figures to be saved.
@@ -25,18 +76,26 @@ def save_figs(
     path_results (str): Path to save the figures.
     figure_width (str): Figure width in pixels
     figure_height (str): Figure width in pixels
+    zoom (float): Zoom level of the map, polygons should be simplified for the same zoom
+    scale (float): Scale of the exported image relative to the figure size
+    max_workers (int): Number of export processes, defaults to the number of CPUs
+    skip_unchanged (bool): Keeps images whose figure did not change since they were saved
     """
 
     # Get the Mapbox token
     mapbox_token = mapbox.get_token(path_token)
 
+    path_hashes = pathlib.Path(path_results, FIGURES_HASH_FILE)
+    fig_hashes = data_handler.load_json(path_hashes)
+
+    exports = {}
     for fig_name, fig in figs.items():
         # Update the layout of the figure
         fig.update_layout(
             mapbox={
                 'accesstoken': mapbox_token,
                 'style': 'open-street-map',
-                'zoom': 12,
+                'zoom': zoom,
                 'center': {'lat' : center_coord['lat'], 'lon': center_coord['lon']}            
             },
             margin={'r':0,'t':0,'l':0,'b':0},
@@ -48,9 +107,33 @@ def save_figs(
         # Construct the figure path
         path_fig = pathlib.PurePath(path_results, fig_name + '.png')
         path_fig = pathlib.Path(path_fig)
+        path_fig.parent.mkdir(parents=True, exist_ok=True)
+
+        fig_hash = get_fig_hash(fig, scale)
+        if skip_unchanged and fig_hashes.get(fig_name) == fig_hash and path_fig.exists():
+            print(f'Figure unchanged, skipped: {path_fig}')
+            continue
+
+        exports[fig_name] = (path_fig, fig_hash, fig.to_dict())
 
-        # Save the figure
-        fig.write_image(path_fig, engine='kaleido', scale=2)
+    # Save the figures
+    executor = get_export_pool(max_workers)
+    futures = {
+        fig_name: executor.submit(_write_image, fig, str(path_fig), scale)
+        for fig_name, (path_fig, _, fig) in exports.items()
+    }
+    try:
+        for fig_name, future in futures.items():
+            path_fig, fig_hash, _ = exports[fig_name]
+            time_export = future.result()
+            fig_hashes[fig_name] = fig_hash
+            print(f'Figure saved in {time_export:.2f} s: {path_fig}')
+    finally:
+        # Record figures saved so far, also when one of them failed
+        if futures:
+            path_hashes.parent.mkdir(parents=True, exist_ok=True)
+            with open(path_hashes, 'w') as file:
+                json.dump(fig_hashes, file, indent=4)
 
 def draw_elevation(
         fig: go.Figure,
@@ -74,7 +157,7 @@ def draw_elevation(
 
 def draw_initial_coordinates(
         fig: go.Figure,
-        coordinates: dict,
+        coordinates: Coordinates,
         color: str,
         name: str,
         marker_size : int = 10
@@ -84,7 +167,7 @@ def draw_initial_coordinates(
 
     Parameters:
     fig (go.Figure): The figure to which the trace will be added.
-    coordinates (dict): The coordinates to be plotted.
+    coordinates (Coordinates): The coordinates to be plotted.
     color (str): The color of the markers.
     name (str): The name of the trace.
     maker_size (int): The size of the markers
@@ -95,12 +178,12 @@ def draw_initial_coordinates(
     # Plot each category on individual figure
     fig.add_trace(
         go.Scattermapbox(
-            lat = [coord['lat'] for coord in coordinates],
-            lon = [coord['lon'] for coord in coordinates],
+            lat = coordinates.lat,
+            lon = coordinates.lon,
             mode='markers',
             marker = {
                 'size': marker_size,
-                'color': [color for coord in coordinates],
+                'color': color,
             },
             hoverinfo=['name'],
             hoverlabel = dict(namelength = -1),
@@ -145,21 +228,95 @@ def draw_shapely_polygons(
         },       
     )
 
+def draw_heatmap(
+        fig: go.Figure,
+        raster: dict,
+        colorscale: str = 'Viridis',
+        layer_opacity : float = 0.6
+    ) -> None:
+    """
+    This function adds a suitability raster as an image layer to a given figure.
+
+    Parameters:
+    fig (go.Figure): The figure to which the layer will be added.
+    raster (dict): Raster from suitability.get_suitability.
+    colorscale (str): Name of the plotly colorscale.
+    layer_opacity (float): The opacity of the raster.
+
+    Returns:
+    None
+    """
+    score = raster['score']
+    score_min, score_max = float(score.min()), float(score.max())
+
+    # Map scores to colors through a lookup table, far faster than per cell colorscale sampling
+    colors = plotly.colors.sample_colorscale(colorscale, np.linspace(0, 1, 256), colortype='tuple')
+    lookup = (np.array(colors) * 255).astype(np.uint8)
+    index = np.round((score - score_min) / max(score_max - score_min, 1e-12) * 255).astype(np.uint8)
+
+    image = io.BytesIO()
+    Image.fromarray(lookup[index]).save(image, format='png')
+    source = 'data:image/png;base64,' + base64.b64encode(image.getvalue()).decode()
+
+    n_rows, n_cols = raster['shape']
+    lon_min, lat_max = raster['lon_min'], raster['lat_max']
+    lon_max = lon_min + n_cols * raster['lon_step']
+    lat_min = lat_max - n_rows * raster['lat_step']
+
+    # Invisible trace only to show the colorbar
+    fig.add_trace(
+        go.Scattermapbox(
+            lat=[lat_min, lat_max],
+            lon=[lon_min, lon_max],
+            mode='markers',
+            marker={
+                'size': 0,
+                'color': [score_min, score_max],
+                'colorscale': colorscale,
+                'showscale': True
+            },
+            hoverinfo='skip'
+        )
+    )
+
+    fig.update_layout(
+        mapbox = {
+            'layers': [
+                {
+                    'sourcetype': 'image',
+                    'source': source,
+                    'coordinates': [[lon_min, lat_max], [lon_max, lat_max], [lon_max, lat_min], [lon_min, lat_min]],
+                    'opacity': layer_opacity
+                }
+            ],
+        },
+    )
+
 def draw_map(
-        map: data_handler.Map      
+        map: data_handler.Map,
+        path_results: str = 'results',
+        zoom: float = 12,
+        save: bool = True
     ):
     """
     This function draws a map with polygons and locations.
-    It takes a Map object as input and returns a figure.
+    It takes a Map object as input, saves figures to path_results and returns them.
+    Polygons are simplified to the detail visible at the zoom level.
+    With save=False the figures are only built, e.g. to show them in a notebook.
     """
 
     figs = {'final' : go.Figure()}
 
+    # Polygons are stacked in metres, convert them back to lon/lat for drawing
+    to_lonlat = map.projection.to_lonlat
+    geometries = map.get_lod(zoom)
+
     # Plot final polygons
-    final_shapely_polygon = map.locations_stacked['final_shapely_polygon']
+    final_shapely_polygon = to_lonlat(geometries['final'])
     draw_shapely_polygons(figs['final'], final_shapely_polygon, 'green', name='Final')
 
-    # Plot individual category
+    # Plot individual category, the union of a category is converted and drawn once for all of its locations
+    categories_drawn = set()
     for location_name, location in map.locations.items():
 
         location_category = location.config['category']
@@ -172,26 +329,27 @@ def draw_map(
             for polygon in location.polygons:
                 draw_elevation(figs[location_category], polygon.coords)
                 # draw_elevation(figs['final'], polygon.coords)
-        
-        elif location_type == 'line':
+            continue
+
+        if location_category not in categories_drawn:
             draw_shapely_polygons(
                 figs[location_category],
-                map.locations_stacked[location_category]['final_shapely_polygon'],
+                to_lonlat(geometries[location_category]),
                 location.config['color'],
                 location_category
             )
-        
-        else:
-            draw_shapely_polygons(
-                figs[location_category],
-                map.locations_stacked[location_category]['final_shapely_polygon'],
-                location.config['color'],
-                location_category
-            )    
+            categories_drawn.add(location_category)
+
+        if location_type != 'line':
+            draw_initial_coordinates(figs[location_category], location.coordinates, location.config['color'], location_name)
+            draw_initial_coordinates(figs['final'], location.coordinates, location.config['color'], location_name)
 
-            draw_initial_coordinates(figs[location_category], location.config['coordinates'], location.config['color'], location_name)    
-            draw_initial_coordinates(figs['final'], location.config['coordinates'], location.config['color'], location_name)
+    # Plot graded suitability if configured
+    if 'heatmap' in map.configuration:
+        figs['heatmap'] = go.Figure()
+        draw_heatmap(figs['heatmap'], suitability.get_suitability(map))
 
-    save_figs(figs, map.configuration['center'])
+    if save:
+        save_figs(figs, map.configuration['center'], path_results=path_results, zoom=zoom)
 
     return figs
\ No newline at end of file